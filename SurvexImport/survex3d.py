@@ -0,0 +1,1146 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Decoder for survex .3d files (v8), free of any QGIS or Qt dependency
+so that it can be shared by the plugin and the scripts in extra/.
+
+File parser based on a library to handle Survex 3D files (*.3d)
+Copyright (C) 2008-2012 Thomas Holder, http://sf.net/users/speleo3/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from array import array
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date
+from struct import Struct
+
+import gc
+import mmap
+import os
+
+import numpy as np
+
+# Rather than reading the file a byte at a time, the whole file is
+# mapped into memory and walked with an integer offset, unpacking
+# binary data in place with these precompiled structures.
+
+xyz_struct = Struct('<iii')
+xy_struct = Struct('<ii')
+z_struct = Struct('<i')
+len_struct = Struct('<I')
+date_struct = Struct('<H')
+date_range_struct = Struct('<HB')
+date_long_struct = Struct('<HH')
+error_struct = Struct('<iiiii')
+lrud_struct = Struct('<iiii')
+lrud_short_struct = Struct('<hhhh')
+
+Header = namedtuple('Header', 'title cs timestamp version flag offset')
+
+# Records generated by iter_3d_records(), with the current label,
+# style and dates resolved.  Dates are days since 1900.01.01, or None
+# if there is no date.  Line records carry the position they start
+# from, and Xsect records a flag for XSECT_END.
+
+Style = namedtuple('Style', 'style')
+Move = namedtuple('Move', 'xyz')
+Date = namedtuple('Date', 'date1 date2')
+ErrorInfo = namedtuple('ErrorInfo', 'nlehv')
+Xsect = namedtuple('Xsect', 'label lrud date1 date2 end')
+Line = namedtuple('Line', 'xyz_from xyz label style date1 date2 flag')
+Node = namedtuple('Node', 'xyz label flag')
+
+@contextmanager
+def paused_gc():
+    """Suspend the cyclic garbage collector while building many small tuples"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class ByteMap(mmap.mmap):
+    """A memory map which gives integers when indexed, as under Python 3
+
+    Under Python 2 indexing an mmap gives single characters, so this
+    converts them with ord(), leaving slices (strings) and the buffer
+    used by struct.unpack_from() as they are.
+    """
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return mmap.mmap.__getitem__(self, k)
+        return ord(mmap.mmap.__getitem__(self, k))
+
+@contextmanager
+def open_3d(path):
+    """Map a .3d file into memory, yielding (header, buffer)"""
+    with open(path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            raise IOError('Empty file: ' + path)
+        mapping = ByteMap if bytes is str else mmap.mmap
+        buf = mapping(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(buf, 'madvise'): # pages are read once, in order
+            buf.madvise(mmap.MADV_SEQUENTIAL)
+        try:
+            yield read_header(buf, path), buf
+        finally:
+            buf.close()
+
+def read_header(buf, path=''):
+    """Read the header lines, returning a Header with the offset to the data"""
+    lines = []
+    pos = 0
+    for i in range(4):
+        end = buf.find(b'\n', pos)
+        if end < 0:
+            raise IOError('Not a survex .3d file: ' + path)
+        lines.append(bytes(buf[pos:end]).rstrip())
+        pos = end + 1
+
+    if not lines[0].startswith(b'Survex 3D Image File'): # File ID check
+        raise IOError('Not a survex .3d file: ' + path)
+
+    if not lines[1].startswith(b'v'): # File format version
+        raise IOError('Unrecognised survex .3d version in ' + path)
+
+    version = int(lines[1][1:])
+    if version < 8:
+        raise IOError('Survex .3d version >= 8 required in ' + path)
+
+    fields = [s.decode('utf-8') for s in lines[2].split(b'\x00')] # title and CS
+    title = fields[0]
+    cs = fields[1] if len(fields) > 1 else ''
+
+    if not lines[3].startswith(b'@'):
+        raise IOError('Unrecognised timestamp in ' + path)
+
+    timestamp = int(lines[3][1:])
+
+    if pos >= len(buf):
+        raise IOError('Premature end of file in ' + path)
+
+    flag = buf[pos] # file-wide flag
+
+    return Header(title, cs, timestamp, version, flag, pos + 1)
+
+def read_long_label(buf, pos, label):
+    """Read a label whose lengths are in the long format, returning (label, pos)"""
+    ndel = buf[pos]
+    if ndel == 0xff:
+        ndel = len_struct.unpack_from(buf, pos + 1)[0]
+        pos += 4
+    nadd = buf[pos + 1]
+    if nadd == 0xff:
+        nadd = len_struct.unpack_from(buf, pos + 2)[0]
+        pos += 4
+    pos += 2
+    label = label[:len(label) - ndel] + buf[pos:pos + nadd].decode('ascii')
+    return label, pos + nadd
+
+def read_label(buf, pos, label):
+    """Read a label, or part thereof, according to .3d spec, returning (label, pos)"""
+    byte = buf[pos]
+    if byte == 0x00:
+        return read_long_label(buf, pos + 1, label)
+    nadd = byte & 0x0f
+    pos += 1
+    label = label[:len(label) - (byte >> 4)] + buf[pos:pos + nadd].decode('ascii')
+    return label, pos + nadd
+
+def iter_3d_records(path):
+    """Generate the header and then the records in a .3d file, in order
+
+    Nothing is accumulated, and the file is memory mapped, so memory
+    use is independent of the file size.  The
+    file is closed if the generator is closed before the end.
+    """
+    with open_3d(path) as (header, buf):
+
+        yield header
+
+        label, style = '', 0xff
+        date1 = date2 = None
+        xyz = None
+        pos = header.offset
+        unpack_xyz = xyz_struct.unpack_from
+
+        while True:
+
+            try:
+                byte = buf[pos]
+            except IndexError: # End of file (reached prematurely?)
+                raise IOError('Premature end of file in ' + path)
+
+            pos += 1
+
+            if byte <= 0x05: # STYLE
+                if byte == 0x00 and style == 0x00: # this signals end of data
+                    return
+                style = byte
+                yield Style(style)
+
+            elif byte <= 0x0e: # Reserved
+                continue
+
+            elif byte == 0x0f: # MOVE
+                xyz = unpack_xyz(buf, pos)
+                pos += 12
+                yield Move(xyz)
+
+            elif byte == 0x10: # DATE (none)
+                date1 = date2 = None
+                yield Date(date1, date2)
+
+            elif byte == 0x11: # DATE (single date)
+                date1 = date2 = date_struct.unpack_from(buf, pos)[0]
+                pos += 2
+                yield Date(date1, date2)
+
+            elif byte == 0x12:  # DATE (date range, short format)
+                date1, extra = date_range_struct.unpack_from(buf, pos)
+                date2 = date1 + extra + 1
+                pos += 3
+                yield Date(date1, date2)
+
+            elif byte == 0x13: # DATE (date range, long format)
+                date1, date2 = date_long_struct.unpack_from(buf, pos)
+                pos += 4
+                yield Date(date1, date2)
+
+            elif byte <= 0x1e: # Reserved
+                continue
+
+            elif byte == 0x1f:  # Error info
+                yield ErrorInfo(error_struct.unpack_from(buf, pos))
+                pos += 20
+
+            elif byte <= 0x2f: # Reserved
+                continue
+
+            elif byte <= 0x33: # XSECT
+                label, pos = read_label(buf, pos, label)
+                if byte & 0x02:
+                    lrud = lrud_struct.unpack_from(buf, pos)
+                    pos += 16
+                else:
+                    lrud = lrud_short_struct.unpack_from(buf, pos)
+                    pos += 8
+                yield Xsect(label, lrud, date1, date2, byte & 0x01)
+
+            elif byte <= 0x3f: # Reserved
+                continue
+
+            elif byte <= 0x7f: # LINE
+                flag = byte & 0x3f
+                if not (flag & 0x20):
+                    label, pos = read_label(buf, pos, label)
+                xyz_from, xyz = xyz, unpack_xyz(buf, pos)
+                pos += 12
+                yield Line(xyz_from, xyz, label, style, date1, date2, flag)
+
+            else: # LABEL (or NODE)
+                label, pos = read_label(buf, pos, label)
+                xyz = unpack_xyz(buf, pos)
+                pos += 12
+                yield Node(xyz, label, byte & 0x7f)
+
+def find_3d_files(paths):
+    """Generate the .3d files in a list of files and directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if name.lower().endswith('.3d'):
+                        yield os.path.join(dirpath, name)
+        else:
+            yield path
+
+def source_names(paths):
+    """Return a name for each of a list of .3d files, unique among them
+
+    The names are the paths relative to the deepest directory they
+    are all in, so files with the same name in different directories
+    (as found by find_3d_files) can be told apart.  A single file is
+    named by its file name.
+    """
+    dirs = [os.path.dirname(os.path.abspath(path)) + os.sep for path in paths]
+    root = os.path.commonprefix(dirs)
+    root = root[:root.rfind(os.sep) + 1] # back to a whole directory
+    return [os.path.abspath(path)[len(root):] for path in paths]
+
+# Summary of a .3d file from scan_3d().  Dates are the earliest and
+# latest days since 1900.01.01 (None if there are no dates), and bbox
+# is ((xmin, ymin, zmin), (xmax, ymax, zmax)) in metres over all the
+# positions in the file (None if there are none).
+
+Summary = namedtuple('Summary', 'title cs timestamp version extended legs splay_legs '
+                     'surface_legs duplicate_legs stations entrances xsects date1 date2 bbox')
+
+def scan_3d(path):
+    """Scan a .3d file for a Summary, without decoding the labels or legs
+
+    This is much quicker than a full decode, as labels are skipped
+    over, and the positions are only gathered up to find the bounds.
+    Extended elevations are not rejected, but flagged in the summary.
+    """
+    with open_3d(path) as (header, buf), paused_gc():
+
+        line_flags = array('i', [0]) * 0x40 # counts of each LINE flag
+        node_flags = array('i', [0]) * 0x80 # ditto NODE
+        nxsects = 0
+        dates = set()
+        coords = bytearray()
+
+        style = 0xff
+        pos = header.offset
+
+        while True:
+
+            try:
+                byte = buf[pos]
+            except IndexError: # End of file (reached prematurely?)
+                raise IOError('Premature end of file in ' + path)
+
+            pos += 1
+
+            if byte >= 0x40: # LINE or NODE, skip over the label
+                if byte & 0x80 or not byte & 0x20:
+                    n = buf[pos]
+                    if n:
+                        pos += 1 + (n & 0x0f)
+                    else:
+                        pos = read_long_label(buf, pos + 1, '')[1]
+                coords += buf[pos:pos + 12]
+                pos += 12
+                if byte & 0x80:
+                    node_flags[byte & 0x7f] += 1
+                else:
+                    line_flags[byte & 0x3f] += 1
+
+            elif byte <= 0x05: # STYLE
+                if byte == 0x00 and style == 0x00: # this signals end of data
+                    break
+                style = byte
+
+            elif byte == 0x0f: # MOVE
+                coords += buf[pos:pos + 12]
+                pos += 12
+
+            elif byte == 0x11: # DATE (single date)
+                dates.add(date_struct.unpack_from(buf, pos)[0])
+                pos += 2
+
+            elif byte == 0x12:  # DATE (date range, short format)
+                days, extra = date_range_struct.unpack_from(buf, pos)
+                dates.update((days, days + extra + 1))
+                pos += 3
+
+            elif byte == 0x13: # DATE (date range, long format)
+                dates.update(date_long_struct.unpack_from(buf, pos))
+                pos += 4
+
+            elif byte == 0x1f:  # Error info
+                pos += 20
+
+            elif 0x30 <= byte <= 0x33: # XSECT
+                pos = read_label(buf, pos, '')[1] + (16 if byte & 0x02 else 8)
+                nxsects += 1
+
+            # Anything else is reserved, or DATE (none), and skipped
+
+    def count(flags, bit):
+        return sum(n for flag, n in enumerate(flags) if flag & bit)
+
+    if coords:
+        xyz = np.frombuffer(coords, dtype='<i4').reshape(-1, 3)
+        bbox = (tuple((0.01 * xyz.min(axis=0)).tolist()), tuple((0.01 * xyz.max(axis=0)).tolist()))
+    else:
+        bbox = None
+
+    return Summary(header.title, header.cs, header.timestamp, header.version,
+                   bool(header.flag & 0x80), sum(line_flags), count(line_flags, 0x04),
+                   count(line_flags, 0x01), count(line_flags, 0x02), sum(node_flags),
+                   count(node_flags, 0x04), nxsects,
+                   min(dates) if dates else None, max(dates) if dates else None, bbox)
+
+# The decoded data are held in structured arrays whose records are
+# built directly from the bytes in the file, so that coordinates are
+# int32 in cm and dates are int32 days since 1900.01.01.  Labels are
+# stored once, and referred to by an integer id.
+
+leg_dtype = np.dtype({'names': ['xyz', 'label', 'date1', 'date2', 'style', 'flag'],
+                      'formats': [('<i4', (2, 3)), '<i4', '<i4', '<i4', 'u1', 'u1'],
+                      'offsets': [0, 24, 28, 32, 36, 37], 'itemsize': 40})
+
+station_dtype = np.dtype({'names': ['xyz', 'label', 'flag'],
+                          'formats': [('<i4', 3), '<i4', 'u1'],
+                          'offsets': [0, 12, 16], 'itemsize': 20})
+
+xsect_dtype = np.dtype([('label', '<i4'), ('lrud', '<i4', 4)])
+
+traverse_dtype = np.dtype({'names': ['start', 'stop', 'nlehv', 'has_nlehv'],
+                           'formats': ['<i4', '<i4', ('<i4', 5), 'u1'],
+                           'offsets': [0, 4, 8, 28], 'itemsize': 32})
+
+run_dtype = np.dtype([('start', '<i4'), ('stop', '<i4')])
+
+xyz_dtype = np.dtype([('x', '<i4'), ('y', '<i4'), ('z', '<i4')]) # to sort and search positions
+
+leg_tail_struct = Struct('<iiiBB2x') # label, date1, date2, style, flag
+station_tail_struct = Struct('<iB3x') # label, flag
+xsect_struct = Struct('<iiiii') # label, lrud
+traverse_struct = Struct('<ii') # start, stop
+run_struct = Struct('<ii') # start, stop
+
+no_nlehv = b'\x00' * 24 # zero nlehv, has_nlehv, and padding
+
+class LabelTable:
+    """Labels compressed by survey prefix
+
+    Each label is split after the last separator into a survey prefix
+    and a leaf (station name), each of which is stored only once, so
+    that 'DowProv.dgp.dgp7.23' is held as the pair of ids for
+    'DowProv.dgp.dgp7.' and '23'.  Labels are referred to by integer
+    ids, and full names are only put together when asked for.
+    """
+
+    def __init__(self, prefixes=(), leaves=(), prefix_id=None, leaf_id=None):
+        self.prefixes = list(prefixes)
+        self.leaves = list(leaves)
+        self.prefix_id = np.zeros(0, dtype=np.int32) if prefix_id is None else prefix_id
+        self.leaf_id = np.zeros(0, dtype=np.int32) if leaf_id is None else leaf_id
+
+    def __len__(self):
+        return len(self.prefix_id)
+
+    def __getitem__(self, i):
+        return self.prefixes[self.prefix_id[i]] + self.leaves[self.leaf_id[i]]
+
+    def names(self, ids):
+        """Return the full names for an array of label ids, as a list"""
+        prefixes, leaves = self.prefixes, self.leaves
+        return [prefixes[i] + leaves[j] for i, j in zip(self.prefix_id[ids].tolist(),
+                                                        self.leaf_id[ids].tolist())]
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the table"""
+        strings = sum(len(s) + 50 for s in self.prefixes) + sum(len(s) + 50 for s in self.leaves)
+        return self.prefix_id.nbytes + self.leaf_id.nbytes + strings
+
+class Region:
+    """A region of interest, as a bounding box and/or a polygon
+
+    The bounding box is (xmin, ymin, xmax, ymax), and the polygon a
+    list of rings of (x, y) points, in metres.  Points are inside the
+    polygon by the even-odd rule, so that rings can be holes or parts
+    of a multipolygon.  The box in cm (the intersection of the two)
+    is used for a quick test on the integer xyz while decoding.
+    """
+
+    def __init__(self, bbox=None, polygon=None):
+        self.rings = None if polygon is None else [100.0 * np.asarray(ring, dtype=float)[:, :2]
+                                                   for ring in polygon]
+        lo, hi = np.array([-np.inf, -np.inf]), np.array([np.inf, np.inf])
+        if bbox is not None:
+            lo = np.maximum(lo, 100.0 * np.asarray(bbox[:2], dtype=float))
+            hi = np.minimum(hi, 100.0 * np.asarray(bbox[2:], dtype=float))
+        if self.rings:
+            points = np.vstack(self.rings)
+            lo, hi = np.maximum(lo, points.min(axis=0)), np.minimum(hi, points.max(axis=0))
+        self.clip_to_box = bbox is not None and polygon is None
+        self.lo, self.hi = lo, hi
+        limit = 1 << 31 # beyond any int32 coordinate
+        self.bbox = (int(max(np.floor(lo[0]), -limit)), int(max(np.floor(lo[1]), -limit)),
+                     int(min(np.ceil(hi[0]), limit)), int(min(np.ceil(hi[1]), limit)))
+
+    def contains(self, xy):
+        """Return a mask of the points (rows of xy, in cm) inside the region"""
+        x, y = xy[:, 0], xy[:, 1]
+        inside = (x >= self.lo[0]) & (x <= self.hi[0]) & (y >= self.lo[1]) & (y <= self.hi[1])
+        if self.rings:
+            crossings = np.zeros(len(xy), dtype=bool)
+            for ring in self.rings:
+                for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+                    if y1 == y2:
+                        continue
+                    with np.errstate(invalid='ignore'):
+                        crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+                    crossings ^= crosses
+            inside &= crossings
+        return inside
+
+    def box_params(self, p, q):
+        """Return the parameters (t0, t1) along segments p-q within the box, and a mask of those meeting it"""
+        d = q - p
+        t0, t1 = np.zeros(len(p)), np.ones(len(p))
+        meets = np.ones(len(p), dtype=bool)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for axis in (0, 1):
+                for dk, gap in ((-d[:, axis], p[:, axis] - self.lo[axis]),
+                                (d[:, axis], self.hi[axis] - p[:, axis])):
+                    r = gap / dk
+                    meets &= (dk != 0) | (gap >= 0)
+                    t0 = np.where(dk < 0, np.maximum(t0, r), t0)
+                    t1 = np.where(dk > 0, np.minimum(t1, r), t1)
+        return t0, t1, meets & (t0 <= t1)
+
+    def meets(self, p, q):
+        """Return a mask of the segments p-q (rows, in cm) which meet the region"""
+        meets = self.box_params(p, q)[2]
+        if self.rings:
+            inside = self.contains(p) | self.contains(q)
+            crosses = np.zeros(len(p), dtype=bool)
+            def side(a, b, c): # sign of the turn a, b, c
+                return np.sign((b[..., 0] - a[..., 0]) * (c[..., 1] - a[..., 1])
+                               - (b[..., 1] - a[..., 1]) * (c[..., 0] - a[..., 0]))
+            for ring in self.rings:
+                for a, b in zip(ring, np.roll(ring, -1, axis=0)):
+                    crosses |= ((side(p, q, a) != side(p, q, b)) & (side(a, b, p) != side(a, b, q)))
+            meets &= inside | crosses
+        return meets
+
+    def clip(self, xyz):
+        """Clip legs (xyz from and to, in cm) to the box, returning the new xyz"""
+        p, q = xyz[:, 0].astype(float), xyz[:, 1].astype(float)
+        t0, t1 = self.box_params(p[:, :2], q[:, :2])[:2]
+        t0, t1 = np.maximum(t0, 0), np.minimum(t1, 1)
+        result = xyz.copy()
+        cut = t0 > 0
+        result[cut, 0] = np.rint(p[cut] + t0[cut, np.newaxis] * (q[cut] - p[cut]))
+        cut = t1 < 1
+        result[cut, 1] = np.rint(p[cut] + t1[cut, np.newaxis] * (q[cut] - p[cut]))
+        return result
+
+class Survex3D:
+    """Legs, stations and cross sections decoded from a .3d file
+
+    legs, stations and xsects are structured arrays with the dtypes
+    above; traverses are the runs of legs between MOVEs, with the
+    error info (if any) current at the end of each; xsect_runs are
+    the runs of xsects ending with an XSECT_END; and labels is the
+    LabelTable for the label ids.  Excluded legs and stations are
+    dropped, but entrance_z is the height (cm) of the highest entrance
+    in the whole file, or None if there are none, whatever is excluded.
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.labels = LabelTable()
+        self.legs = np.zeros(0, dtype=leg_dtype)
+        self.stations = np.zeros(0, dtype=station_dtype)
+        self.xsects = np.zeros(0, dtype=xsect_dtype)
+        self.traverses = np.zeros(0, dtype=traverse_dtype)
+        self.xsect_runs = np.zeros(0, dtype=run_dtype)
+        self.label_xyz = np.zeros((0, 3), dtype=np.int32)
+        self.entrance_z = None
+
+    @property
+    def has_error_info(self):
+        """True if any traverse carries error info"""
+        return bool(self.traverses['has_nlehv'].any())
+
+    @property
+    def nbytes(self):
+        """Memory held by the arrays and the label table"""
+        return self.labels.nbytes + sum(a.nbytes for a in (self.legs, self.stations, self.xsects,
+                                                           self.traverses, self.xsect_runs,
+                                                           self.label_xyz))
+
+    def select(self, exclude_surface_legs=False, exclude_duplicate_legs=False,
+               exclude_splay_legs=False, exclude_surface_stations=False,
+               include_surveys=(), exclude_surveys=(), dates=None, styles=None,
+               bbox=None, polygon=None):
+        """Return a copy with legs, stations and xsects selected as in decode_3d()
+
+        Traverses and xsect runs left empty are dropped, so the result
+        is the same as decoding with this selection in the first place.
+        """
+        result = Survex3D(self.header)
+        result.labels = self.labels
+        result.entrance_z = self.entrance_z
+
+        accept_label = survey_filter(include_surveys, exclude_surveys)
+        if accept_label is None:
+            label_ok = np.ones(len(self.labels), dtype=bool)
+        else:
+            label_ok = np.array([accept_label(name) for name
+                                 in self.labels.names(np.arange(len(self.labels)))], dtype=bool)
+
+        mask = leg_mask(exclude_surface_legs, exclude_duplicate_legs, exclude_splay_legs)
+        legs = self.legs
+        keep = ((legs['flag'] & mask) == 0) & label_ok[legs['label']]
+        if styles is not None:
+            style_ok = np.zeros(0x100, dtype=bool)
+            style_ok[list(styles)] = True
+            keep &= style_ok[legs['style']]
+        if dates is not None:
+            keep &= (legs['date2'] >= dates[0]) & (legs['date1'] <= dates[1])
+        result.legs = legs[keep]
+        result.traverses = recount(self.traverses, keep)
+
+        flag = self.stations['flag']
+        keep = label_ok[self.stations['label']]
+        if exclude_surface_stations: # surface but not also underground
+            keep &= ~((flag & 0x01 != 0) & (flag & 0x02 == 0))
+        result.stations = self.stations if keep.all() else self.stations[keep]
+
+        keep = label_ok[self.xsects['label']]
+        result.xsects = self.xsects if keep.all() else self.xsects[keep]
+        result.xsect_runs = recount(self.xsect_runs, keep)
+
+        if label_ok.all():
+            result.label_xyz = self.label_xyz
+        else: # positions are not kept for rejected labels
+            result.label_xyz = np.where(label_ok[:, np.newaxis], self.label_xyz, 0).astype(np.int32)
+
+        if bbox is not None or polygon is not None:
+            result = result.within(Region(bbox, polygon))
+
+        return result
+
+    def leg_runs(self):
+        """Return the runs of consecutive legs which can be merged into polylines
+
+        A run is broken at the start of each traverse, where a leg does
+        not start where the previous one finished, and where the survey,
+        style, flags or dates change, so that all the legs in a run
+        share the same attributes, including the error info.
+        """
+        legs = self.legs
+        brk = np.ones(len(legs), dtype=bool) # break before each leg
+        if len(legs):
+            brk[1:] = (legs['xyz'][1:, 0] != legs['xyz'][:-1, 1]).any(axis=1)
+            for name in ('label', 'style', 'flag', 'date1', 'date2'):
+                brk[1:] |= legs[name][1:] != legs[name][:-1]
+            brk[self.traverses['start']] = True
+        result = np.zeros(np.count_nonzero(brk), dtype=run_dtype)
+        result['start'] = np.flatnonzero(brk)
+        result['stop'][:-1] = result['start'][1:]
+        result['stop'][-1:] = len(legs)
+        return result
+
+    def stations_at(self, xyz):
+        """Return the label ids of the stations at positions (rows of xyz), or -1 for none
+
+        Where there are several, as for equated stations, the first is given.
+        """
+        def as_keys(a):
+            return np.ascontiguousarray(a, dtype=np.int32).view(xyz_dtype).ravel()
+        if not len(self.stations):
+            return np.full(len(xyz), -1, dtype=np.int32)
+        keys = as_keys(self.stations['xyz'])
+        order = np.argsort(keys, kind='mergesort') # stable, so the first is found
+        keys = keys[order]
+        wanted = as_keys(xyz)
+        i = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        return np.where(keys[i] == wanted, self.stations['label'][order][i], -1).astype(np.int32)
+
+    def within(self, region):
+        """Return a copy restricted to a Region
+
+        Stations are kept if inside it, legs if they meet it, and xsect
+        runs if any station or segment of the run meets it.  Legs are
+        clipped if the region is just a bounding box.
+        """
+        result = Survex3D(self.header)
+        result.labels = self.labels
+        result.label_xyz = self.label_xyz
+        result.entrance_z = self.entrance_z
+
+        result.stations = self.stations[region.contains(self.stations['xyz'][:, :2])]
+
+        xy = self.legs['xyz'][:, :, :2].astype(float)
+        keep = region.meets(xy[:, 0], xy[:, 1])
+        result.legs = self.legs[keep]
+        if region.clip_to_box:
+            result.legs['xyz'] = region.clip(result.legs['xyz'])
+        result.traverses = recount(self.traverses, keep)
+
+        xy = self.label_xyz[self.xsects['label']][:, :2].astype(float)
+        meets = region.contains(xy)
+        meets[:-1] |= region.meets(xy[:-1], xy[1:]) # segments between xsects ..
+        meets[self.xsect_runs['stop'] - 1] = region.contains(xy[self.xsect_runs['stop'] - 1]) # .. in a run
+        which = np.repeat(np.arange(len(self.xsect_runs)),
+                          self.xsect_runs['stop'] - self.xsect_runs['start'])
+        runs = np.bincount(which[meets], minlength=len(self.xsect_runs)) > 0 # runs meeting region
+        keep = runs[which]
+        result.xsects = self.xsects[keep]
+        result.xsect_runs = recount(self.xsect_runs, keep)
+
+        return result
+
+    def save(self, path):
+        """Save to an uncompressed .npz file, which can be read back by load()"""
+        header = self.header
+        np.savez(path, title=np.array(header.title), cs=np.array(header.cs),
+                 header=np.array(header[2:], dtype=np.int64),
+                 prefixes=np.array(self.labels.prefixes, dtype=np.str_),
+                 leaves=np.array(self.labels.leaves, dtype=np.str_),
+                 prefix_id=self.labels.prefix_id, leaf_id=self.labels.leaf_id,
+                 legs=self.legs, stations=self.stations, xsects=self.xsects,
+                 traverses=self.traverses, xsect_runs=self.xsect_runs,
+                 label_xyz=self.label_xyz,
+                 entrance_z=np.array([] if self.entrance_z is None else [self.entrance_z], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """Load from a .npz file written by save()"""
+        with np.load(path, allow_pickle=False) as data:
+            header = Header(data['title'].item(), data['cs'].item(),
+                            *[int(v) for v in data['header']])
+            result = cls(header)
+            result.labels = LabelTable(data['prefixes'].tolist(), data['leaves'].tolist(),
+                                       data['prefix_id'], data['leaf_id'])
+            for name in ('legs', 'stations', 'xsects', 'traverses', 'xsect_runs', 'label_xyz'):
+                setattr(result, name, data[name])
+            result.entrance_z = int(data['entrance_z'][0]) if len(data['entrance_z']) else None
+        return result
+
+def leg_mask(exclude_surface_legs, exclude_duplicate_legs, exclude_splay_legs):
+    """Fold the leg exclusions into a single mask of leg flags"""
+    return ((0x01 if exclude_surface_legs else 0) |
+            (0x02 if exclude_duplicate_legs else 0) |
+            (0x04 if exclude_splay_legs else 0))
+
+def survey_filter(include_surveys=(), exclude_surveys=()):
+    """Return a function which accepts or rejects a label, or None to accept all
+
+    A label is in a survey if it is the survey name, or starts with
+    it followed by a separator.  It is accepted if it is in one of
+    the included surveys (or there are none), and in none of the
+    excluded surveys.
+    """
+    if not include_surveys and not exclude_surveys:
+        return None
+    include = tuple(s + '.' for s in include_surveys), set(include_surveys)
+    exclude = tuple(s + '.' for s in exclude_surveys), set(exclude_surveys)
+    def accept_label(label):
+        if include[1] and not (label.startswith(include[0]) or label in include[1]):
+            return False
+        return not (label.startswith(exclude[0]) or label in exclude[1])
+    return accept_label
+
+# Leg styles by name, for the style filter (0xff is before any STYLE record)
+
+style_codes = {'NORMAL': 0x00, 'DIVING': 0x01, 'CARTESIAN': 0x02, 'CYLPOLAR': 0x03,
+               'NOSURVEY': 0x04, 'NOSTYLE': 0xff}
+
+day_zero = date(1900, 1, 1).toordinal()
+
+def parse_day(s, last=False):
+    """Parse a date as yyyy, yyyy.mm or yyyy.mm.dd, returning days since 1900.01.01
+
+    A year or month is taken as its first day, or its last if last is set.
+    """
+    try:
+        parts = [int(v) for v in s.split('.')]
+        if len(parts) == 3:
+            return date(*parts).toordinal() - day_zero
+        if len(parts) > 3:
+            raise ValueError
+        year, month = parts[0], parts[1] if len(parts) == 2 else (12 if last else 1)
+        if not last:
+            return date(year, month, 1).toordinal() - day_zero
+        following = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+        return following.toordinal() - 1 - day_zero
+    except ValueError:
+        raise ValueError('Date should be yyyy, yyyy.mm or yyyy.mm.dd: ' + s)
+
+def parse_dates(text):
+    """Parse a window of dates as 'first last', or a single date, for decode_3d()
+
+    Returns (first, last) in days since 1900.01.01, or None if the
+    text is blank.  Dates are as for parse_day(), so '1990 1999'
+    covers the whole of the 1990s and '2010.06' the whole month.
+    """
+    words = text.replace(',', ' ').replace(' - ', ' ').split()
+    if not words:
+        return None
+    if len(words) > 2:
+        raise ValueError('Dates should be first last, as yyyy.mm.dd: ' + text)
+    first, last = parse_day(words[0]), parse_day(words[-1], last=True)
+    if first > last:
+        raise ValueError('Dates are the wrong way round: ' + text)
+    return first, last
+
+def parse_styles(text):
+    """Parse a list of leg styles by name, returning the set of codes for decode_3d()
+
+    As for the surveys, names prefixed with - are excluded, and if
+    only exclusions are given every other style is kept.  Returns
+    None if the text is blank.
+    """
+    names = text.replace(',', ' ').upper().split()
+    if not names:
+        return None
+    for name in names:
+        if name.lstrip('-') not in style_codes:
+            raise ValueError('Unknown leg style %s, should be one of %s'
+                             % (name, ', '.join(sorted(style_codes))))
+    include = [style_codes[name] for name in names if not name.startswith('-')]
+    exclude = [style_codes[name[1:]] for name in names if name.startswith('-')]
+    return set(include or style_codes.values()) - set(exclude)
+
+def recount(runs, keep):
+    """Renumber traverses or xsect runs after dropping items, dropping any left empty"""
+    which = np.repeat(np.arange(len(runs)), runs['stop'] - runs['start']) # run for each item
+    counts = np.bincount(which[keep], minlength=len(runs))
+    result = runs[counts > 0].copy()
+    result['stop'] = np.cumsum(counts[counts > 0])
+    result['start'] = result['stop'] - counts[counts > 0]
+    return result
+
+def as_array(data, dtype):
+    """Wrap accumulated bytes, or an array.array, as a NumPy array without copying"""
+    return np.frombuffer(data, dtype=dtype) if data else np.zeros(0, dtype=dtype)
+
+# The state carried from one record to the next, as a checkpoint from
+# which decoding can be resumed at offset pos.  Dates are as in the
+# file (0 for none), xyz and nlehv are packed bytes, has_label is
+# False until the first label is seen, and legs and xsects count
+# those in the traverse and xsect run still open at this point.
+
+Checkpoint = namedtuple('Checkpoint', 'pos label has_label style date1 date2 xyz nlehv legs xsects')
+
+# Packed records and labels decoded from a range of the file.  The
+# starts of traverses and xsect runs are relative to the first leg
+# and xsect in the range, so are negative for any carried over from
+# before it, and xstart is the start of the xsect run left open.
+# entrance_z is the height of the highest entrance in the range,
+# filtered or not, or None if there are none.
+
+Chunk = namedtuple('Chunk', 'legs stations xsects traverses xsect_runs xstart entrance_z '
+                   'prefixes leaves prefix_id leaf_id checkpoints')
+
+PROGRESS_SPACING = 1 << 18 # bytes between progress reports
+
+def start_of_data(header):
+    """Return the Checkpoint for the first record in a .3d file"""
+    return Checkpoint(header.offset, '', False, 0xff, 0, 0, b'\x00' * 12, no_nlehv, 0, 0)
+
+def decode_3d(path, exclude_surface_legs=False, exclude_duplicate_legs=False,
+              exclude_splay_legs=False, exclude_surface_stations=False,
+              include_surveys=(), exclude_surveys=(), dates=None, styles=None,
+              bbox=None, polygon=None, progress=None):
+    """Decode a .3d file in a single pass, returning a Survex3D object
+
+    Besides the exclusions by flag, legs, stations and xsects can be
+    restricted to (or excluded from) surveys, given by name, and legs
+    to a window of dates (first and last day, since 1900.01.01), and
+    a collection of styles.  Legs overlapping the window are kept,
+    and undated legs are dropped.  These are all applied as the file
+    is decoded, so records which are rejected are never stored.
+
+    Finally, the import can be restricted to a bounding box and/or a
+    polygon, as for Region.  Records clear of the bounding box of the
+    region are dropped while decoding, and the rest are then selected
+    as in Survex3D.within().
+
+    If given, progress is called every so often with the number of
+    bytes read and the size of the file.  It may raise an exception
+    to abandon the decode.
+    """
+
+    region = None if bbox is None and polygon is None else Region(bbox, polygon)
+
+    with open_3d(path) as (header, buf), paused_gc():
+
+        if header.flag & 0x80: # abort if extended elevation
+            raise IOError("Can't deal with extended elevation in " + path)
+
+        mask = leg_mask(exclude_surface_legs, exclude_duplicate_legs, exclude_splay_legs)
+        chunk = decode_range(buf, path, start_of_data(header), len(buf) + 1,
+                             mask, exclude_surface_stations,
+                             accept_label=survey_filter(include_surveys, exclude_surveys),
+                             dates=dates, styles=styles, region=region, progress=progress)
+
+    result = assemble(header, chunk)
+
+    return result if region is None else result.within(region)
+
+def decode_range(buf, path, start, stop, mask=0, exclude_surface_stations=False, spacing=0,
+                 accept_label=None, dates=None, styles=None, region=None, progress=None):
+    """Decode from a Checkpoint up to offset stop, or the end of data, returning a Chunk
+
+    If spacing is given, a checkpoint is taken at the first record
+    after every spacing bytes.  The counts of open legs in these only
+    make sense for an unfiltered decode, with mask zero.  The filters
+    are as in decode_3d(), with accept_label from survey_filter(),
+    and only the bounding box of the region is tested.  Progress is
+    reported as for decode_3d(), at the checkpoints if there are any.
+    """
+
+    # The records are accumulated as packed bytes, and only
+    # turned into arrays at the end
+
+    legs = bytearray()
+    stations = bytearray()
+    xsects = bytearray()
+    traverses = bytearray()
+    xsect_runs = bytearray()
+    checkpoints = []
+
+    # Labels are given ids as they are first seen.  The prefix
+    # only needs to be looked up when it may have changed, which
+    # is when characters before the last separator are deleted,
+    # or a separator is added.  Otherwise the leaf is looked up
+    # in the (small) table for the current prefix.
+
+    prefixes, leaves = [], []
+    prefix_ids, leaf_index = {}, {}
+    prefix_id, leaf_id = array('i'), array('i')
+    leaf_tables = [] # one per prefix, mapping leaf to label id
+    label_ok = bytearray() # one per label id, set if accepted by the survey filter
+
+    def prefix_of(label):
+        """Return (prefix length, leaf table) for the survey prefix of a label"""
+        plen = label.rfind('.') + 1
+        prefix = label[:plen]
+        k = prefix_ids.get(prefix)
+        if k is None:
+            k = prefix_ids[prefix] = len(prefixes)
+            prefixes.append(prefix)
+            leaf_tables.append({})
+        return plen, k, leaf_tables[k]
+
+    def new_label(k, leaf_ids, leaf):
+        """Add a label with prefix id k and given leaf, returning the label id"""
+        j = leaf_index.get(leaf)
+        if j is None:
+            j = leaf_index[leaf] = len(leaves)
+            leaves.append(leaf)
+        lid = leaf_ids[leaves[j]] = len(prefix_id)
+        prefix_id.append(k)
+        leaf_id.append(j)
+        label_ok.append(accept_label is None or accept_label(prefixes[k] + leaf))
+        return lid
+
+    plen, k, leaf_ids = prefix_of('')
+
+    leg_tail = leg_tail_struct.pack
+    station_tail = station_tail_struct.pack
+
+    # Filtering by survey, date or style is folded into lookups by
+    # label id and style, and a test on the dates which always passes
+    # when there is no window.
+
+    filtering = (accept_label is not None or dates is not None or styles is not None
+                 or region is not None)
+    style_ok = bytearray(styles is None or style in styles for style in range(0x100))
+    date_lo, date_hi = (0, 0xffffffff) if dates is None else dates
+
+    # The region test is on the x, y coordinates, which are only
+    # unpacked if there is a region.  Legs are rejected if they lie
+    # wholly to one side of the box, which keeps all that meet it.
+
+    if region is not None:
+        xmin, ymin, xmax, ymax = region.bbox
+        unpack_xy = xy_struct.unpack_from
+        x, y = unpack_xy(start.xyz, 0)
+
+    pos, label, has_label, style, days1, days2, xyz, nlehv = start[:8]
+
+    lid = -1 # id of current label
+    if has_label:
+        plen, k, leaf_ids = prefix_of(label)
+        lid = new_label(k, leaf_ids, label[plen:])
+
+    nlegs = nxsects = 0 # number of legs and xsects
+    nstart, xstart = -start.legs, -start.xsects # at start of open traverse and xsect run
+    entrance_z = None # height of highest entrance
+
+    step = spacing or (PROGRESS_SPACING if progress else 0)
+    mark = min(pos + step, stop) if step else stop # offset of next checkpoint or progress report
+
+    # This is the same loop as iter_3d_records() with the label
+    # reading inlined, since it is executed for nearly every
+    # record.  Note that all elements must be processed, in
+    # order, otherwise we get out of sync.
+
+    while True: # start of byte-gobbling while loop
+
+        if pos >= mark:
+            if pos >= stop:
+                break
+            if spacing:
+                checkpoints.append(Checkpoint(pos, label, lid >= 0, style, days1, days2, bytes(xyz),
+                                              nlehv, nlegs - nstart, nxsects - xstart))
+            if progress:
+                progress(pos, len(buf))
+            mark = min(pos + step, stop)
+
+        try:
+            byte = buf[pos]
+        except IndexError: # End of file (reached prematurely?)
+            raise IOError('Premature end of file in ' + path)
+
+        pos += 1
+
+        if byte >= 0x40: # LINE or NODE, read the label first
+
+            if byte & 0x80 or not byte & 0x20:
+                n = buf[pos]
+                if n:
+                    nadd = n & 0x0f
+                    keep = len(label) - (n >> 4)
+                    pos += 1
+                    added = buf[pos:pos + nadd].decode('ascii')
+                    label = label[:keep] + added
+                    pos += nadd
+                    if keep < plen or '.' in added:
+                        plen, k, leaf_ids = prefix_of(label)
+                else:
+                    label, pos = read_long_label(buf, pos + 1, label)
+                    plen, k, leaf_ids = prefix_of(label)
+                leaf = label[plen:]
+                lid = leaf_ids.get(leaf)
+                if lid is None:
+                    lid = new_label(k, leaf_ids, leaf)
+
+            xyz_prev = xyz
+            xyz = buf[pos:pos + 12]
+            if region is not None:
+                x_prev, y_prev = x, y
+                x, y = unpack_xy(buf, pos)
+            pos += 12
+
+            if byte & 0x80: # LABEL (or NODE)
+                if byte & 0x04: # ENTRANCE, the reference for depths whether kept or not
+                    z = z_struct.unpack_from(buf, pos - 4)[0]
+                    if entrance_z is None or z > entrance_z:
+                        entrance_z = z
+                if not filtering or label_ok[lid]:
+                    flag = byte & 0x7f
+                    if exclude_surface_stations and flag & 0x01 and not flag & 0x02:
+                        flag = 0x80 # excluded, but keep the position for label_xyz
+                    if region is not None and not (xmin <= x <= xmax and ymin <= y <= ymax):
+                        flag = 0x80 # ditto, outside the region
+                    stations += xyz
+                    stations += station_tail(lid, flag)
+
+            else: # LINE
+                flag = byte & 0x3f
+                if not flag & mask and (not filtering or label_ok[lid] and style_ok[style]
+                                        and days2 >= date_lo and days1 <= date_hi
+                                        and (region is None or
+                                             not (x < xmin and x_prev < xmin or
+                                                  x > xmax and x_prev > xmax or
+                                                  y < ymin and y_prev < ymin or
+                                                  y > ymax and y_prev > ymax))):
+                    legs += xyz_prev
+                    legs += xyz
+                    legs += leg_tail(lid, days1, days2, style, flag)
+                    nlegs += 1
+
+        elif byte <= 0x05: # STYLE
+            if byte == 0x00 and style == 0x00: # this signals end of data
+                if nlegs > nstart: # there may be a pending traverse to save
+                    traverses += traverse_struct.pack(nstart, nlegs) + nlehv
+                    nstart = nlegs
+                break # escape from byte-gobbling while loop
+            else:
+                style = byte
+
+        elif byte == 0x0f: # MOVE
+            xyz = buf[pos:pos + 12]
+            if region is not None:
+                x, y = unpack_xy(buf, pos)
+            pos += 12
+            if nlegs > nstart:
+                traverses += traverse_struct.pack(nstart, nlegs) + nlehv
+                nstart = nlegs
+
+        elif byte == 0x10: # DATE (none)
+            days1 = days2 = 0
+
+        elif byte == 0x11: # DATE (single date)
+            days1 = days2 = date_struct.unpack_from(buf, pos)[0]
+            pos += 2
+
+        elif byte == 0x12:  # DATE (date range, short format)
+            days1, extra = date_range_struct.unpack_from(buf, pos)
+            days2 = days1 + extra + 1
+            pos += 3
+
+        elif byte == 0x13: # DATE (date range, long format)
+            days1, days2 = date_long_struct.unpack_from(buf, pos)
+            pos += 4
+
+        elif byte == 0x1f:  # Error info
+            nlehv = bytes(buf[pos:pos + 20]) + b'\x01\x00\x00\x00'
+            pos += 20
+
+        elif 0x30 <= byte <= 0x33: # XSECT
+            label, pos = read_label(buf, pos, label)
+            plen, k, leaf_ids = prefix_of(label)
+            leaf = label[plen:]
+            lid = leaf_ids.get(leaf)
+            if lid is None:
+                lid = new_label(k, leaf_ids, leaf)
+            if not filtering or label_ok[lid]:
+                if byte & 0x02:
+                    lrud = lrud_struct.unpack_from(buf, pos)
+                else:
+                    lrud = lrud_short_struct.unpack_from(buf, pos)
+                xsects += xsect_struct.pack(lid, *lrud)
+                nxsects += 1
+            pos += 16 if byte & 0x02 else 8
+            if byte & 0x01 and nxsects > xstart: # XSECT_END, with a run to save
+                xsect_runs += run_struct.pack(xstart, nxsects)
+                xstart = nxsects
+
+        # Anything else is reserved, and skipped
+
+    # End of byte-gobbling while loop
+
+    return Chunk(legs, stations, xsects, traverses, xsect_runs, xstart, entrance_z,
+                 prefixes, leaves, prefix_id, leaf_id, checkpoints)
+
+def assemble(header, chunk):
+    """Turn a Chunk covering the whole file into a Survex3D object"""
+
+    result = Survex3D(header)
+
+    # Station positions are looked up by label id, using the last
+    # NODE seen for each label, before excluded stations are dropped
+
+    stations = as_array(chunk.stations, station_dtype)
+    last = len(stations) - 1 - np.unique(stations['label'][::-1], return_index=True)[1]
+    result.labels = LabelTable(chunk.prefixes, chunk.leaves, as_array(chunk.prefix_id, np.int32),
+                               as_array(chunk.leaf_id, np.int32))
+
+    result.label_xyz = np.zeros((len(chunk.prefix_id), 3), dtype=np.int32)
+    result.label_xyz[stations['label'][last]] = stations['xyz'][last]
+
+    result.stations = stations[stations['flag'] != 0x80]
+    result.legs = as_array(chunk.legs, leg_dtype)
+    result.xsects = as_array(chunk.xsects, xsect_dtype)[:chunk.xstart] # drop unterminated run
+    result.traverses = as_array(chunk.traverses, traverse_dtype)
+    result.xsect_runs = as_array(chunk.xsect_runs, run_dtype)
+    result.entrance_z = chunk.entrance_z
+
+    return result
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Persistent on-disk cache of decoded survex .3d files, so that
+re-importing an unchanged file skips the decode entirely.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from survex3d import Survex3D, decode_3d
+from survex3d_files import replace
+
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+# Bump this when the layout of the decoded arrays changes, so that
+# stale entries are never loaded (they are evicted in due course).
+
+CACHE_VERSION = 2
+
+# A truncated or otherwise corrupt .npz (zipfile.BadZipfile in Python 2)
+
+BadZipFile = getattr(zipfile, 'BadZipFile', None) or zipfile.BadZipfile
+
+# Exclusions which may leave only a small part of a file, when it is
+# quicker to decode just that part than to decode (and cache) it all
+
+selective = ('include_surveys', 'exclude_surveys', 'dates', 'styles', 'bbox', 'polygon')
+
+def default_cache_dir():
+    """Return the per-user cache directory for decoded .3d files"""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'survex3d')
+
+def content_hash(path, blocksize=1 << 20):
+    """Return the SHA-1 hex digest of the contents of a file"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class DecodeCache:
+    """Cache of decoded .3d files, held as .npz files in a directory
+
+    Entries are keyed on a hash of the file contents.  An index maps
+    each .3d path to its size, mtime and hash, so an unchanged file is
+    not even re-read; when cavern rewrites a file the size or mtime
+    changes and the hash is recomputed.  The least recently used
+    entries are evicted to keep the total under max_bytes.
+    """
+
+    index_name = 'index.json'
+
+    def __init__(self, directory=None, max_bytes=512 << 20):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+
+    def index_path(self):
+        return os.path.join(self.directory, self.index_name)
+
+    def read_index(self):
+        """Return the index as a dict, or empty if missing or unreadable"""
+        try:
+            with open(self.index_path()) as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_index(self, index):
+        """Write the index, atomically so concurrent readers never see half of it"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(index, fp)
+        except (IOError, OSError):
+            os.remove(tmp)
+            raise
+        replace(tmp, self.index_path())
+
+    def key(self, path):
+        """Return the content hash for a .3d file, via the index if it is unchanged"""
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        index = self.read_index()
+        entry = index.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[2]
+        sha = content_hash(path)
+        if os.path.isdir(self.directory):
+            index[path] = [st.st_size, st.st_mtime, sha]
+            self.write_index(index)
+        return sha
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, '%s-v%i.npz' % (key, CACHE_VERSION))
+
+    def decode_3d(self, path, progress=None, **exclusions):
+        """Return (decode_3d(path, **exclusions), True if it came from the cache)
+
+        Progress is reported as for decode_3d(), if the file has to be
+        decoded.  On a miss the whole file is decoded and cached, then
+        the exclusions applied, unless some of them are selective (by
+        survey, date, style or region), when only the part selected
+        is decoded, and nothing is cached.
+        """
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            entry = self.entry_path(self.key(path))
+        except (IOError, OSError): # no usable cache directory, so just decode
+            self.misses += 1
+            return decode_3d(path, progress=progress, **exclusions), False
+
+        try:
+            decoded = Survex3D.load(entry)
+            os.utime(entry, None) # mark as recently used
+            self.hits += 1
+        except (IOError, OSError, ValueError, KeyError, BadZipFile): # missing or corrupt
+            self.misses += 1
+            if any(exclusions.get(k) is not None and len(exclusions[k]) for k in selective):
+                return decode_3d(path, progress=progress, **exclusions), False
+            decoded = decode_3d(path, progress=progress)
+            self.store(decoded, entry)
+            return decoded.select(**exclusions), False
+
+        return decoded.select(**exclusions), True
+
+    def store(self, decoded, entry):
+        """Save a decoded file to the cache, then evict old entries"""
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                decoded.save(fp)
+        except (IOError, OSError): # e.g. disk full, the cache is only an optimisation
+            os.remove(tmp)
+            return
+        try:
+            replace(tmp, entry)
+        except OSError:
+            return
+        self.evict(keep=entry)
+
+    def entries(self):
+        """Return (mtime, size, path) for all entries, oldest first"""
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError: # removed by another process
+                    continue
+                result.append((st.st_mtime, st.st_size, path))
+        return sorted(result)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until under max_bytes"""
+        entries = self.entries()
+        total = sum(size for mtime, size, path in entries)
+        removed = set()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed.add(os.path.basename(path).split('-')[0])
+        if removed: # forget hashes that are no longer cached
+            index = self.read_index()
+            index = dict((k, v) for k, v in index.items() if v[2] not in removed)
+            self.write_index(index)
+
+    def clear(self):
+        """Remove all entries and the index"""
+        if os.path.isdir(self.directory):
+            for mtime, size, path in self.entries():
+                os.remove(path)
+            if os.path.exists(self.index_path()):
+                os.remove(self.index_path())
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Writing of files in one step, shared by the decode cache, the
+checkpoint index and the GeoPackage writer.  Each is written to a
+temporary file beside the target, which then replaces it, so that an
+interrupted write never leaves a truncated file behind.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+
+def replace(tmp, target):
+    """Rename tmp over target, removing tmp if that fails
+
+    os.replace() is atomic, but is Python 3 only, and under Python 2
+    os.rename() fails on Windows if the target exists, so the target
+    is removed first there (a reader may briefly find it missing).
+    """
+    try:
+        if hasattr(os, 'replace'):
+            os.replace(tmp, target)
+        else:
+            if os.name == 'nt' and os.path.exists(target):
+                os.remove(target)
+            os.rename(tmp, target)
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Bulk writing of layers to a GeoPackage with OGR, free of any QGIS
+dependency.  Features are inserted in large transactions, geometries
+pass straight through as WKB, and fields are set by index.  The
+spatial (rtree) index on each layer is built once all its features
+are in, which is much quicker than maintaining it during the insert.
+Also here, as they need OSR, are the lookup of EPSG codes from the CS
+in .3d files, and the transform of coordinates from one CRS to another.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from osgeo import osr # spatial reference system API
+from osgeo import ogr # GDAL vector layer API
+
+from survex3d_files import replace
+from survex3d_timing import PhaseTimer
+
+from datetime import date
+from re import search
+
+import glob
+import os
+import tempfile
+
+import numpy as np
+
+BATCH_SIZE = 20000 # features per transaction
+
+# map from geometry and field types in survex3d_layers to OGR, with z dimension
+
+ogr_geom_type = {'Point': ogr.wkbPoint25D,
+                 'LineString': ogr.wkbLineString25D,
+                 'Polygon': ogr.wkbPolygon25D}
+
+ogr_field_type = {'Int': ogr.OFTInteger,
+                  'Double': ogr.OFTReal,
+                  'String': ogr.OFTString,
+                  'Date': ogr.OFTDate}
+
+day_zero = date(1900, 1, 1).toordinal()
+
+def create_gpkg(path, overwrite=True):
+    """Create a new GeoPackage, removing an existing one if overwrite is set"""
+    driver = ogr.GetDriverByName('GPKG')
+    if overwrite and os.path.exists(path):
+        driver.DeleteDataSource(path)
+    dataset = driver.CreateDataSource(path)
+    if dataset is None:
+        raise IOError("Can't create GeoPackage " + path)
+    return dataset
+
+# First try to extract an explicit EPSG number, otherwise try
+# assuming the string is PROJ.4.  The reason for this somewhat
+# convoluted route is to ensure if there is an EPSG number in the
+# passed string, it is returned 'as is' and not transmuted into
+# another EPSG number with ostensibly the same CRS.  The lookup from
+# a PROJ.4 string is slow, and the same few strings come up again
+# and again, so the results are kept.
+
+epsg_cache = {} # map from CS string to EPSG number
+
+def epsg_from_cs(s):
+    """Extract EPSG number from string"""
+    if s not in epsg_cache:
+        epsg_cache[s] = lookup_epsg(s)
+    return epsg_cache[s]
+
+def lookup_epsg(s):
+    """Extract EPSG number from string, without the cache"""
+    srs = osr.SpatialReference()
+    match = search('epsg:([0-9]*)', s)
+    if match:
+        return_code = srs.ImportFromEPSG(int(match.group(1)))
+    else:
+        return_code = srs.ImportFromProj4(s)
+    if return_code:
+        raise ValueError("Invalid proj4 string: " + s)
+    return int(srs.GetAttrValue('AUTHORITY', 1))
+
+def srs_from_epsg(epsg):
+    """Return an OGR spatial reference system for an EPSG code, or None"""
+    if not epsg:
+        return None
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs
+
+def coordinate_transform(source_epsg, target_epsg):
+    """Return a function transforming an (n, 3) array of coordinates between two CRS
+
+    All the coordinates are passed to OSR in a single call.  The axes
+    are kept in x, y order (easting and northing, or longitude and
+    latitude) whatever the CRS says, as with GDAL before version 3.
+    """
+    source, target = srs_from_epsg(source_epsg), srs_from_epsg(target_epsg)
+    if hasattr(source, 'SetAxisMappingStrategy'): # GDAL 3 on
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    ct = osr.CoordinateTransformation(source, target)
+    def transform(xyz):
+        return np.array(ct.TransformPoints(xyz.tolist()), dtype='<f8').reshape(-1, 3)
+    return transform
+
+def transform_region(bbox, polygon, transform, npoints=16):
+    """Return (bbox, polygon) for a region of interest transformed to another CRS
+
+    The region is as for survex3d.Region, and transform is from
+    coordinate_transform().  The sides of a bounding box are no longer
+    straight or square in the new CRS, so it becomes a polygon with
+    npoints along each side (or the envelope of that, if there is a
+    polygon as well).
+    """
+    rings = [np.asarray(ring, dtype=float)[:, :2] for ring in polygon] if polygon is not None else []
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        t = np.linspace(0.0, 1.0, npoints, endpoint=False)
+        box = np.vstack([np.column_stack([xmin + t * (xmax - xmin), ymin + 0 * t]),
+                         np.column_stack([xmax + 0 * t, ymin + t * (ymax - ymin)]),
+                         np.column_stack([xmax - t * (xmax - xmin), ymax + 0 * t]),
+                         np.column_stack([xmin + 0 * t, ymax - t * (ymax - ymin)])])
+        rings.append(box)
+    sizes = np.cumsum([len(ring) for ring in rings])[:-1]
+    xy = np.vstack(rings)
+    xy = transform(np.column_stack([xy, np.zeros(len(xy))]))[:, :2]
+    rings = [ring.tolist() for ring in np.split(xy, sizes)]
+    if bbox is None:
+        return None, rings
+    if polygon is None:
+        return None, rings[-1:]
+    box = np.asarray(rings.pop())
+    return tuple(box.min(axis=0).tolist() + box.max(axis=0).tolist()), rings
+
+def write_layer(dataset, name, geom_type, fields, rows, srs=None,
+                batch_size=BATCH_SIZE, progress=None, ncount=0, timer=None):
+    """Write a layer of features to an open GeoPackage, and return the running count
+
+    The fields are (name, OGR field type) pairs, and the rows are
+    (wkb, values) pairs with the values in the same order as the
+    fields, already as plain Python types; None leaves a field null.
+    If given, progress is called with the running count of features
+    after each transaction, starting from ncount.  The inserts and
+    the spatial index are timed as phases by timer (a PhaseTimer).
+    """
+
+    timer = timer or PhaseTimer(enabled=False)
+
+    layer = dataset.CreateLayer(name, srs=srs, geom_type=geom_type, options=['SPATIAL_INDEX=NO'])
+    if layer is None:
+        raise IOError("Can't create layer " + name)
+
+    for field_name, field_type in fields:
+        layer.CreateField(ogr.FieldDefn(field_name, field_type))
+
+    schema = layer.GetLayerDefn()
+    indices = list(range(len(fields)))
+
+    nstart = ncount
+
+    with timer.phase('gpkg insert') as counts:
+
+        layer.StartTransaction()
+        nbatch = 0
+
+        for wkb, values in rows:
+            feat = ogr.Feature(schema)
+            feat.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb))
+            for i, value in zip(indices, values):
+                if value is not None:
+                    feat.SetField(i, value)
+            layer.CreateFeature(feat)
+            nbatch += 1
+            if nbatch == batch_size:
+                layer.CommitTransaction()
+                ncount += nbatch
+                nbatch = 0
+                if progress:
+                    progress(ncount)
+                layer.StartTransaction()
+
+        layer.CommitTransaction()
+        ncount += nbatch
+        if progress:
+            progress(ncount)
+
+        counts['count'] = ncount - nstart
+
+    # Now build the rtree in one go
+
+    with timer.phase('gpkg index') as counts:
+        sql = "SELECT CreateSpatialIndex('%s', '%s')" % (name, layer.GetGeometryColumn())
+        result = dataset.ExecuteSQL(sql)
+        if result is not None:
+            dataset.ReleaseResultSet(result)
+        counts['count'] = ncount - nstart
+
+    return ncount
+
+def ogr_rows(layer):
+    """Generate (wkb, values) for a Layer from survex3d_layers, with dates as strings"""
+    dates = [i for i, (name, kind) in enumerate(layer.fields) if kind == 'Date']
+    for wkb, row in zip(layer.wkbs, layer.rows):
+        if dates:
+            row = list(row)
+            for i in dates:
+                if row[i] is not None:
+                    row[i] = date.fromordinal(day_zero + row[i]).isoformat()
+        yield wkb, row
+
+def remove_gpkg(path):
+    """Remove a GeoPackage, with any journal or WAL files left beside it"""
+    for name in [path] + glob.glob(path + '-*'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+def write_layers(path, layers, epsg=None, progress=None, timer=None):
+    """Write Layers from survex3d_layers to a new GeoPackage, returning the number of features
+
+    Progress is reported as for write_layer(), with the running count
+    over all the layers, and likewise the phases are timed by timer.
+    The GeoPackage is written to a temporary file beside path, which
+    only replaces any existing file once it is complete, so that if
+    the export fails, or progress raises an exception to cancel it,
+    the existing file is left as it was.
+    """
+    timer = timer or PhaseTimer(enabled=False)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.' + os.path.basename(path) + '-', suffix='.gpkg')
+    os.close(fd)
+    os.remove(tmp) # as OGR creates it afresh
+    dataset = None
+    try:
+        dataset = create_gpkg(tmp)
+        srs = srs_from_epsg(epsg)
+        ncount = 0
+        for layer in layers:
+            fields = [(name, ogr_field_type[kind]) for name, kind in layer.fields]
+            ncount = write_layer(dataset, layer.name, ogr_geom_type[layer.geom], fields, ogr_rows(layer),
+                                 srs=srs, progress=progress, ncount=ncount, timer=timer)
+        with timer.phase('gpkg flush') as counts:
+            dataset = None # all done, flush to disk
+            counts['count'] = ncount
+        replace(tmp, path)
+    except BaseException:
+        dataset = None # close it, to be able to remove it
+        remove_gpkg(tmp)
+        raise
+    return ncount
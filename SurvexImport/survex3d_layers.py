@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+The layers built from decoded .3d files, free of any QGIS or Qt
+dependency, so that the plugin and the command line converter make
+the same layers with the same schemas.
+
+Each layer has a name (legs, stations, etc), a geometry type, a list
+of (field name, type) with the type one of 'Int', 'Double', 'String'
+or 'Date', and the features as a list of WKB geometries and a list of
+rows of attribute values.  Dates are given as days since 1900.01.01,
+and a value of None is null.  If the features come from several .3d
+files, a SOURCE field can be added to say which file each came from.
+The geometries can be transformed into another CRS as they are built,
+by a function taking and returning an (n, 3) array of coordinates in
+metres (see survex3d_gpkg.coordinate_transform); the attributes, such
+as ELEVATION, are as in the .3d file.
+
+A Digest of a layer can be kept after it has been imported, so that
+when the .3d file is imported again, only the features which differ
+need to be changed (see diff_layer).
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from survex3d import run_dtype
+from survex3d_wkb import points_wkb, linestrings_wkb, polygons_wkb, run_vertices, scaled
+
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+Layer = namedtuple('Layer', 'name geom fields wkbs rows')
+
+layer_names = ('stations', 'legs', 'traverses', 'xsections', 'walls', 'polygons') # in order
+
+# The following are some dictionaries for flags in the .3d file
+
+station_attr = {0x01:'SURFACE', 0x02:'UNDERGROUND', 0x04:'ENTRANCE',
+                0x08:'EXPORTED', 0x10:'FIXED', 0x20:'ANON'}
+
+leg_attr = {0x01:'SURFACE', 0x02:'DUPLICATE', 0x04:'SPLAY'}
+
+style_type = {0x00:'NORMAL', 0x01:'DIVING', 0x02:'CARTESIAN',
+              0x03:'CYLPOLAR', 0x04:'NOSURVEY', 0xff:'NOSTYLE'}
+
+# lists of keys of above, sorted to restore ordering
+
+station_flags = sorted(station_attr.keys())
+leg_flags = sorted(leg_attr.keys())
+
+# field names if there is error data
+
+error_fields = ('NLEGS', 'LENGTH', 'ERROR', 'ERROR_HORIZ', 'ERROR_VERT')
+
+# field names for the optional fields derived from the leg geometry;
+# the first two are taken as LEG_LENGTH etc as the error data has a
+# LENGTH (of the traverse) already
+
+derived_fields = ('LEG_LENGTH', 'HORIZ_LENGTH', 'BEARING', 'INCLINATION')
+
+def source_fields(sources):
+    """Return the SOURCE field if there are sources, and for each survey the value as a list"""
+    if sources is None:
+        return [], None
+    return [('SOURCE', 'String')], [[source] for source in sources]
+
+def station_depths(stations, entrance_z):
+    """Return the depth (m) of each station below the highest entrance, as a list
+
+    The height entrance_z (cm) is that of Survex3D, taken over the
+    whole file so that it does not depend on which stations are
+    selected.  The depths are None if there are no entrances.
+    """
+    if entrance_z is None:
+        return [None] * len(stations)
+    return np.round(0.01 * (entrance_z - stations['xyz'][:, 2]), 2).tolist()
+
+def run_geometry(xyz_pairs, runs):
+    """Return the lengths, horizontal lengths, bearings and inclinations of runs of legs
+
+    Given the from and to positions (m) of each leg, and the (start,
+    stop) of each run, the lengths (m) are added up over the legs in
+    each run, and the bearing and inclination (degrees) are those of
+    the straight line from the start to the end of the run.  These
+    are returned as a list of rows, with the bearing None for a
+    vertical run.
+    """
+    if not len(runs):
+        return []
+    firsts = runs['start']
+    d = xyz_pairs[:, 1] - xyz_pairs[:, 0]
+    horiz = np.hypot(d[:, 0], d[:, 1])
+    lengths = np.add.reduceat(np.hypot(horiz, d[:, 2]), firsts)
+    horiz = np.add.reduceat(horiz, firsts)
+    span = xyz_pairs[runs['stop'] - 1, 1] - xyz_pairs[firsts, 0]
+    span_horiz = np.hypot(span[:, 0], span[:, 1])
+    bearings = np.round(np.degrees(np.arctan2(span[:, 0], span[:, 1])), 2) % 360
+    inclinations = np.round(np.degrees(np.arctan2(span[:, 2], span_horiz)), 2)
+    return [[length, h, bearing if level_span else None, inclination] for length, h, bearing, level_span, inclination
+            in zip(np.round(lengths, 2).tolist(), np.round(horiz, 2).tolist(), bearings.tolist(),
+                   (span_horiz > 0).tolist(), inclinations.tolist())]
+
+def station_layer(surveys, sources=None, transform=None, include_derived=False):
+    """Return the stations in a list of decoded .3d files as a Layer
+
+    If given, sources are the names of the .3d files the surveys came
+    from, for the SOURCE field, and transform is applied to the
+    coordinates of the geometries.  If include_derived is set, each
+    station has a DEPTH below the highest entrance in its .3d file.
+    """
+
+    fields = [('NAME', 'String'), ('ELEVATION', 'Double')]
+    fields += [(station_attr[k], 'Int') for k in station_flags]
+    if include_derived:
+        fields.append(('DEPTH', 'Double'))
+    extra, values = source_fields(sources)
+    fields += extra
+
+    wkbs, rows = [], []
+
+    for n, survey in enumerate(surveys):
+        stations = survey.stations
+        elevs = (0.01 * stations['xyz'][:, 2]).tolist() # convert to metres
+        labels = survey.labels.names(stations['label'])
+        depths = [[depth] for depth in station_depths(stations, survey.entrance_z)] if include_derived else None
+        source = values[n] if values else []
+        for j, (elev, label, flag) in enumerate(zip(elevs, labels, stations['flag'].tolist())):
+            row = [label, round(elev, 2)] + [1 if flag & k else 0 for k in station_flags]
+            if depths:
+                row += depths[j]
+            rows.append(row + source)
+        wkbs.extend(points_wkb(stations['xyz'], transform=transform))
+
+    return Layer('stations', 'Point', fields, wkbs, rows)
+
+def leg_layer(surveys, merge_legs=False, sources=None, transform=None, include_derived=False):
+    """Return the legs in a list of decoded .3d files as a Layer
+
+    Each feature is a run of legs, which is a single leg unless they
+    are being merged into polylines.  These share attributes, which
+    are taken from the first leg and its traverse, except that the
+    elevation is the mean over the legs.  Error fields are only added
+    if error data has been provided.  If include_derived is set, the
+    length, horizontal length, bearing and inclination of each run
+    are added (see run_geometry).  Sources and transform are as for
+    station_layer().
+    """
+
+    error_info = any(survey.has_error_info for survey in surveys)
+
+    fields = [('NAME', 'String'), ('ELEVATION', 'Double'), ('STYLE', 'String'),
+              ('DATE1', 'Date'), ('DATE2', 'Date')]
+    if error_info:
+        fields += [(s, 'Int' if s == 'NLEGS' else 'Double') for s in error_fields]
+    fields += [(leg_attr[k], 'Int') for k in leg_flags]
+    if include_derived:
+        fields += [(s, 'Double') for s in derived_fields]
+    if merge_legs:
+        fields.append(('STATIONS', 'String'))
+    extra, values = source_fields(sources)
+    fields += extra
+
+    wkbs, rows = [], []
+
+    for n, survey in enumerate(surveys):
+        legs = survey.legs
+        if merge_legs:
+            runs = survey.leg_runs()
+        else:
+            runs = np.zeros(len(legs), dtype=run_dtype)
+            runs['start'] = np.arange(len(legs))
+            runs['stop'] = runs['start'] + 1
+        firsts = runs['start']
+        xyz_pairs = 0.01 * legs['xyz'] # convert to metres
+        elevs = 0.5 * (xyz_pairs[:, 0, 2] + xyz_pairs[:, 1, 2])
+        elevs = (np.add.reduceat(elevs, firsts) / (runs['stop'] - firsts)).tolist() if len(legs) else []
+        labels = survey.labels.names(legs['label'][firsts])
+        styles = [style_type[style] for style in legs['style'][firsts].tolist()]
+        days1 = legs['date1'][firsts].tolist()
+        days2 = legs['date2'][firsts].tolist()
+        flags = legs['flag'][firsts].tolist()
+        traverse = np.searchsorted(survey.traverses['start'], firsts, side='right') - 1
+        nlehvs = survey.traverses['nlehv'][traverse].tolist()
+        has_nlehvs = survey.traverses['has_nlehv'][traverse].tolist()
+        derived = run_geometry(xyz_pairs, runs) if include_derived else None
+        if merge_legs: # names of the stations at each vertex
+            ids = survey.stations_at(legs['xyz'][:, 1])
+            names = [name if i >= 0 else '' for name, i
+                     in zip(survey.labels.names(np.maximum(ids, 0)), ids.tolist())]
+            ids = survey.stations_at(legs['xyz'][firsts, 0])
+            first_names = [name if i >= 0 else '' for name, i
+                           in zip(survey.labels.names(np.maximum(ids, 0)), ids.tolist())]
+        for j, (start, stop) in enumerate(zip(firsts.tolist(), runs['stop'].tolist())):
+            row = [labels[j], round(elevs[j], 2), styles[j], days1[j], days2[j]]
+            if has_nlehvs[j]:
+                nlehv = nlehvs[j]
+                row += [nlehv[0]] + [0.01*v for v in nlehv[1:5]]
+            elif error_info: # this traverse has no error data
+                row += [None] * len(error_fields)
+            row += [1 if flags[j] & k else 0 for k in leg_flags]
+            if derived:
+                row += derived[j]
+            if merge_legs:
+                row.append(','.join([first_names[j]] + names[start:stop]))
+            if values:
+                row += values[n]
+            rows.append(row)
+        vertices, counts = run_vertices(legs['xyz'], runs)
+        wkbs.extend(linestrings_wkb(vertices, counts, transform=transform))
+
+    return Layer('legs', 'LineString', fields, wkbs, rows)
+
+Walls = namedtuple('Walls', 'xyz left right up_down counts')
+
+def passage_walls(xyz, lrud, runs, use_clino_wgt=True):
+    """Return the passage walls for runs of xsects, as Walls
+
+    Given the positions (cm) and LRUD data of the xsects as integer
+    arrays, and the (start, stop) of each run, the walls are built
+    for all the runs at once.  Runs of a single station are dropped,
+    since we don't know which way to face.  The result has the
+    positions of the remaining stations (cm), the left and right wall
+    points and up / down (in metres), and the number in each run.
+
+    The direction of each leg of a run is a horizontal unit vector,
+    optionally weighted by cos(inclination) = dh/dl where dh^2 = dx^2
+    + dy^2 and dl^2 = dh^2 + dz^2.  The normalisation is
+    correspondingly either 1/dh, or 1/dh * dh/dl = 1/dl, and the
+    direction is zero for a plumb.  At each station the walls are
+    offset by the left and right distances perpendicular to the mean
+    (sum) of the directions of the legs either side, with just the
+    one leg at the start and end stations.
+    """
+
+    counts = (runs['stop'] - runs['start']).astype(np.int64)
+    runs, counts = runs[counts > 1], counts[counts > 1]
+
+    # Gather the stations in the runs, and mark the first and last in each
+
+    n = int(counts.sum())
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    index = np.arange(n) + np.repeat(runs['start'] - offsets[:-1], counts)
+    xyz = np.asarray(xyz, dtype=np.int64)[index]
+    lrud = np.asarray(lrud, dtype=np.int64)[index]
+    first = np.zeros(n, dtype=bool)
+    first[offsets[:-1]] = True
+    last = np.zeros(n, dtype=bool)
+    last[offsets[1:] - 1] = True
+
+    # Directions of the legs from each station to the next, where the
+    # calculation is in integers up to the normalisation, so that the
+    # test for a plumb is safely dh2 = 0
+
+    d = xyz[1:] - xyz[:-1]
+    dh2 = d[:, 0]*d[:, 0] + d[:, 1]*d[:, 1]
+    norm = np.sqrt(dh2 + d[:, 2]*d[:, 2] if use_clino_wgt else dh2)
+    ok = (dh2 > 0) & (norm > 0)
+    direction = np.zeros((max(n - 1, 0), 2))
+    direction[ok] = d[ok, 0:2] / norm[ok, np.newaxis]
+
+    # The sum of the directions either side of each station,
+    # normalised to a unit vector (e)
+
+    before = np.zeros((n, 2))
+    before[1:] = direction
+    before[first] = 0
+    after = np.zeros((n, 2))
+    after[:-1] = direction
+    after[last] = 0
+    e = before + after
+    norm = np.sqrt(e[:, 0]*e[:, 0] + e[:, 1]*e[:, 1])
+    ok = norm > 0
+    e[ok] /= norm[ok, np.newaxis]
+    e[~ok] = 0
+
+    # Convert to metres when saving the points
+
+    x, y, z = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+    l, r = lrud[:, 0], lrud[:, 1]
+    ex, ey = e[:, 0], e[:, 1]
+    left = 0.01 * np.column_stack([x - l*ey, y + l*ex, z])
+    right = 0.01 * np.column_stack([x + r*ey, y - r*ex, z])
+    up_down = 0.01 * lrud[:, 2:4]
+
+    return Walls(xyz, left, right, up_down, counts)
+
+def wall_layers(surveys, use_clino_wgt=True, include_up_down=True, sources=None, transform=None):
+    """Return the traverses, xsections, walls and polygons from the xsects, as Layers
+
+    Sources and transform are as for station_layer().
+    """
+
+    # The station position and LRUD data for all xsects, looking up
+    # coordinates from labels, and replacing missing (negative) LRUD
+    # data by zero, with the runs offset to match
+
+    xyzs, lruds, all_runs = [], [], []
+    nxsects = 0
+
+    for survey in surveys:
+        xsects = survey.xsects
+        xyzs.append(survey.label_xyz[xsects['label']])
+        lruds.append(np.maximum(xsects['lrud'], 0))
+        runs = survey.xsect_runs.copy()
+        runs['start'] += nxsects
+        runs['stop'] += nxsects
+        all_runs.append(runs)
+        nxsects += len(xsects)
+
+    all_runs = np.concatenate(all_runs)
+    walls = passage_walls(np.concatenate(xyzs), np.concatenate(lruds), all_runs, use_clino_wgt)
+
+    left, right, counts = walls.left, walls.right, walls.counts
+    first = np.zeros(len(left), dtype=bool)
+    first[np.cumsum(counts) - counts] = True
+
+    # The geometries are all built from the centerline and wall
+    # positions in metres, which are transformed together (if asked)
+    # before being shared out
+
+    n = len(left)
+    xyz = scaled(np.concatenate([0.01 * walls.xyz, left, right]), 1, transform)
+    centre, left_xyz, right_xyz = xyz[:n], xyz[n:2*n], xyz[2*n:]
+
+    # The centerline traverses (from cm), with the mean elevation
+    # of each, which is also used for the walls
+
+    z = walls.xyz[:, 2]
+    elevs = (0.01 * np.add.reduceat(z, np.cumsum(counts) - counts) / counts).tolist() if len(counts) else []
+    trav_attrs = [[round(elev, 2)] for elev in elevs]
+    trav_wkbs = linestrings_wkb(centre, counts, scale=1)
+
+    # The walls as line strings, the left then the right for each run
+
+    side = np.concatenate([2 * np.repeat(np.arange(len(counts)), counts)] * 2)
+    side[len(left):] += 1
+    order = np.argsort(side, kind='mergesort') # stable
+    wall_wkbs = linestrings_wkb(np.concatenate([left_xyz, right_xyz])[order], np.repeat(counts, 2), scale=1)
+    wall_attrs = [attrs for attrs in trav_attrs for i in (0, 1)]
+
+    # Slightly more elaborate, pair up points on left and right
+    # walls, and build a cross section as a 2-point line string, and
+    # a quadrilateral polygon with a closed 5-point line string for
+    # the exterior ring.  Note that QGIS polygons are supposed to
+    # have their points ordered clockwise.
+
+    xsect_wkbs = linestrings_wkb(np.stack([left_xyz, right_xyz], axis=1).reshape(-1, 3),
+                                 [2] * len(left), scale=1)
+    xsect_attrs = [[round(elev, 2)] for elev in (0.01 * z).tolist()]
+
+    i = np.flatnonzero(~first) # the second station onwards in each run
+    ring = np.stack([right_xyz[i-1], left_xyz[i-1], left_xyz[i], right_xyz[i], right_xyz[i-1]], axis=1)
+    quad_wkbs = polygons_wkb(ring.reshape(-1, 3), [5] * len(i), scale=1)
+    quad_elevs = (0.5 * (left[i-1, 2] + left[i, 2])).tolist() # average elevation
+    if include_up_down: # average up / down
+        quad_attrs = [[round(elev, 2)] + up_down for elev, up_down
+                      in zip(quad_elevs, (0.5 * (walls.up_down[i-1] + walls.up_down[i])).tolist())]
+    else:
+        quad_attrs = [[round(elev, 2)] for elev in quad_elevs]
+
+    fields = [('ELEVATION', 'Double')] # common to all
+    quad_fields = fields + ([(s, 'Double') for s in ('MEAN_UP', 'MEAN_DOWN')] if include_up_down else [])
+
+    # The source of each run kept by passage_walls(), and so of each
+    # traverse, the pair of walls, the xsections and the polygons
+
+    extra, values = source_fields(sources)
+
+    if values:
+        run_source = np.repeat(np.arange(len(surveys)), [len(survey.xsect_runs) for survey in surveys])
+        run_source = run_source[all_runs['stop'] - all_runs['start'] > 1].tolist()
+        per_station = np.repeat(run_source, counts).tolist()
+        trav_attrs = [attrs + values[n] for attrs, n in zip(trav_attrs, run_source)]
+        wall_attrs = [attrs + values[n] for attrs, n in zip(wall_attrs, np.repeat(run_source, 2).tolist())]
+        xsect_attrs = [attrs + values[n] for attrs, n in zip(xsect_attrs, per_station)]
+        quad_attrs = [attrs + values[n] for attrs, n in zip(quad_attrs, np.repeat(run_source, counts - 1).tolist())]
+        fields += extra
+        quad_fields += extra
+
+    return [Layer('traverses', 'LineString', fields, trav_wkbs, trav_attrs),
+            Layer('xsections', 'LineString', fields, xsect_wkbs, xsect_attrs),
+            Layer('walls', 'LineString', fields, wall_wkbs, wall_attrs),
+            Layer('polygons', 'Polygon', quad_fields, quad_wkbs, quad_attrs)]
+
+def build_layers(surveys, include_legs=True, include_stations=True, include_traverses=False,
+                 include_xsections=False, include_walls=False, include_polygons=False,
+                 merge_legs=False, use_clino_wgt=True, include_up_down=True, sources=None,
+                 transform=None, include_derived=False):
+    """Return the requested Layers for a list of decoded .3d files
+
+    Layers are only returned if they have features, in the order
+    stations, legs, traverses, xsections, walls, polygons.  If
+    sources (the names of the .3d files, one for each survey) are
+    given, each layer has a SOURCE field.  If given, transform is
+    applied to the coordinates of all the geometries.  If
+    include_derived is set, the legs have their lengths, bearings and
+    inclinations, and the stations their depths, as extra fields.
+    """
+
+    layers = []
+
+    if include_stations and any(len(survey.stations) for survey in surveys):
+        layers.append(station_layer(surveys, sources, transform, include_derived))
+
+    if include_legs and any(len(survey.legs) for survey in surveys):
+        layers.append(leg_layer(surveys, merge_legs, sources, transform, include_derived))
+
+    # Now do wall features if asked
+
+    included = {'traverses': include_traverses, 'xsections': include_xsections,
+                'walls': include_walls, 'polygons': include_polygons}
+
+    if any(included.values()) and any(len(survey.xsect_runs) for survey in surveys):
+        layers.extend(layer for layer in wall_layers(surveys, use_clino_wgt, include_up_down, sources, transform)
+                      if included[layer.name] and layer.rows)
+
+    return layers
+
+def pad_layer(layer, fields):
+    """Return a Layer with the given fields, null where it doesn't have them, or None if it has others"""
+    if layer.fields == fields:
+        return layer
+    index = dict((field, i) for i, field in enumerate(layer.fields))
+    if not set(index).issubset(fields):
+        return None
+    take = [index.get(field) for field in fields]
+    rows = [[None if i is None else row[i] for i in take] for row in layer.rows]
+    return Layer(layer.name, layer.geom, list(fields), layer.wkbs, rows)
+
+def concat_layers(layer_lists):
+    """Join up lists of Layers, as built from separate .3d files, into one list
+
+    Layers with the same name are concatenated, in the order of the
+    lists, and returned in the same order as build_layers().  They
+    have the same fields, except that the error fields are only
+    there for files which have error data, so a field which is
+    missing from a layer is null for its features.
+    """
+
+    by_name = {}
+    for layers in layer_lists:
+        for layer in layers:
+            by_name.setdefault(layer.name, []).append(layer)
+
+    result = []
+
+    for name in [name for name in layer_names if name in by_name]:
+        layers = by_name[name]
+        fields = max((layer.fields for layer in layers), key=len)
+        wkbs, rows = [], []
+        for layer in layers:
+            wkbs.extend(layer.wkbs)
+            rows.extend(pad_layer(layer, fields).rows)
+        result.append(Layer(name, layers[0].geom, fields, wkbs, rows))
+
+    return result
+
+Digest = namedtuple('Digest', 'fields hashes keys')
+
+def digest(layer):
+    """Return a Digest of a Layer, to compare with a later version of it
+
+    This has the fields, a hash of each feature (geometry and
+    attributes together), and a key for each feature, which is its
+    NAME if there is one, so the station name for stations and the
+    survey for legs.
+    """
+    names = [name for name, kind in layer.fields]
+    hashes = [hash((wkb, tuple(row))) for wkb, row in zip(layer.wkbs, layer.rows)]
+    if 'NAME' in names:
+        k = names.index('NAME')
+        keys = [row[k] for row in layer.rows]
+    else:
+        keys = [None] * len(layer.rows)
+    return Digest(list(layer.fields), hashes, keys)
+
+Patch = namedtuple('Patch', 'same change delete add')
+
+def diff_layer(old, new):
+    """Work out how to turn the old features of a layer into the new, from their Digests, as a Patch
+
+    Unchanged features are matched up by their hashes, as pairs (i,
+    j) of old and new indices in same.  Of the rest, old and new
+    features with the same key, such as a station which has moved or
+    the legs of a survey which has been re-entered, are paired up in
+    order in change, to be changed in place.  The old features left
+    over (indices in delete) are to be deleted, and the new ones left
+    over (indices in add) added.
+    """
+
+    unmatched = defaultdict(list) # old indices for each hash, last first
+    for i in range(len(old.hashes) - 1, -1, -1):
+        unmatched[old.hashes[i]].append(i)
+
+    same, left = [], []
+    for j, h in enumerate(new.hashes):
+        if unmatched.get(h):
+            same.append((unmatched[h].pop(), j))
+        else:
+            left.append(j)
+
+    by_key = defaultdict(list) # unmatched old indices for each key, last first
+    for i in sorted((i for indices in unmatched.values() for i in indices), reverse=True):
+        by_key[old.keys[i]].append(i)
+
+    change, add = [], []
+    for j in left:
+        key = new.keys[j]
+        if by_key.get(key):
+            change.append((by_key[key].pop(), j))
+        else:
+            add.append(j)
+
+    delete = sorted(i for indices in by_key.values() for i in indices)
+
+    return Patch(same, change, delete, add)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Parallel decoding of a single survex .3d file, using a checkpoint
+index kept in a sidecar file next to it.  The index is only written
+when asked for, as the directory the .3d file is in belongs to the
+user, not to this module.
+
+The records in a .3d file can't be decoded independently, since the
+current label, style, date and position carry over from one to the
+next.  A sequential decode can however take snapshots of this state
+as it goes.  Given these, the file is split into chunks which are
+decoded in a pool of processes and stitched back together in order.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from survex3d_files import replace
+from survex3d import (Checkpoint, Chunk, open_3d, paused_gc, start_of_data, decode_range,
+                      assemble, as_array, leg_dtype, station_dtype, xsect_dtype,
+                      traverse_dtype, run_dtype)
+
+import survex3d
+
+from array import array
+from multiprocessing import Pool
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+DEFAULT_SPACING = 1 << 20 # bytes between checkpoints
+
+def index_path(path):
+    """Return the name of the sidecar index file for a .3d file"""
+    return path + '.idx'
+
+def write_index(path, checkpoints, spacing=DEFAULT_SPACING):
+    """Save checkpoints to the sidecar index, with the size and mtime of the .3d file
+
+    The index is written to a temporary file which then replaces it,
+    so an interrupted write leaves no truncated index behind.
+    """
+    st = os.stat(path)
+    index = {'version': INDEX_VERSION, 'size': st.st_size, 'mtime': st.st_mtime,
+             'spacing': spacing,
+             'checkpoints': [[cp.pos, cp.label, cp.has_label, cp.style, cp.date1, cp.date2,
+                              np.frombuffer(cp.xyz, dtype='<i4').tolist(),
+                              np.frombuffer(cp.nlehv, dtype='<i4').tolist(),
+                              cp.legs, cp.xsects] for cp in checkpoints]}
+    target = index_path(path)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)),
+                               prefix='.' + os.path.basename(target) + '-')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(index, fp)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    replace(tmp, target)
+
+def read_index(path):
+    """Return the checkpoints from the sidecar index, or None if missing or stale"""
+    try:
+        with open(index_path(path)) as fp:
+            index = json.load(fp)
+        st = os.stat(path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION or index.get('size') != st.st_size
+        or index.get('mtime') != st.st_mtime):
+        return None
+    return [Checkpoint(pos, label, has_label, style, date1, date2,
+                       np.array(xyz, dtype='<i4').tobytes(), np.array(nlehv, dtype='<i4').tobytes(),
+                       legs, xsects)
+            for pos, label, has_label, style, date1, date2, xyz, nlehv, legs, xsects
+            in index['checkpoints']]
+
+def index_3d(path, spacing=DEFAULT_SPACING):
+    """Decode a .3d file in a single pass, taking checkpoints, and return (Survex3D, checkpoints)"""
+    with open_3d(path) as (header, buf), paused_gc():
+        if header.flag & 0x80: # abort if extended elevation
+            raise IOError("Can't deal with extended elevation in " + path)
+        chunk = decode_range(buf, path, start_of_data(header), len(buf) + 1, spacing=spacing)
+    return assemble(header, chunk), chunk.checkpoints
+
+def decode_chunk(args):
+    """Decode one chunk of a .3d file, in a worker process"""
+    path, start, stop = args
+    with open_3d(path) as (header, buf), paused_gc():
+        if start is None:
+            start = start_of_data(header)
+        return decode_range(buf, path, start, len(buf) + 1 if stop is None else stop)
+
+def merge_chunks(chunks):
+    """Stitch chunks decoded from consecutive ranges into a single Chunk
+
+    Each chunk has its own label table, which are merged in order so
+    that labels get the same ids as in a sequential decode, and the
+    leg and xsect positions in traverses and xsect runs are offset.
+    """
+
+    prefixes, leaves, labels = [], [], []
+    prefix_ids, leaf_ids, label_ids = {}, {}, {}
+
+    def lookup(ids, items, item):
+        i = ids.get(item)
+        if i is None:
+            i = ids[item] = len(items)
+            items.append(item)
+        return i
+
+    legs, stations, xsects, traverses, xsect_runs = [], [], [], [], []
+    nlegs = nxsects = xstart = 0
+    entrances = [chunk.entrance_z for chunk in chunks if chunk.entrance_z is not None]
+
+    for chunk in chunks:
+
+        pmap = [lookup(prefix_ids, prefixes, prefix) for prefix in chunk.prefixes]
+        lmap = [lookup(leaf_ids, leaves, leaf) for leaf in chunk.leaves]
+        relabel = [lookup(label_ids, labels, (pmap[i], lmap[j]))
+                   for i, j in zip(chunk.prefix_id, chunk.leaf_id)]
+        relabel = np.array(relabel + [-1], dtype=np.int32) # so that -1 (no label) stays as is
+
+        a = as_array(chunk.legs, leg_dtype).copy()
+        a['label'] = relabel[a['label']]
+        legs.append(a)
+
+        a = as_array(chunk.stations, station_dtype).copy()
+        a['label'] = relabel[a['label']]
+        stations.append(a)
+
+        a = as_array(chunk.xsects, xsect_dtype).copy()
+        a['label'] = relabel[a['label']]
+        xsects.append(a)
+
+        a = as_array(chunk.traverses, traverse_dtype).copy()
+        a['start'] += nlegs
+        a['stop'] += nlegs
+        traverses.append(a)
+
+        a = as_array(chunk.xsect_runs, run_dtype).copy()
+        a['start'] += nxsects
+        a['stop'] += nxsects
+        xsect_runs.append(a)
+
+        xstart = nxsects + chunk.xstart
+        nlegs += len(legs[-1])
+        nxsects += len(xsects[-1])
+
+    prefix_id = array('i', [i for i, j in labels])
+    leaf_id = array('i', [j for i, j in labels])
+
+    return Chunk(*[b''.join(a.tobytes() for a in arrays)
+                   for arrays in (legs, stations, xsects, traverses, xsect_runs)] +
+                 [xstart, max(entrances) if entrances else None, prefixes, leaves, prefix_id, leaf_id, []])
+
+def decode_chunks(path, checkpoints, processes=None):
+    """Decode a .3d file in the chunks between checkpoints, returning a Survex3D object
+
+    The chunks are decoded in a pool of processes, unless there is
+    only one of either, and then merged.
+    """
+
+    with open_3d(path) as (header, buf):
+        if header.flag & 0x80: # abort if extended elevation
+            raise IOError("Can't deal with extended elevation in " + path)
+
+    ranges = list(zip([None] + checkpoints, [cp.pos for cp in checkpoints] + [None]))
+    tasks = [(path, start, stop) for start, stop in ranges]
+
+    if len(tasks) == 1 or processes == 1:
+        chunks = [decode_chunk(task) for task in tasks]
+    else:
+        pool = Pool(processes)
+        try:
+            chunks = pool.map(decode_chunk, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return assemble(header, merge_chunks(chunks))
+
+def decode_3d(path, processes=None, spacing=DEFAULT_SPACING, update_index=False, **exclusions):
+    """Decode a .3d file in parallel if there is an index, returning a Survex3D object
+
+    Without an up to date index, the file is decoded sequentially,
+    as by survex3d.decode_3d().  If update_index is set, this pass
+    instead builds an index and saves it (if the directory is
+    writable), so the next decode can be in parallel.  Exclusions
+    are as for survex3d.decode_3d(), applied after decoding in
+    parallel.
+    """
+
+    checkpoints = read_index(path)
+
+    if checkpoints is None:
+        if not update_index:
+            return survex3d.decode_3d(path, **exclusions)
+        decoded, checkpoints = index_3d(path, spacing)
+        try:
+            write_index(path, checkpoints, spacing)
+        except (IOError, OSError): # e.g. read-only directory
+            pass
+        return decoded.select(**exclusions)
+
+    return decode_chunks(path, checkpoints, processes).select(**exclusions)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Timing of the phases of an import (decoding, building features,
+adding them to layers, exporting, and so on), free of any QGIS
+dependency so that it can be shared by the plugin and the scripts in
+extra/.  Each phase records its wall time, a count of the records or
+features it dealt with, and what can be measured of its memory use.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from contextlib import contextmanager
+
+import sys
+import time
+
+try: # not on Windows
+    import resource
+except ImportError:
+    resource = None
+
+try: # Python 3
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def peak_rss():
+    """Return the high water mark of the memory used by the process in bytes, or None"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else 1024 * maxrss # kB on Linux
+
+def current_rss():
+    """Return the memory now used by the process in bytes, or None if not known (as off Linux)"""
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+class PhaseTimer:
+    """Wall time, peak memory and counts for the phases of an import
+
+    Phases are timed by 'with timer.phase(name) as counts:', adding
+    the number of records or features dealt with to counts['count'].
+    A phase run several times (once for each layer, say) is added up
+    under its name, in the order first run.
+
+    The memory of a phase is given by three figures, each None if it
+    can't be measured.  peak_bytes is the peak traced by tracemalloc
+    during the phase, if something has started tracing (as bench3d.py
+    does) and the peak can be reset at the start (Python 3.9 on).
+    rss_growth_bytes is the increase in the memory used by the process
+    over the phase (on Linux), and process_peak_bytes is the high water
+    mark of the process at the end of it, which is cheap but is the
+    largest peak so far, not that of the phase.  A timer which is not
+    enabled does nothing, so it can always be passed along.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = [] # dicts with name, seconds, count and the memory figures, in order
+        self.by_name = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase, yielding a dict to put the count in"""
+        counts = {'count': 0}
+        if not self.enabled:
+            yield counts
+            return
+        tracing = (tracemalloc is not None and tracemalloc.is_tracing()
+                   and hasattr(tracemalloc, 'reset_peak')) # Python 3.9 on
+        if tracing:
+            tracemalloc.reset_peak()
+        rss = current_rss()
+        t0 = time.time()
+        try:
+            yield counts
+        finally:
+            seconds = time.time() - t0
+            peak = tracemalloc.get_traced_memory()[1] if tracing else None
+            growth = current_rss()
+            growth = growth - rss if growth is not None and rss is not None else None
+            entry = self.by_name.get(name)
+            if entry is None:
+                entry = self.by_name[name] = {'name': name, 'seconds': 0.0, 'count': 0, 'peak_bytes': None,
+                                              'rss_growth_bytes': None, 'process_peak_bytes': None}
+                self.phases.append(entry)
+            entry['seconds'] += seconds
+            entry['count'] += counts['count']
+            if peak is not None:
+                entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak)
+            if growth is not None:
+                entry['rss_growth_bytes'] = (entry['rss_growth_bytes'] or 0) + growth
+            entry['process_peak_bytes'] = peak_rss()
+
+    def as_dict(self):
+        """Return the phases and the total time, as a dict of plain types (for JSON)"""
+        return {'phases': [dict(entry) for entry in self.phases],
+                'seconds': sum(entry['seconds'] for entry in self.phases)}
+
+    def lines(self):
+        """Return a line of text for each phase, and one for the total"""
+        lines = []
+        for entry in self.phases:
+            line = '%s: %.3fs, %i records' % (entry['name'], entry['seconds'], entry['count'])
+            if entry['peak_bytes'] is not None:
+                line += ', peak %.1f MB' % (entry['peak_bytes'] / 1e6)
+            if entry['rss_growth_bytes'] is not None:
+                line += ', RSS %+.1f MB' % (entry['rss_growth_bytes'] / 1e6)
+            if entry['process_peak_bytes'] is not None:
+                line += ', process peak %.1f MB' % (entry['process_peak_bytes'] / 1e6)
+            lines.append(line)
+        lines.append('total: %.3fs' % sum(entry['seconds'] for entry in self.phases))
+        return lines
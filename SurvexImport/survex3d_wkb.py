@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Bulk encoding of geometries as well-known binary (WKB), free of any
+QGIS or Qt dependency.  The coordinates for many features at once
+are encoded by NumPy, and each feature gets a slice of the result,
+ready to be handed to QGIS (or OGR) in a single call.  The coordinates
+can be transformed on the way, all at once, into another CRS.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import numpy as np
+
+# ISO WKB geometry types with a z dimension, as QgsWKBTypes.PointZ etc
+
+POINT_Z = 1001
+LINESTRING_Z = 1002
+POLYGON_Z = 1003
+
+# Little endian records: byte order, geometry type, then xyz (for a
+# point), the number of points (for a line string), or the number of
+# rings and points (for a polygon with a single ring)
+
+point_dtype = np.dtype({'names': ['order', 'type', 'xyz'], 'formats': ['u1', '<u4', ('<f8', 3)],
+                        'offsets': [0, 1, 5], 'itemsize': 29})
+
+linestring_header_dtype = np.dtype({'names': ['order', 'type', 'npoints'],
+                                    'formats': ['u1', '<u4', '<u4'],
+                                    'offsets': [0, 1, 5], 'itemsize': 9})
+
+polygon_header_dtype = np.dtype({'names': ['order', 'type', 'nrings', 'npoints'],
+                                 'formats': ['u1', '<u4', '<u4', '<u4'],
+                                 'offsets': [0, 1, 5, 9], 'itemsize': 13})
+
+def scaled(xyz, scale, transform=None):
+    """Return the coordinates as doubles, scaled (cm to m by default), and transformed if asked
+
+    The transform takes and returns an (n, 3) array of doubles.
+    """
+    xyz = scale * np.asarray(xyz, dtype='<f8').reshape(-1, 3)
+    return xyz if transform is None or not len(xyz) else transform(xyz)
+
+def as_doubles(xyz, scale, transform=None):
+    """Return the coordinates as packed little endian doubles, as scaled()"""
+    return scaled(xyz, scale, transform).astype('<f8').tobytes()
+
+def points_wkb(xyz, scale=0.01, transform=None):
+    """Return a list of PointZ WKB, one for each row of xyz"""
+    points = np.zeros(len(xyz), dtype=point_dtype)
+    points['order'] = 1
+    points['type'] = POINT_Z
+    points['xyz'] = scaled(xyz, scale, transform)
+    data = points.tobytes()
+    return [data[i:i + 29] for i in range(0, len(data), 29)]
+
+def linestrings_wkb(xyz, counts, scale=0.01, transform=None):
+    """Return a list of LineStringZ WKB, each taking the next counts[i] rows of xyz"""
+    counts = np.asarray(counts, dtype=np.int64)
+    header = np.zeros(len(counts), dtype=linestring_header_dtype)
+    header['order'] = 1
+    header['type'] = LINESTRING_Z
+    header['npoints'] = counts
+    return join_headers(header.tobytes(), 9, as_doubles(xyz, scale, transform), counts)
+
+def polygons_wkb(xyz, counts, scale=0.01, transform=None):
+    """Return a list of PolygonZ WKB, each with a (closed) ring of the next counts[i] rows of xyz"""
+    counts = np.asarray(counts, dtype=np.int64)
+    header = np.zeros(len(counts), dtype=polygon_header_dtype)
+    header['order'] = 1
+    header['type'] = POLYGON_Z
+    header['nrings'] = 1
+    header['npoints'] = counts
+    return join_headers(header.tobytes(), 13, as_doubles(xyz, scale, transform), counts)
+
+def join_headers(headers, size, points, counts):
+    """Put each header of the given size together with its points"""
+    stops = (24 * np.cumsum(counts)).tolist()
+    starts = [0] + stops[:-1]
+    return [headers[i:i + size] + points[start:stop]
+            for i, start, stop in zip(range(0, len(headers), size), starts, stops)]
+
+def run_vertices(xyz_pairs, runs):
+    """Return (vertices, counts) for the line strings through runs of legs
+
+    xyz_pairs holds the from and to positions of each leg, and runs
+    the (start, stop) of each run, as from Survex3D.leg_runs().  The
+    vertices are the from position of the first leg in each run,
+    followed by the to positions of all the legs in it.
+    """
+    starts, stops = runs['start'], runs['stop']
+    nruns, nlegs = len(runs), len(xyz_pairs)
+    which = np.repeat(np.arange(nruns), stops - starts) # run for each leg
+    vertices = np.empty((nlegs + nruns, 3), dtype=xyz_pairs.dtype)
+    vertices[starts + np.arange(nruns)] = xyz_pairs[starts, 0]
+    vertices[np.arange(nlegs) + which + 1] = xyz_pairs[:, 1]
+    return vertices, stops - starts + 1
@@ -25,75 +25,51 @@ Copyright (C) 2008-2012 Thomas Holder, http://sf.net/users/speleo3/
 """
 
 from PyQt4.QtCore import QSettings, QTranslator, qVersion, QCoreApplication
-from PyQt4.QtCore import QVariant, QDate, QFileInfo, Qt
-from PyQt4.QtGui import QAction, QIcon, QFileDialog, QProgressBar
-from qgis.core import QGis, QgsPointV2, QgsPolygonV2, QgsLineStringV2
+from PyQt4.QtCore import QVariant, QDate, QFileInfo, Qt, QThread
+from PyQt4.QtGui import QAction, QIcon, QFileDialog, QInputDialog, QProgressBar, QPushButton
+from qgis.core import QGis
 from qgis.core import QgsFeature, QgsField, QgsGeometry, QgsVectorLayer
-from qgis.core import QgsMapLayerRegistry, QgsWKBTypes, QgsVectorFileWriter
-from qgis.core import QgsMessageLog
+from qgis.core import QgsMapLayerRegistry, QgsVectorFileWriter
+from qgis.core import QgsMessageLog, QgsMapLayer
 from qgis.gui import QgsMessageBar
 
 import resources # Initialize Qt resources from file resources.py
 
-from survex_import_dialog import SurvexImportDialog # Import the code for the dialog
+from survex_import_task import ImportWorker # for importing in a background thread
+from survex_import_session import ImportSession, Imported # the decoded files behind the layers
+from survex3d_timing import PhaseTimer # optional timing of each phase
 
-from osgeo import osr # spatial reference system API
-from osgeo import ogr # GDAL vector layer API
-from struct import unpack # from binary, read from .3d file
-from re import search # for matching and extracting substrings
-from math import log10, floor, sqrt
+# The dialog (survex_import_dialog), the .3d file decoder and layers
+# (survex3d, survex3d_cache and survex3d_layers, with numpy), and the
+# bulk GeoPackage writer (survex3d_gpkg, with the GDAL bindings) are
+# only imported where first used, in the methods below, so that they
+# add nothing to QGIS startup for those who don't use the plugin.
 
-import os # used for file system operations
-
-class SurvexImport:
-    """QGIS Plugin Implementation."""
-
-    # The following are some dictionaries for flags in the .3d file
-
-    station_attr = {0x01:'SURFACE', 0x02:'UNDERGROUND', 0x04:'ENTRANCE',
-                    0x08:'EXPORTED', 0x10:'FIXED', 0x20:'ANON'}
-
-    leg_attr = {0x01:'SURFACE', 0x02:'DUPLICATE', 0x04:'SPLAY'}
+from collections import namedtuple
 
-    style_type = {0x00:'NORMAL', 0x01:'DIVING', 0x02:'CARTESIAN',
-                  0x03:'CYLPOLAR', 0x04:'NOSURVEY', 0xff:'NOSTYLE'}
-
-    # lists of keys of above, sorted to restore ordering
-
-    station_flags = sorted(station_attr.keys())
-    leg_flags = sorted(leg_attr.keys())
-
-    # field names if there is error data
-
-    error_fields = ('ERROR_VERT', 'ERROR_HORIZ', 'ERROR', 'LENGTH')
-
-    # map from QGIS geometry type to OGR geometry type with z dimension
-
-    ogr_vec_type = {QGis.WKBPoint: ogr.wkbPoint25D,
-                    QGis.WKBLineString: ogr.wkbLineString25D,
-                    QGis.WKBPolygon: ogr.wkbPolygon25D}
+import os # used for file system operations
+import shutil
+import tempfile
 
-    # map from QGIS field type to OGR field type
+# The changes to bring the features from one source (.3d file) in
+# an imported layer up to date, worked out in the background and
+# made in the main thread: the feature ids to delete, maps from
+# feature ids to new geometries and attributes, the features to add,
+# and their indices among the features from the source
 
-    ogr_type = {QVariant.Int: ogr.OFTInteger,
-                QVariant.Double: ogr.OFTReal,
-                QVariant.String: ogr.OFTString,
-                QVariant.Date: ogr.OFTDate}
+Update = namedtuple('Update', 'name source layer_id delete geometries attributes features add')
 
-    # replacements needed for QGIS geometry WKT, indexed by OGR geometry type
+# An import running in the background, with its progress bar
 
-    wkt_replace = {ogr.wkbPoint25D: ('PointZ', 'POINT'),
-                   ogr.wkbLineString25D: ('LineStringZ', 'LINESTRING'),
-                   ogr.wkbPolygon25D: ('PolygonZ', 'POLYGON')}
+Running = namedtuple('Running', 'worker thread message progress_bar')
 
-    leg_list = [] # accumulates legs + metadata
-    station_list = [] # ditto stations
-    xsect_list = [] # ditto for cross sections for walls
+class SurvexImport:
+    """QGIS Plugin Implementation."""
 
-    station_xyz = {} # map station names to xyz coordinates
+    # map from field types in survex3d_layers to QGIS field types
 
-    epsg = None # used to set layer CRS in memory provider
-    title = '' # used to set layer title in memory provider
+    qgis_type = {'Int': QVariant.Int, 'Double': QVariant.Double,
+                 'String': QVariant.String, 'Date': QVariant.Date}
 
     path_3d = '' # to remember the path to the survex .3d file
     path_gpkg = '' # ditto for path to save GeoPackage (.gpkg)
@@ -101,6 +77,11 @@ class SurvexImport:
     def __init__(self, iface):
         """Constructor"""
         self.iface = iface # Save reference to the QGIS interface
+        self.sessions = [] # ImportSessions with layers in QGIS, the latest last
+        self.running = [] # imports running in the background
+        self.cache = None # DecodeCache of decoded .3d files in the user cache directory, made on first use
+        self.temporary_dirs = [] # holding GeoPackages which layers are served from
+        self.timing = None # phases of the last import, as PhaseTimer.as_dict(), if logged
         self.plugin_dir = os.path.dirname(__file__) # initialize plugin directory
         locale = QSettings().value('locale/userLocale')[0:2] # initialize locale
         locale_path = os.path.join(
@@ -121,10 +102,17 @@ class SurvexImport:
         self.toolbar = self.iface.addToolBar(u'SurvexImport')
         self.toolbar.setObjectName(u'SurvexImport')
 
+        self.dlg = None # built on first use, by create_dialog()
+
+    def create_dialog(self):
+        """Build the dialog, and wire up its signals"""
+        from survex_import_dialog import SurvexImportDialog
+
         self.dlg = SurvexImportDialog()
-        
+
         self.dlg.selectedFile.clear()
         self.dlg.fileSelector.clicked.connect(self.select_3d_file)
+        self.dlg.selectedFile.editingFinished.connect(self.preview_3d_file)
         
         self.dlg.selectedGPKG.clear()
         self.dlg.GPKGSelector.clicked.connect(self.select_gpkg)
@@ -135,6 +123,14 @@ class SurvexImport:
         self.dlg.CRSFromFile.setChecked(False)
         self.dlg.CRSFromProject.clicked.connect(self.crs_from_project)
 
+        self.dlg.Reproject.setChecked(False)
+        self.dlg.Reproject.clicked.connect(self.reproject)
+
+        self.dlg.KeepFeatures.clicked.connect(self.keep_features)
+
+        self.dlg.UpdateFeatures.setChecked(False)
+        self.dlg.UpdateFeatures.clicked.connect(self.update_features)
+
     # noinspection PyMethodMayBeStatic
     def tr(self, message):
         """Get the translation for a string using Qt translation API."""
@@ -181,6 +177,13 @@ class SurvexImport:
             text=self.tr(u'Import features from .3d files'),
             callback=self.run,
             parent=self.iface.mainWindow())
+        self.add_action(
+            icon_path,
+            text=self.tr(u'Remove the features from an imported .3d file'),
+            callback=self.remove_source,
+            add_to_toolbar=False,
+            parent=self.iface.mainWindow())
+        QgsMapLayerRegistry.instance().layersRemoved.connect(self.layers_removed)
 
 
     def unload(self):
@@ -192,22 +195,139 @@ class SurvexImport:
             self.iface.removeToolBarIcon(action)
         # remove the toolbar
         del self.toolbar
+        QgsMapLayerRegistry.instance().layersRemoved.disconnect(self.layers_removed)
+        # stop any imports running in the background
+        for running in self.running:
+            running.worker.kill()
+            running.thread.quit()
+            running.thread.wait()
+        self.running = []
+        # let go of the decoded .3d files
+        for session in self.sessions:
+            session.release()
+        self.sessions = []
+        # remove temporary GeoPackages (QGIS may still hold some open)
+        for directory in self.temporary_dirs:
+            shutil.rmtree(directory, ignore_errors=True)
+        self.temporary_dirs = []
+
+    def layers_removed(self, layer_ids):
+        """Drop the sessions which no longer have any layers in QGIS, freeing their memory"""
+        registered = QgsMapLayerRegistry.instance().mapLayers()
+        for session in list(self.sessions):
+            if not any(layer_id in registered for layer_id in session.layer_ids()):
+                self.sessions.remove(session)
+                msg = "Released '%s' (%.1f MB)" % (session.title, session.nbytes / 1e6)
+                session.release()
+                QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+
+    def remove_source(self):
+        """Ask which imported .3d file to remove, and remove its features"""
+        if self.running:
+            self.iface.messageBar().pushMessage('Busy', 'Wait for the running import to finish',
+                                                level=QgsMessageBar.WARNING, duration=5)
+            return
+        choices = [(session, source) for session in self.sessions for source in session.sources]
+        if not choices:
+            self.iface.messageBar().pushMessage('Remove', 'No .3d files have been imported',
+                                                level=QgsMessageBar.INFO, duration=5)
+            return
+        items = ['%s (%s)' % (source, session.title) for session, source in choices]
+        item, ok = QInputDialog.getItem(self.iface.mainWindow(), 'Remove .3d file',
+                                        'Remove the features from', items, 0, False)
+        if ok:
+            self.drop_source(*choices[items.index(item)])
+
+    def drop_source(self, session, source):
+        """Remove the features from one .3d file from the layers of a session
+
+        Only the features from the source are touched, as the session
+        knows their feature ids in each layer.
+        """
+        nbytes = session.source_nbytes(source)
+        registry = QgsMapLayerRegistry.instance()
+        nfeatures = 0
+        for layer_id, fids in session.remove_source(source).items():
+            layer = registry.mapLayer(layer_id)
+            if layer is not None and fids:
+                layer.dataProvider().deleteFeatures(fids)
+                layer.updateExtents()
+                layer.triggerRepaint()
+                nfeatures += len(fids)
+        if not session.sources:
+            self.sessions.remove(session)
+        msg = "Removed %s from '%s': %i features, %.1f MB" % (source, session.title, nfeatures, nbytes / 1e6)
+        QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
 
     def crs_from_file(self):
         """Enforce consistent CRS selector state"""
         if self.dlg.CRSFromFile.isChecked():
             self.dlg.CRSFromProject.setChecked(False)
+            self.dlg.Reproject.setChecked(False)
 
     def crs_from_project(self):
         """Enforce consistent CRS selector state"""
         if self.dlg.CRSFromProject.isChecked():
             self.dlg.CRSFromFile.setChecked(False)
+            self.dlg.Reproject.setChecked(False)
+
+    def reproject(self):
+        """Enforce consistent CRS selector state"""
+        if self.dlg.Reproject.isChecked():
+            self.dlg.CRSFromFile.setChecked(False)
+            self.dlg.CRSFromProject.setChecked(False)
+
+    def keep_features(self):
+        """Enforce consistent keep / update selector state"""
+        if self.dlg.KeepFeatures.isChecked():
+            self.dlg.UpdateFeatures.setChecked(False)
+
+    def update_features(self):
+        """Enforce consistent keep / update selector state"""
+        if self.dlg.UpdateFeatures.isChecked():
+            self.dlg.KeepFeatures.setChecked(False)
 
     def select_3d_file(self):
         """Select 3d file"""
         file_3d = QFileDialog.getOpenFileName(self.dlg, "Select .3d file ", self.path_3d, '*.3d')
         self.dlg.selectedFile.setText(file_3d)
         self.path_3d = QFileInfo(file_3d).path() # memorise path selection
+        self.preview_3d_file()
+
+    def preview_3d_file(self):
+        """Show a summary of the selected .3d file, from a quick scan"""
+        from survex3d import scan_3d, find_3d_files
+        file_3d = self.dlg.selectedFile.text()
+        if os.path.isdir(file_3d): # just count the files for a batch import
+            nfiles = len(list(find_3d_files([file_3d])))
+            self.dlg.preview.setText('%i .3d files, to be imported together' % nfiles)
+            return
+        if not os.path.isfile(file_3d):
+            self.dlg.preview.clear()
+            return
+        try:
+            summary = scan_3d(file_3d)
+        except (IOError, OSError, ValueError) as e: # not a .3d file, or truncated
+            self.dlg.preview.setText(str(e))
+            return
+        lines = [summary.title + (' (%s)' % summary.cs if summary.cs else '')]
+        if summary.extended:
+            lines[0] += ', extended elevation (cannot be imported)'
+        lines.append('%i legs (%i splay, %i surface, %i duplicate), %i stations (%i entrances), '
+                     '%i xsects' % (summary.legs, summary.splay_legs, summary.surface_legs,
+                                    summary.duplicate_legs, summary.stations, summary.entrances,
+                                    summary.xsects))
+        extra = []
+        if summary.date1 is not None:
+            date0 = QDate(1900, 1, 1)
+            extra.append('dated %s to %s' % (date0.addDays(summary.date1).toString('yyyy-MM-dd'),
+                                             date0.addDays(summary.date2).toString('yyyy-MM-dd')))
+        if summary.bbox:
+            size = [hi - lo for lo, hi in zip(*summary.bbox)]
+            extra.append('extent %.0f x %.0f x %.0f m' % tuple(size))
+        if extra:
+            lines.append(', '.join(extra))
+        self.dlg.preview.setText('\n'.join(lines))
 
     def select_gpkg(self):
         """Select GeoPackage (.gpkg)"""
@@ -216,35 +336,62 @@ class SurvexImport:
         self.dlg.selectedGPKG.setText(file_gpkg)
         self.path_gpkg = QFileInfo(file_gpkg).path() # memorise path selection
 
-    # First try to extract an explicit EPSG number, otherwise try
-    # assuming the string is PROJ.4.  The reason for this somewhat
-    # convoluted route is to ensure if there is an EPSG number in the
-    # passed string, it is returned 'as is' and not transmuted into
-    # another EPSG number with ostensibly the same CRS.
+    def region(self):
+        """Return (bbox, polygon, crs) for the region of interest selected in the dialog
+
+        The crs is the CRS the region is given in (as 'epsg:4326'), or
+        None if it is in the coordinates of the .3d file.  The canvas
+        extent is in the project CRS, as is a bounding box typed in if
+        the coordinates are to be transformed to the project CRS.
+        """
+        authid = self.iface.mapCanvas().mapRenderer().destinationCrs().authid()
+        project_crs = authid.lower() if authid.startswith('EPSG:') else None
+        choice = self.dlg.Region.currentIndex()
+        if choice == 1: # map canvas extent
+            extent = self.iface.mapCanvas().extent()
+            return (extent.xMinimum(), extent.yMinimum(),
+                    extent.xMaximum(), extent.yMaximum()), None, project_crs
+        if choice == 2: # selected polygons in the current layer
+            layer = self.iface.activeLayer()
+            if (layer is None or layer.type() != QgsMapLayer.VectorLayer
+                or layer.geometryType() != QGis.Polygon):
+                raise Exception("Select polygons in the current layer to use as the region")
+            authid = layer.crs().authid()
+            if not authid.startswith('EPSG:'):
+                raise Exception("Layer '%s' needs an EPSG CRS to use as the region" % layer.name())
+            rings = []
+            for feat in layer.selectedFeatures():
+                geom = feat.geometry()
+                for polygon in geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]:
+                    rings.extend([(p.x(), p.y()) for p in ring] for ring in polygon)
+            if not rings:
+                raise Exception("No polygons selected in layer '%s'" % layer.name())
+            return None, rings, authid.lower()
+        if choice == 3: # bounding box given as text
+            try:
+                bbox = tuple(float(v) for v in self.dlg.BoundingBox.text().replace(',', ' ').split())
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                raise Exception("Bounding box should be xmin ymin xmax ymax")
+            return bbox, None, project_crs if self.dlg.Reproject.isChecked() else None
+        return None, None, None # whole file
 
     def extract_epsg(self, s):
-        """Extract EPSG number from string"""
-        srs = osr.SpatialReference()
-        match = search('epsg:([0-9]*)', s)
-        if match:
-            return_code = srs.ImportFromEPSG(int(match.group(1)))
-        else:
-            return_code = srs.ImportFromProj4(s)
-        if return_code:
-            raise Exception("Invalid proj4 string: " + s)
-        code = srs.GetAttrValue('AUTHORITY', 1)
-        srs = None
-        self.epsg = int(code)
-        msg = "%s --> EPSG:%i" % (s, self.epsg)
+        """Extract EPSG number from string, as survex3d_gpkg.epsg_from_cs()"""
+        from survex3d_gpkg import epsg_from_cs
+        epsg = epsg_from_cs(s)
+        msg = "%s --> EPSG:%i" % (s, epsg)
         QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+        return epsg
 
     # Note that 'PointZ', 'LineStringZ', 'PolygonZ' are not possible
     # in QGIS 2.18 However the z-dimension data is respected.
 
-    def add_layer(self, subtitle, geom):
+    def add_layer(self, title, subtitle, geom, epsg):
         """Add a memory layer with title and geom, and CRS if epsg defined"""
-        uri = '%s?crs=epsg:%i' % (geom, self.epsg) if self.epsg else geom
-        name = '%s - %s' % (self.title, subtitle) if self.title else subtitle
+        uri = '%s?crs=epsg:%i' % (geom, epsg) if epsg else geom
+        name = '%s - %s' % (title, subtitle) if title else subtitle
         layer =  QgsVectorLayer(uri, name, 'memory')
         if not layer.isValid():
             raise Exception("Invalid layer with %s" % uri)
@@ -252,32 +399,522 @@ class SurvexImport:
         QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
         return layer
 
-    def read_xyz(self, fp):
-        """Read xyz as integers, according to .3d spec""" 
-        return unpack('<iii', fp.read(12))
-        
-    def read_len(self, fp):
-        """Read a number as a length according to .3d spec"""
-        byte = ord(fp.read(1))
-        if byte != 0xff:
-            return byte
+    def gpkg_layer(self, path, title, subtitle):
+        """Open a layer (legs, stations, etc) from a GeoPackage, served by OGR"""
+        uri = '%s|layername=%s' % (path, subtitle)
+        name = '%s - %s' % (title, subtitle) if title else subtitle
+        layer = QgsVectorLayer(uri, name, 'ogr')
+        if not layer.isValid():
+            raise Exception("Invalid layer with %s" % uri)
+        msg = "GeoPackage layer '%s' called '%s' added" % (uri, name)
+        QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+        return layer
+
+    def temporary_gpkg(self, name):
+        """Return a path for a GeoPackage named after a file, in a new temporary directory removed on unload"""
+        directory = tempfile.mkdtemp(prefix='survex3d-')
+        self.temporary_dirs = self.temporary_dirs + [directory]
+        return os.path.join(directory, os.path.splitext(os.path.basename(name))[0] + '.gpkg')
+
+    def wkb_features(self, wkbs, attrs_list, report, message):
+        """Return features with geometries from a list of WKB, and the corresponding attributes"""
+        features = []
+        n = len(attrs_list)
+        for i, (wkb, attrs) in enumerate(zip(wkbs, attrs_list)):
+            if i % 1000 == 0:
+                report(message, i, n)
+            geom = QgsGeometry()
+            geom.fromWkb(wkb)
+            feat = QgsFeature()
+            feat.setGeometry(geom)
+            feat.setAttributes(attrs)
+            features.append(feat)
+        return features
+
+    def qgis_rows(self, fields, rows, dates):
+        """Return rows of attributes with dates (days since 1900.01.01) as QDates
+
+        The QDates are cached in dates, as there are few distinct ones.
+        """
+        date_fields = [i for i, (name, kind) in enumerate(fields) if kind == 'Date']
+        if not date_fields:
+            return rows
+        date0 = QDate(1900, 1, 1)
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i in date_fields:
+                days = row[i]
+                if days not in dates:
+                    dates[days] = date0.addDays(days)
+                row[i] = dates[days]
+        return rows
+
+    def layer_update(self, layer_id, source, old_digest, old_fids, b, new_digest, dates, report):
+        """Work out the changes to bring the features from a source up to date, as an Update
+
+        The source has features with old_fids in the layer, as given
+        by old_digest.  Also return the feature ids of the new features
+        b, in order, with None for those yet to be added.
+        """
+        from survex3d_layers import diff_layer
+        patch = diff_layer(old_digest, new_digest)
+        fids = [None] * len(b.rows)
+        for i, j in patch.same + patch.change:
+            fids[j] = old_fids[i]
+        geometries, attributes = {}, {}
+        rows = self.qgis_rows(b.fields, [b.rows[j] for i, j in patch.change], dates)
+        for (i, j), row in zip(patch.change, rows):
+            geom = QgsGeometry()
+            geom.fromWkb(b.wkbs[j])
+            geometries[old_fids[i]] = geom
+            attributes[old_fids[i]] = dict(enumerate(row))
+        rows = self.qgis_rows(b.fields, [b.rows[j] for j in patch.add], dates)
+        features = self.wkb_features([b.wkbs[j] for j in patch.add], rows, report, 'Updating ' + b.name)
+        delete = [old_fids[i] for i in patch.delete]
+        return Update(b.name, source, layer_id, delete, geometries, attributes, features, patch.add), fids
+
+    def import_3d(self, report, survex3dfiles, batch_name, gpkg_file, include_legs, merge_legs,
+                  include_stations, include_polygons, include_walls, include_xsections,
+                  include_traverses, exclude_surface_legs, exclude_splay_legs,
+                  exclude_duplicate_legs, exclude_surface_stations, use_clino_wgt,
+                  include_up_down, include_derived, include_surveys, exclude_surveys, dates, styles,
+                  bbox, polygon, region_crs, get_crs_from_file, project_epsg, reproject, file_backed,
+                  session, previous_layers, timer):
+        """Decode .3d files, build the layers, and save them, in the worker thread
+
+        Several files (a batch, named by batch_name) are imported
+        together, as if one after the other with previous features
+        kept.  If reproject is set, the coordinates are transformed
+        from the CS in each file to the project CRS (project_epsg).
+        The region (bbox and polygon) is in region_crs, if given, and
+        is transformed to the CRS of the coordinates in each file.
+        If session is given, the import builds on it, keeping
+        its features, or updating those of the previous_layers
+        (Imported, by name) in place.  This reports progress and may
+        be cancelled (by report), so it only reads the session and
+        plugin state.  It returns (layers, updates, replaced, new
+        session, session, gpkg_file, timer), for finish_import() to
+        add to QGIS, where replaced are the ids of previous layers
+        which new layers take the place of, and the phases so far
+        are timed by timer (a PhaseTimer).
+        """
+
+        from survex3d_layers import Layer, layer_names, build_layers, concat_layers, pad_layer
+        from survex3d_layers import Digest, digest
+        from survex3d_gpkg import write_layers, coordinate_transform, transform_region
+        from survex3d import open_3d, source_names
+
+        # Decode each .3d file in a single pass, or fetch it from
+        # the cache if it hasn't changed, and save data structures.
+        # Under QGIS the files are decoded one after the other, since
+        # multiprocessing would start QGIS itself on Windows, but the
+        # cache makes light work of importing a batch again.
+
+        surveys = list(session.surveys) if session else []
+        sources = list(session.sources) if session else []
+        names = list(session.names) if session else []
+        title = session.title if session else ''
+        new_titles, cs_list = [], []
+        batch_names = dict(zip(survex3dfiles, source_names(survex3dfiles)))
+
+        region_epsg = self.extract_epsg(region_crs) if region_crs else None
+
+        for k, survex3dfile in enumerate(survex3dfiles):
+
+            msg = 'Reading ' + QFileInfo(survex3dfile).fileName()
+            if len(survex3dfiles) > 1:
+                msg += ' (%i of %i)' % (k + 1, len(survex3dfiles))
+
+            # A region given in some CRS is transformed to the CRS of
+            # the coordinates in the file: the project CRS if that is
+            # used for them, otherwise the CS in the file, if there is
+            # one (which is always the case when reprojecting)
+
+            file_bbox, file_polygon = bbox, polygon
+            if region_epsg:
+                if project_epsg and not reproject:
+                    data_epsg = project_epsg
+                else:
+                    with open_3d(survex3dfile) as (header, buf):
+                        data_epsg = self.extract_epsg(header.cs) if header.cs else None
+                if data_epsg and data_epsg != region_epsg:
+                    file_bbox, file_polygon = transform_region(bbox, polygon,
+                                                               coordinate_transform(region_epsg, data_epsg))
+
+            with timer.phase('decode') as counts:
+                decoded, cached = self.cache.decode_3d(survex3dfile,
+                                               progress=lambda pos, n, msg=msg: report(msg, pos, n),
+                                               exclude_surface_legs=exclude_surface_legs,
+                                               exclude_duplicate_legs=exclude_duplicate_legs,
+                                               exclude_splay_legs=exclude_splay_legs,
+                                               exclude_surface_stations=exclude_surface_stations,
+                                               include_surveys=include_surveys,
+                                               exclude_surveys=exclude_surveys,
+                                               dates=dates, styles=styles,
+                                               bbox=file_bbox, polygon=file_polygon)
+                counts['count'] = len(decoded.legs) + len(decoded.stations) + len(decoded.xsects)
+
+            how = 'Loaded from cache' if cached else 'Decoded'
+            QgsMessageLog.logMessage('%s %s' % (how, survex3dfile), tag='Import .3d', level=QgsMessageLog.INFO)
+
+            if decoded.header.cs:
+                cs_list.append(decoded.header.cs)
+
+            # The new version of a .3d file which has been imported
+            # before takes the place of the old one, otherwise it is
+            # added to (or replaces) what has been imported so far
+
+            if survex3dfile in sources:
+                surveys[sources.index(survex3dfile)] = decoded
+            else:
+                surveys.append(decoded)
+                sources.append(survex3dfile)
+                name = batch_names[survex3dfile] # the full path if already taken
+                names.append(survex3dfile if name in names else name)
+                new_titles.append(decoded.header.title)
+
+        if new_titles:
+            new_title = batch_name or ' + '.join(new_titles)
+            title = title + ' + ' + new_title if title else new_title
+
+        # Try to work out EPSG number from CS string if available,
+        # unless the project CRS is being used.  A batch should all
+        # be in the same CS, and the first one found is used.
+
+        if project_epsg:
+            epsg = project_epsg
+        elif get_crs_from_file and cs_list:
+            epsg = self.extract_epsg(cs_list[0])
+            if len(set(cs_list)) > 1:
+                msg = 'The .3d files have different CS, using ' + cs_list[0]
+                QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.WARNING)
         else:
-            return unpack('<I', fp.read(4))[0]
-
-    def read_label(self, fp, current_label):
-        """Read a string as a label, or part thereof, according to .3d spec"""
-        byte = ord(fp.read(1))
-        if byte != 0x00:
-            ndel = byte >> 4
-            nadd = byte & 0x0f
+            epsg = None
+
+        # If asked, the coordinates from each file are transformed
+        # from its own CS as the layers are built, with all of them
+        # passed to OSR at once for each layer
+
+        transforms = {} # by (source, target) EPSG number
+
+        def transform_for(k):
+            if not reproject:
+                return None
+            if not surveys[k].header.cs:
+                raise Exception("No CS in '%s' to transform from" % sources[k])
+            key = self.extract_epsg(surveys[k].header.cs), epsg
+            if key[0] == key[1]: # nothing to do
+                return None
+            if key not in transforms:
+                transforms[key] = coordinate_transform(*key)
+            return transforms[key]
+
+        # Now build the layers, only if required and data is
+        # available, and create the corresponding memory layers in
+        # QGIS.  The geometries are already encoded as WKB.  If the
+        # layers are to be served from a GeoPackage, the memory
+        # layers are skipped, and OGR serves features from the file
+        # as QGIS asks for them (using the spatial index for extents).
+
+        # The layers are built for each source (.3d file) separately
+        # and then joined up, so that the features from each source
+        # can be told apart, and are only built for the sources which
+        # are needed.  If there are (or have been) several sources,
+        # each feature has a SOURCE field with the name of the .3d file,
+        # relative to the directory of the batch it came in.
+
+        report('Building layers', 0, 1)
+
+        with_source = len(sources) > 1 or any(('SOURCE', 'String') in previous.fields
+                                              for previous in previous_layers.values())
+        source_layers = {}
+
+        def layers_for(k):
+            if sources[k] not in source_layers:
+                with timer.phase('build layers') as counts:
+                    source_layers[sources[k]] = build_layers(
+                        [surveys[k]], include_legs=include_legs, include_stations=include_stations,
+                        include_traverses=include_traverses, include_xsections=include_xsections,
+                        include_walls=include_walls, include_polygons=include_polygons,
+                        merge_legs=merge_legs, use_clino_wgt=use_clino_wgt,
+                        include_up_down=include_up_down, sources=[names[k]] if with_source else None,
+                        transform=transform_for(k), include_derived=include_derived)
+                    counts['count'] = sum(len(b.rows) for b in source_layers[sources[k]])
+            return dict((b.name, b) for b in source_layers[sources[k]])
+
+        dates = {} # cache the QDates, as there are few distinct ones
+
+        # Layers which were imported before, with the same fields,
+        # are updated in place: only the features from the sources
+        # just read are looked at, and of these only the ones which
+        # differ are changed, so the rest keep their feature ids (and
+        # anything QGIS attaches to them).  The feature ids of
+        # features yet to be added are filled in by finish_import().
+
+        included = {'stations': include_stations, 'legs': include_legs,
+                    'traverses': include_traverses, 'xsections': include_xsections,
+                    'walls': include_walls, 'polygons': include_polygons}
+
+        fresh_names = set(name for name in layer_names if included[name]) - set(previous_layers)
+        changed = [sources.index(survex3dfile) for survex3dfile in survex3dfiles]
+
+        # If the fields have changed (error data has appeared after
+        # loop closure, say) the layer is built afresh, and replaces
+        # the previous one, which is removed by finish_import()
+
+        updates, imported, replaced = [], {}, []
+
+        for name, previous in previous_layers.items():
+            padded = {}
+            for k in changed:
+                b = layers_for(k).get(name) or Layer(name, None, previous.fields, [], [])
+                padded[sources[k]] = pad_layer(b, previous.fields)
+            if None in padded.values(): # the fields have changed
+                fresh_names.add(name)
+                replaced.append(previous.layer_id)
+                continue
+            digests, fids = dict(previous.digests), dict(previous.fids)
+            for source, b in padded.items():
+                with timer.phase('diff features') as counts:
+                    digests[source] = digest(b)
+                    old = previous.digests.get(source) or Digest(previous.fields, [], [])
+                    update, fids[source] = self.layer_update(previous.layer_id, source, old,
+                                                             previous.fids.get(source, []),
+                                                             b, digests[source], dates, report)
+                    counts['count'] = len(b.rows)
+                updates.append(update)
+            imported[name] = Imported(previous.layer_id, previous.fields, previous.path, digests, fids)
+
+        # Other layers are built afresh from all the sources, as are
+        # all the layers if a GeoPackage is to be saved
+
+        if fresh_names or gpkg_file:
+            lists = [[b for b in layers_for(k).values() if gpkg_file or b.name in fresh_names]
+                     for k in range(len(sources))]
+            with timer.phase('join layers') as counts:
+                built = concat_layers(lists)
+                counts['count'] = sum(len(b.rows) for b in built)
         else:
-            ndel = self.read_len(fp)
-            nadd = self.read_len(fp)
-        oldlen = len(current_label)
-        return current_label[:oldlen - ndel] + fp.read(nadd).decode('ascii')
+            built = []
+
+        fresh = [b for b in built if b.name in fresh_names]
+
+        def fresh_imported(layer_id, b, fids, path):
+            """Split the features of a fresh layer by source, as Imported"""
+            digests, by_source = {}, {}
+            with timer.phase('digest features') as counts:
+                for k, source in enumerate(sources):
+                    part = layers_for(k).get(b.name)
+                    n = len(part.rows) if part else 0
+                    by_source[source], fids = fids[:n], fids[n:]
+                    digests[source] = digest(pad_layer(part, b.fields)) if part else Digest(b.fields, [], [])
+                counts['count'] = len(b.rows)
+            return Imported(layer_id, b.fields, path, digests, by_source)
+
+        layers = [] # used to keep a list of the created layers
+
+        for b in ([] if file_backed else fresh):
+            layer = self.add_layer(title, b.name, b.geom, epsg)
+            layer.dataProvider().addAttributes([QgsField(name, self.qgis_type[kind])
+                                                for name, kind in b.fields])
+            layer.updateFields()
+            with timer.phase('QgsFeature') as counts:
+                rows = self.qgis_rows(b.fields, b.rows, dates)
+                features = self.wkb_features(b.wkbs, rows, report, 'Building ' + b.name)
+                counts['count'] = len(features)
+            with timer.phase('addFeatures') as counts:
+                ok, features = layer.dataProvider().addFeatures(features)
+                counts['count'] = len(features)
+            with timer.phase('updateExtents') as counts:
+                layer.updateExtents()
+                counts['count'] = len(features)
+            layers.append(layer)
+            imported[b.name] = fresh_imported(layer.id(), b, [f.id() for f in features], '')
+
+        # Save layers to a GeoPackage if selected.
+
+        # QgsVectorFileWriter would be ideal but it can only write
+        # single layers (afaik!), so the GeoPackage layers, fields,
+        # and attributes are created using OGR calls, straight from
+        # the built layers.  The features are inserted in large
+        # transactions with the geometries passed through as WKB
+        # and the fields set by index, and the spatial index on
+        # each layer is built at the end.  Meanwhile, the user is
+        # appraised of progress through the report callback.
+
+        # A GeoPackage serving layers which are being updated is
+        # left alone, as it is updated in place, and if the layers
+        # are served from a GeoPackage, only the new ones are saved.
+
+        in_use = set(imported[update.name].path for update in updates)
+        saved = fresh if file_backed else built
+
+        if gpkg_file and gpkg_file in in_use:
+            msg = "%s is being updated in place, so it hasn't been saved afresh" % gpkg_file
+            QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+            gpkg_file = ''
+
+        path = gpkg_file or (self.temporary_gpkg(batch_name or survex3dfiles[0])
+                             if file_backed and saved else '')
+
+        if path:
+            nfeatures = sum(len(b.rows) for b in saved) # how many features in total
+            msg = 'Saving ' + QFileInfo(path).fileName()
+            report(msg, 0, nfeatures)
+            write_layers(path, saved, epsg, progress=lambda n: report(msg, n, nfeatures), timer=timer)
+
+        if file_backed: # feature ids in a new GeoPackage count from 1
+            with timer.phase('open layers') as counts:
+                layers = [self.gpkg_layer(path, title, b.name) for b in saved]
+                counts['count'] = len(layers)
+            for layer, b in zip(layers, saved):
+                imported[b.name] = fresh_imported(layer.id(), b, list(range(1, len(b.rows) + 1)), path)
+
+        # The layers now belong to the main thread, ready to be added to QGIS
+
+        main_thread = QCoreApplication.instance().thread()
+        [ layer.moveToThread(main_thread) for layer in layers ]
+
+        return (layers, updates, replaced, ImportSession(surveys, sources, title, epsg, imported, names),
+                session, gpkg_file, timer)
+
+    def start_import(self, work, message):
+        """Run work(report) in a background thread, with a progress bar and cancel button"""
+        worker = ImportWorker(work)
+        thread = QThread()
+        worker.moveToThread(thread)
+
+        progress_bar = QProgressBar()
+        progress_bar.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        cancel_button = QPushButton('Cancel')
+        cancel_button.clicked.connect(lambda: worker.kill()) # directly, as the worker thread is busy
+        progress_message = self.iface.messageBar().createMessage(message)
+        progress_message.layout().addWidget(progress_bar)
+        progress_message.layout().addWidget(cancel_button)
+        self.iface.messageBar().pushWidget(progress_message, self.iface.messageBar().INFO)
+
+        running = Running(worker, thread, progress_message, progress_bar)
+        self.running.append(running)
+
+        worker.progress.connect(lambda message, value, maximum:
+                                self.show_progress(running, message, value, maximum))
+        worker.finished.connect(lambda result: self.finish_import(running, result))
+        worker.cancelled.connect(lambda: self.cancel_import(running))
+        worker.error.connect(lambda trace: self.fail_import(running, trace))
+        thread.started.connect(worker.run)
+        thread.start()
+
+    def show_progress(self, running, message, value, maximum):
+        """Update the progress bar of a running import, in the main thread"""
+        running.message.setText(message)
+        running.progress_bar.setMaximum(maximum)
+        running.progress_bar.setValue(value)
+
+    def end_import(self, running):
+        """Wind up the background thread and remove the progress bar"""
+        running.thread.quit()
+        running.thread.wait()
+        self.iface.messageBar().popWidget(running.message)
+        self.running.remove(running)
+
+    def finish_import(self, running, result):
+        """Add the imported layers to QGIS, and update layers in place, all in the main thread"""
+        self.end_import(running)
+        layers, updates, replaced, session, base, gpkg_file, timer = result
+
+        if updates:
+            with timer.phase('apply updates') as counts:
+                for update in updates:
+                    self.apply_update(update, session.imported)
+                counts['count'] = sum(len(update.delete) + len(update.geometries) + len(update.features)
+                                      for update in updates)
+
+        if layers:
+            with timer.phase('addMapLayers') as counts:
+                QgsMapLayerRegistry.instance().addMapLayers(layers)
+                counts['count'] = len(layers)
+
+        # The new session takes over from the one it was built on
+
+        if base in self.sessions:
+            self.sessions.remove(base)
+        self.sessions.append(session)
+
+        # Layers whose fields have changed have been rebuilt, so the
+        # previous ones (which nothing refers to any more) are removed
+
+        registry = QgsMapLayerRegistry.instance()
+        replaced = [layer_id for layer_id in replaced if registry.mapLayer(layer_id) is not None]
+        if replaced:
+            names = ', '.join("'%s'" % registry.mapLayer(layer_id).name() for layer_id in replaced)
+            registry.removeMapLayers(replaced)
+            msg = 'Replaced %s, as the fields have changed' % names
+            QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+
+        msg = "Imported '%s' (%.1f MB), %i sessions held" % (session.title, session.nbytes / 1e6,
+                                                              len(self.sessions))
+        QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+
+        # The timings, if asked for, go to the log, and are kept for scripts
+
+        if timer.enabled:
+            for line in timer.lines():
+                QgsMessageLog.logMessage('Timing ' + line, tag='Import .3d', level=QgsMessageLog.INFO)
+            self.timing = dict(timer.as_dict(), title=session.title)
+
+        if gpkg_file:
+            msg = QFileInfo(gpkg_file).fileName() + ' to ' + QFileInfo(gpkg_file).path()
+            QgsMessageLog.logMessage('Saved ' + msg, tag='Import .3d', level=QgsMessageLog.INFO)
+            self.iface.messageBar().pushMessage('Saved', msg, level=QgsMessageBar.INFO, duration=5)
+
+    def apply_update(self, update, imported):
+        """Make the changes in an Update, and fill in the feature ids of the added features"""
+        layer = QgsMapLayerRegistry.instance().mapLayer(update.layer_id)
+        if layer is None: # removed while the import was running
+            imported.pop(update.name, None)
+            return
+        provider = layer.dataProvider()
+        if update.delete:
+            provider.deleteFeatures(update.delete)
+        if update.geometries:
+            provider.changeGeometryValues(update.geometries)
+        if update.attributes:
+            provider.changeAttributeValues(update.attributes)
+        if update.features:
+            ok, features = provider.addFeatures(update.features)
+            fids = imported[update.name].fids[update.source]
+            for j, feat in zip(update.add, features):
+                fids[j] = feat.id()
+        layer.updateExtents()
+        layer.triggerRepaint()
+        msg = "Updated '%s' from %s: %i features deleted, %i changed, %i added" % (
+            layer.name(), QFileInfo(update.source).fileName(), len(update.delete),
+            len(update.geometries), len(update.features))
+        QgsMessageLog.logMessage(msg, tag='Import .3d', level=QgsMessageLog.INFO)
+
+    def cancel_import(self, running):
+        """Report that the import was cancelled, leaving everything as it was"""
+        self.end_import(running)
+        self.iface.messageBar().pushMessage('Cancelled', 'Import of .3d file cancelled',
+                                            level=QgsMessageBar.INFO, duration=5)
+
+    def fail_import(self, running, trace):
+        """Report an error raised in the background thread"""
+        self.end_import(running)
+        QgsMessageLog.logMessage(trace, tag='Import .3d', level=QgsMessageLog.CRITICAL)
+        self.iface.messageBar().pushMessage('Error', 'Import of .3d file failed, see the log',
+                                            level=QgsMessageBar.CRITICAL)
+
+    def load_decoder(self):
+        """Make the cache of decoded .3d files, loading the decoder, in the main thread"""
+        if self.cache is None:
+            from survex3d_cache import DecodeCache
+            self.cache = DecodeCache()
 
     def run(self):
-        """Run method that performs all the real work"""
+        """Run method that shows the dialog and starts an import"""
+        if self.dlg is None:
+            self.create_dialog()
         self.dlg.show() # show the dialog
         result = self.dlg.exec_() # Run the dialog event loop
 
@@ -287,6 +924,7 @@ class SurvexImport:
             gpkg_file = self.dlg.selectedGPKG.text()
 
             include_legs = self.dlg.Legs.isChecked()
+            merge_legs = self.dlg.MergeLegs.isChecked()
             include_stations = self.dlg.Stations.isChecked()
             include_polygons = self.dlg.Polygons.isChecked()
             include_walls = self.dlg.Walls.isChecked()
@@ -301,8 +939,26 @@ class SurvexImport:
 
             use_clino_wgt = self.dlg.UseClinoWeights.isChecked()
             include_up_down = self.dlg.IncludeUpDown.isChecked()
+            include_derived = self.dlg.DerivedFields.isChecked()
 
             discard_features = not self.dlg.KeepFeatures.isChecked()
+            update_features = self.dlg.UpdateFeatures.isChecked()
+            reproject = self.dlg.Reproject.isChecked()
+            file_backed = self.dlg.FileBacked.isChecked()
+            log_phases = self.dlg.LogPhases.isChecked()
+
+            survey_names = self.dlg.SurveyFilter.text().split()
+            include_surveys = [s for s in survey_names if not s.startswith('-')]
+            exclude_surveys = [s[1:] for s in survey_names if s.startswith('-')]
+
+            from survex3d import parse_dates, parse_styles
+            try:
+                dates = parse_dates(self.dlg.DateFilter.text())
+                styles = parse_styles(self.dlg.StyleFilter.text())
+            except ValueError as e:
+                raise Exception(str(e))
+
+            bbox, polygon, region_crs = self.region()
             
             get_crs_from_file = self.dlg.CRSFromFile.isChecked()
             get_crs_from_project = self.dlg.CRSFromProject.isChecked()
@@ -310,525 +966,83 @@ class SurvexImport:
             if not os.path.exists(survex3dfile):
                 raise Exception("File '%s' doesn't exist" % survex3dfile)
 
-            if discard_features:
-                self.leg_list = []
-                self.station_list = []
-                self.station_xyz = {}
-                self.xsect_list = []
-
-            # Read .3d file as binary, parse, and save data structures
-            
-            with open(survex3dfile, 'rb') as fp:
-    
-                line = fp.readline().rstrip() # File ID check
-                
-                if not line.startswith(b'Survex 3D Image File'):
-                    raise IOError('Not a survex .3d file: ' + survex3dfile)
-
-                line = fp.readline().rstrip() # File format version
-                
-                if not line.startswith(b'v'):
-                    raise IOError('Unrecognised survex .3d version in ' + survex3dfile)
-                
-                version = int(line[1:])
-                if version < 8:
-                    raise IOError('Survex .3d version >= 8 required in ' + survex3dfile)
-
-                line = fp.readline().rstrip() # Metadata (title and coordinate system)
-                fields = line.split(b'\x00')
-
-                previous_title = '' if discard_features else self.title
-
-                if previous_title:
-                    self.title = previous_title + ' + ' + fields[0];
-                else:
-                    self.title = fields[0];
-
-                # Try to work out EPSG number from second field if available.
-                # The project_crs should end up as a lowercase string like 'epsg:27700'
-
-                if get_crs_from_project:
-                    project_crs = self.iface.mapCanvas().mapRenderer().destinationCrs()
-                    self.extract_epsg(project_crs.authid().lower())
-                elif get_crs_from_file and len(fields) > 1:
-                    self.extract_epsg(fields[1])
-                else:
-                    self.epsg = None
-
-                line = fp.readline().rstrip() # Timestamp, unused in present application
-
-                if not line.startswith(b'@'):
-                    raise IOError('Unrecognised timestamp in ' + survex3dfile)
-
-                # timestamp = int(line[1:])
-
-                flag = ord(fp.read(1)) # file-wide flag
-
-                if flag & 0x80: # abort if extended elevation
-                    raise IOError("Can't deal with extended elevation in " + survex3dfile)
-
-                # All front-end data read in, now read byte-wise
-                # according to .3d spec.  Note that all elements must
-                # be processed, in order, otherwise we get out of sync.
-
-                # We first define some baseline dates
-    
-                date0 = QDate(1900, 1, 1)
-                date1 = QDate(1900, 1, 1)
-                date2 = QDate(1900, 1, 1)
-
-                label, style = '', 0xff # initialise label and style
-                
-                legs = [] # will be used to capture leg data between MOVEs
-                xsect = [] # will be used to capture XSECT data
-                nlehv = None # .. remains None if there isn't any error data...
-
-                while True: # start of byte-gobbling while loop
-
-                    char = fp.read(1)
-
-                    if not char: # End of file (reached prematurely?)
-                        raise IOError('Premature end of file in ' + survex3dfile)
-
-                    byte = ord(char)
-
-                    if byte <= 0x05: # STYLE
-                        if byte == 0x00 and style == 0x00: # this signals end of data
-                            if legs: # there may be a pending list of legs to save
-                                self.leg_list.append((legs,  nlehv))
-                            break # escape from byte-gobbling while loop
-                        else:
-                            style = byte
-                
-                    elif byte <= 0x0e: # Reserved
-                        continue
-        
-                    elif byte == 0x0f: # MOVE
-                        xyz = self.read_xyz(fp)
-                        if legs:
-                            self.leg_list.append((legs,  nlehv))
-                            legs = []
-
-                    elif byte == 0x10: # DATE (none)
-                        date1 = date2 = date0
-                                    
-                    elif byte == 0x11: # DATE (single date)
-                        days = unpack('<H', fp.read(2))[0]
-                        date1 = date2 = date0.addDays(days)
-            
-                    elif byte == 0x12:  # DATE (date range, short format)
-                        days, extra = unpack('<HB', fp.read(3))
-                        date1 = date0.addDays(days)
-                        date2 = date0.addDays(days + extra + 1)
-
-                    elif byte == 0x13: # DATE (date range, long format)
-                        days1, days2 = unpack('<HH', fp.read(4)) 
-                        date1 = date0.addDays(days1)
-                        date2 = date0.addDays(days2)
-
-                    elif byte <= 0x1e: # Reserved
-                        continue
-        
-                    elif byte == 0x1f:  # Error info
-                        nlehv = unpack('<iiiii', fp.read(20))
-            
-                    elif byte <= 0x2f: # Reserved
-                        continue
-            
-                    elif byte <= 0x33: # XSECT
-                        label = self.read_label(fp, label)
-                        if byte & 0x02:
-                            lrud = unpack('<iiii', fp.read(16))
-                        else:
-                            lrud = unpack('<hhhh', fp.read(8))
-                        xsect.append((label, lrud))
-                        if byte & 0x01: # XSECT_END
-                            self.xsect_list.append(xsect)
-                            xsect = []
-            
-                    elif byte <= 0x3f: # Reserved
-                        continue
-        
-                    elif byte <= 0x7f: # LINE
-                        flag = byte & 0x3f
-                        if not (flag & 0x20):
-                            label = self.read_label(fp, label)
-                        xyz_prev = xyz
-                        xyz = self.read_xyz(fp)
-                        while (True): # code pattern to implement logic
-                            if exclude_surface_legs and flag & 0x01: break
-                            if exclude_duplicate_legs and flag & 0x02: break
-                            if exclude_splay_legs and flag & 0x04: break
-                            legs.append(((xyz_prev, xyz), label, style, date1, date2, flag))
-                            break
-
-                    elif byte <= 0xff: # LABEL (or NODE)
-                        flag = byte & 0x7f
-                        label = self.read_label(fp, label)
-                        xyz = self.read_xyz(fp)
-                        while (True): # code pattern to implement logic
-                            if exclude_surface_stations and flag & 0x01 and not flag & 0x02: break
-                            self.station_list.append((xyz, label, flag))
-                            break
-                        self.station_xyz[label] = xyz
-
-                # End of byte-gobbling while loop
-
-            # file closes automatically, with open(survex3dfile, 'rb') as fp:
-
-            # Now create the layers in QGIS.  Attributes are inserted
-            # like pushing onto a stack, so in reverse order.  Layers
-            # are created only if required and data is available.
-            # If nlehv is still None, then no error data has been provided.
-            
-            layers = [] # used to keep a list of the created layers
-
-            if include_stations and self.station_list: # station layer
-                
-                station_layer = self.add_layer('stations', 'Point')
-    
-                attrs = [QgsField(self.station_attr[k], QVariant.Int) for k in self.station_flags]
-                attrs.insert(0, QgsField('ELEVATION', QVariant.Double))
-                attrs.insert(0, QgsField('NAME', QVariant.String))
-                station_layer.dataProvider().addAttributes(attrs)
-                station_layer.updateFields() 
-    
-                features = []
-
-                for (xyz, label, flag) in self.station_list:
-                    xyz = [0.01*v for v in xyz]
-                    attrs = [1 if flag & k else 0 for k in self.station_flags]
-                    attrs.insert(0, round(xyz[2], 2)) # elevation
-                    attrs.insert(0, label)
-                    feat = QgsFeature()
-                    geom = QgsGeometry(QgsPointV2(QgsWKBTypes.PointZ, *xyz))
-                    feat.setGeometry(geom)
-                    feat.setAttributes(attrs)
-                    features.append(feat)
-                    
-                station_layer.dataProvider().addFeatures(features)
-                layers.append(station_layer)
-
-            if include_legs and self.leg_list: # leg layer
-                
-                leg_layer = self.add_layer('legs', 'LineString')
-                
-                attrs = [QgsField(self.leg_attr[k], QVariant.Int) for k in self.leg_flags]
-                if nlehv:
-                    [ attrs.insert(0, QgsField(s, QVariant.Double)) for s in self.error_fields ]
-                    attrs.insert(0, QgsField('NLEGS', QVariant.Int))
-                attrs.insert(0, QgsField('DATE2', QVariant.Date))
-                attrs.insert(0, QgsField('DATE1', QVariant.Date))
-                attrs.insert(0, QgsField('STYLE', QVariant.String))
-                attrs.insert(0, QgsField('ELEVATION', QVariant.Double))
-                attrs.insert(0, QgsField('NAME', QVariant.String))
-                leg_layer.dataProvider().addAttributes(attrs)
-                leg_layer.updateFields()
-                
-                features = []
-
-                for legs, nlehv in self.leg_list:
-                    for (xyz_pair, label, style, from_date, to_date, flag) in legs:
-                        elev = 0.5 * sum([0.01*xyz[2] for xyz in xyz_pair])
-                        points = []
-                        for xyz in xyz_pair:
-                            xyz = [0.01*v for v in xyz]
-                            points.append(QgsPointV2(QgsWKBTypes.PointZ, *xyz))
-                        attrs = [1 if flag & k else 0 for k in self.leg_flags]
-                        if nlehv:
-                            [ attrs.insert(0, 0.01*v) for v in reversed(nlehv[1:5]) ]
-                            attrs.insert(0, nlehv[0])
-                        attrs.insert(0, to_date)
-                        attrs.insert(0, from_date)
-                        attrs.insert(0, self.style_type[style])
-                        attrs.insert(0, round(elev, 2))
-                        attrs.insert(0, label)
-                        linestring = QgsLineStringV2()
-                        linestring.setPoints(points)
-                        feat = QgsFeature()
-                        geom = QgsGeometry(linestring)
-                        feat.setGeometry(geom) 
-                        feat.setAttributes(attrs)
-                        features.append(feat)
-                    
-                leg_layer.dataProvider().addFeatures(features)
-                layers.append(leg_layer)
-
-            # Now do wall features if asked
-            
-            if (include_traverses or include_xsections
-                or include_walls or include_polygons) and self.xsect_list:
-                                
-                trav_features = []
-                wall_features = []
-                xsect_features = []
-                quad_features = []
-                
-                for xsect in self.xsect_list:
-
-                    if len(xsect) < 2: # if there's only one station ..
-                        continue # .. give up as we don't know which way to face
-
-                    centerline = [] # will contain the station position and LRUD data
-
-                    for label, lrud in xsect:
-                        xyz = self.station_xyz[label] # look up coordinates from label
-                        lrud_or_zero = tuple([max(0, v) for v in lrud]) # deal with missing data
-                        centerline.append(xyz + lrud_or_zero) # and collect as 7-uple
-
-                    direction = [] # will contain the corresponding direction vectors
-
-                    # The calculations below use integers for xyz and lrud, and
-                    # conversion to metres is left to the end.  Then dh2 is an
-                    # integer and the test for a plumb is safely dh2 = 0.
-
-                    # The directions are unit vectors optionally weighted by
-                    # cos(inclination) = dh/dl where dh^2 = dx^2 + dy^2 + dz^2
-                    # and dl^2 = dh^2 + dz^2.  The normalisation is correspondingly
-                    # either 1/dh, or 1/dh * dh/dl = 1/dl.
-
-                    for i, xyzlrud in enumerate(centerline):
-                        x, y, z = xyzlrud[0:3]
-                        if i > 0:
-                            dx, dy, dz = x - xp, y - yp, z - zp
-                            dh2 = dx*dx + dy*dy # integer horizontal displacement (mm^2)
-                            norm = sqrt(dh2 + dz*dz) if use_clino_wgt else sqrt(dh2)
-                            dx, dy = (dx/norm, dy/norm) if dh2 > 0 and norm > 0 else (0, 0)
-                            direction.append((dx, dy))
-                        xp, yp, zp = x, y, z
-
-                    left_wall = []
-                    right_wall = []
-                    up_down = []
-
-                    # We build the walls by walking through the list
-                    # of stations and directions, with simple defaults
-                    # for the start and end stations
-                    
-                    for i, (x, y, z, l, r, u, d) in enumerate(centerline):
-                        d1x, d1y = direction[i-1] if i > 0 else (0, 0)
-                        d2x, d2y = direction[i] if i+1 < len(centerline) else (0, 0)
-                        dx, dy = d1x+d2x, d1y+d2y # mean (sum of) direction vectors
-                        norm = sqrt(dx*dx + dy*dy) # normalise to unit vector
-                        ex, ey = (dx/norm, dy/norm) if norm > 0 else (0, 0)
-                        # Convert to metres when saving the points
-                        left_wall.append((0.01*(x-l*ey), 0.01*(y+l*ex), 0.01*z))
-                        right_wall.append((0.01*(x+r*ey), 0.01*(y-r*ex), 0.01*z))
-                        up_down.append((0.01*u, 0.01*d))
-
-                    # Mean elevation of centerline, used for elevation attribute
-                    
-                    elev = 0.01 * sum([xyzlrud[2] for xyzlrud in centerline]) / len(centerline)
-                    attrs = [round(elev, 2)]
-
-                    # Now create the feature sets - first the centerline traverse
-
-                    points = []
-
-                    for xyzlrud in centerline:
-                        xyz = [0.01*v for v in xyzlrud[0:3]] # These were mm, convert to metres
-                        points.append(QgsPointV2(QgsWKBTypes.PointZ, *xyz))
-                        
-                    linestring = QgsLineStringV2()
-                    linestring.setPoints(points)
-                    feat = QgsFeature()
-                    geom = QgsGeometry(linestring)
-                    feat.setGeometry(geom)
-                    feat.setAttributes(attrs)
-                    trav_features.append(feat)
-
-                    # The walls as line strings
-
-                    for wall in (left_wall, right_wall):
-                        
-                        points = [QgsPointV2(QgsWKBTypes.PointZ, *xyz) for xyz in wall]
-                        linestring = QgsLineStringV2()
-                        linestring.setPoints(points)
-                        feat = QgsFeature()
-                        geom = QgsGeometry(linestring)
-                        feat.setGeometry(geom) 
-                        feat.setAttributes(attrs)
-                        wall_features.append(feat)
-
-                    # Slightly more elaborate, pair up points on left
-                    # and right walls, and build a cross section as a
-                    # 2-point line string, and a quadrilateral polygon
-                    # with a closed 5-point line string for the
-                    # exterior ring.  Note that QGIS polygons are
-                    # supposed to have their points ordered clockwise.
-
-                    for i, xyz_pair in enumerate(zip(left_wall, right_wall)):
-
-                        elev = 0.01 * centerline[i][2] # elevation of station in centerline
-                        attrs = [round(elev, 2)]
-                        points = [QgsPointV2(QgsWKBTypes.PointZ, *xyz) for xyz in xyz_pair]
-                        linestring = QgsLineStringV2()
-                        linestring.setPoints(points)
-                        feat = QgsFeature()
-                        geom = QgsGeometry(linestring)
-                        feat.setGeometry(geom) 
-                        feat.setAttributes(attrs)
-                        xsect_features.append(feat)
-
-                        if i > 0:
-                            elev = 0.5*(prev_xyz_pair[0][2] + xyz_pair[0][2]) # average elevation
-                            attrs = [round(elev, 2)]
-                            if include_up_down: # average up / down
-                                attrs += [ 0.5*(v1+v2) for (v1, v2) in zip(up_down[i-1], up_down[i]) ]
-                            points = [] # will contain the exterior 5-point ring, as follows...
-                            for xyz in tuple(reversed(prev_xyz_pair)) + xyz_pair + (prev_xyz_pair[1],):
-                                points.append(QgsPointV2(QgsWKBTypes.PointZ, *xyz))
-                            linestring = QgsLineStringV2()
-                            linestring.setPoints(points)
-                            polygon = QgsPolygonV2()
-                            polygon.setExteriorRing(linestring)
-                            feat = QgsFeature()
-                            geom = QgsGeometry(polygon)
-                            feat.setGeometry(geom)
-                            feat.setAttributes(attrs)
-                            quad_features.append(feat)
-                            
-                        prev_xyz_pair = xyz_pair
-
-                # End of processing xsect_list - now add features to requested layers
-
-                attrs = [QgsField('ELEVATION', QVariant.Double)] # common to all
-
-                if include_traverses and trav_features: # traverse layer
-                    travs_layer = self.add_layer('traverses', 'LineString')
-                    travs_layer.dataProvider().addAttributes(attrs)
-                    travs_layer.updateFields()
-                    travs_layer.dataProvider().addFeatures(trav_features)
-                    layers.append(travs_layer)
-
-                if include_xsections and xsect_features: # xsection layer
-                    xsects_layer = self.add_layer('xsections', 'LineString')
-                    xsects_layer.dataProvider().addAttributes(attrs)
-                    xsects_layer.updateFields()
-                    xsects_layer.dataProvider().addFeatures(xsect_features)
-                    layers.append(xsects_layer)
-
-                if include_walls and wall_features: # wall layer
-                    walls_layer = self.add_layer('walls', 'LineString')
-                    walls_layer.dataProvider().addAttributes(attrs)
-                    walls_layer.updateFields()
-                    walls_layer.dataProvider().addFeatures(wall_features)
-                    layers.append(walls_layer)
-
-                if include_up_down: # add fields if requested for polygons
-                    attrs += [QgsField(s, QVariant.Double) for s in ('MEAN_UP', 'MEAN_DOWN')]
-
-                if include_polygons and quad_features: # polygon layer
-                    quads_layer = self.add_layer('polygons', 'Polygon')
-                    quads_layer.dataProvider().addAttributes(attrs)
-                    quads_layer.updateFields()
-                    quads_layer.dataProvider().addFeatures(quad_features)
-                    layers.append(quads_layer)
-
-            # All layers have been created, now update extents and add to QGIS registry
-
-            if layers:
-                [ layer.updateExtents() for layer in layers ]
-                QgsMapLayerRegistry.instance().addMapLayers(layers)
-
-            # Save layers to a GeoPackage if selected.
-
-            # QgsVectorFileWriter would be ideal but it can only write
-            # single layers (afaik!), so the GeoPackage layers,
-            # fields, and attributes are created using OGR calls,
-            # translating the corresponding QGIS objects on the fly.
-
-            # It's possible this could be done faster by iterating
-            # numerically over the attributes but I'm not sure the OGR
-            # features would be visited in the right order, so here
-            # use the field names as indices.  Meanwhile, the user is
-            # appraised of progress by a progress bar.
-
-            if gpkg_file:
-
-                nfeatures = 0 # how many features in total
-                for layer in layers:
-                    nfeatures += layer.featureCount()
-
-                if nfeatures > 100: # create a progress bar
-                    progress_bar = QProgressBar()
-                    progress_bar.setMaximum(nfeatures)
-                    progress_bar.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-                    msg = 'Saving ' + QFileInfo(gpkg_file).fileName()
-                    progressMessageBar = self.iface.messageBar().createMessage(msg)
-                    progressMessageBar.layout().addWidget(progress_bar)
-                    self.iface.messageBar().pushWidget(progressMessageBar, self.iface.messageBar().INFO)
-                    ntrack = int(10**(floor(log10(nfeatures))-1)) # update frequency
-                else:
-                    progress_bar = None
-
-                gpkg_driver = ogr.GetDriverByName('GPKG')
-
-                if os.path.exists(gpkg_file):
-                    gpkg_driver.DeleteDataSource(gpkg_file)
-
-                ogr_dataset = gpkg_driver.CreateDataSource(gpkg_file)
-
-                if self.epsg: # figure out the spatial reference system in OGR terms
-                    ogr_srs = osr.SpatialReference()
-                    ogr_srs.ImportFromEPSG(self.epsg)
-                else:
-                    ogr_srs = None
-
-                ncount = 0 # to keep track of number of features processed
-
-                for layer in layers: # go through all the layers
-
-                    qgis_name = layer.name()
-                    match = search(' - ([a-z]*)', qgis_name)
-                    ogr_name = str(match.group(1)) if match else qgis_name # ie, legs, stations, etc
-                    ogr_type = self.ogr_vec_type[layer.wkbType()]
-                    ogr_layer = ogr_dataset.CreateLayer(ogr_name, srs=ogr_srs, geom_type=ogr_type)
-
-                    qgis_fields = layer.pendingFields()
-                    names = [str(field.name()) for field in qgis_fields]
-                    types = [self.ogr_type[field.type()] for field in qgis_fields]
-                    ogr_type_of_ = dict(zip(names, types)) # map field names to OGR field types
-
-                    [ ogr_layer.CreateField(ogr.FieldDefn(name, ogr_type_of_[name])) for name in names ]
-
-                    ogr_schema = ogr_layer.GetLayerDefn() # for creating features in the OGR layer
-
-                    for qgis_feat in layer.getFeatures(): # go through all the features
-
-                        ncount += 1 # update feature count
-
-                        if progress_bar and ncount % ntrack: # update progress bar
-                            progress_bar.setValue(ncount)
-
-                        ogr_feat = ogr.Feature(ogr_schema)
-
-                        ogr_wkt = qgis_feat.geometry().exportToWkt().replace(*self.wkt_replace[ogr_type])
-                        ogr_feat.SetGeometry(ogr.CreateGeometryFromWkt(ogr_wkt))
-
-                        qgis_attrs = qgis_feat.attributes()
-
-                        for name, qgis_attr in zip(names, qgis_attrs):
-                            if ogr_type_of_[name] == ogr.OFTString: # fix for strings
-                                ogr_feat.SetField(name, str(qgis_attr))
-                            elif ogr_type_of_[name] == ogr.OFTDate: # translate dates
-                                ogr_feat.SetField(name, str(qgis_attr.toString(Qt.ISODate)))
-                            else: # everything else just passes through
-                                ogr_feat.SetField(name, qgis_attr)
-
-                        ogr_layer.CreateFeature(ogr_feat)
-
-                ogr_dataset = None # all done, flush to disk
-
-                if progress_bar: # clean up and free resources
-                    self.iface.messageBar().clearWidgets()
-                    progress_bar = None
-
-                msg = QFileInfo(gpkg_file).fileName() + ' to ' + QFileInfo(gpkg_file).path()
-                QgsMessageLog.logMessage('Saved ' + msg, tag='Import .3d', level=QgsMessageLog.INFO)
-                self.iface.messageBar().pushMessage('Saved', msg, level=QgsMessageBar.INFO, duration=5)
-
-            # End of save to GeoPackage
+            # A directory is a batch of all the .3d files in it, and
+            # below, imported together and named after the directory
+
+            if os.path.isdir(survex3dfile):
+                from survex3d import find_3d_files
+                survex3dfiles = list(find_3d_files([survex3dfile]))
+                batch_name = os.path.basename(os.path.normpath(survex3dfile))
+                if not survex3dfiles:
+                    raise Exception("No .3d files in '%s'" % survex3dfile)
+            else:
+                survex3dfiles, batch_name = [survex3dfile], ''
+
+            # The project CRS has to be found here, in the main thread.
+            # It should end up as a lowercase string like 'epsg:27700'
+
+            if get_crs_from_project or reproject:
+                project_crs = self.iface.mapCanvas().mapRenderer().destinationCrs()
+                project_epsg = self.extract_epsg(project_crs.authid().lower())
+            else:
+                project_epsg = None
+
+            # An import which keeps or updates features builds on a
+            # session: the one with the file in it for an update, or
+            # else the latest.  It can't run alongside another import,
+            # which might replace the session, but new imports can.
+
+            if update_features:
+                session = next((s for s in reversed(self.sessions) if set(survex3dfiles) & set(s.sources)),
+                               self.sessions[-1] if self.sessions else None)
+            elif not discard_features:
+                session = self.sessions[-1] if self.sessions else None
+            else:
+                session = None
+
+            if session and self.running:
+                self.iface.messageBar().pushMessage('Busy', 'Wait for the running import to finish',
+                                                    level=QgsMessageBar.WARNING, duration=5)
+                return
+
+            # Likewise for the layers from the session which are still
+            # there, if they are to be updated in place
+
+            if update_features and session:
+                registered = QgsMapLayerRegistry.instance().mapLayers()
+                previous_layers = dict((name, entry) for name, entry in session.imported.items()
+                                       if entry.layer_id in registered)
+                if not previous_layers: # nothing left to update
+                    session = None
+            else:
+                previous_layers = {}
+
+            # Everything else is done in a background thread, and
+            # the results are added to QGIS when it has finished
+
+            self.load_decoder()
+
+            options = dict(survex3dfiles=survex3dfiles, batch_name=batch_name, gpkg_file=gpkg_file,
+                           include_legs=include_legs, merge_legs=merge_legs,
+                           include_stations=include_stations, include_polygons=include_polygons,
+                           include_walls=include_walls, include_xsections=include_xsections,
+                           include_traverses=include_traverses,
+                           exclude_surface_legs=exclude_surface_legs,
+                           exclude_splay_legs=exclude_splay_legs,
+                           exclude_duplicate_legs=exclude_duplicate_legs,
+                           exclude_surface_stations=exclude_surface_stations,
+                           use_clino_wgt=use_clino_wgt, include_up_down=include_up_down,
+                           include_derived=include_derived,
+                           include_surveys=include_surveys, exclude_surveys=exclude_surveys,
+                           dates=dates, styles=styles,
+                           bbox=bbox, polygon=polygon, region_crs=region_crs,
+                           get_crs_from_file=get_crs_from_file, project_epsg=project_epsg,
+                           reproject=reproject,
+                           file_backed=file_backed, session=session, previous_layers=previous_layers,
+                           timer=PhaseTimer(enabled=log_phases))
+
+            self.start_import(lambda report: self.import_3d(report, **options),
+                              'Importing ' + (batch_name or QFileInfo(survex3dfile).fileName()))
 
         # End of what happens if user pressed OK
 
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Import sessions, which own the decoded .3d files behind a set of
+imported layers, so that each can be built on by a later import,
+kept, or let go of, independently of any other.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from collections import namedtuple
+
+import os
+
+# A layer from an import, kept so that the features from any one of
+# the .3d files in it can be updated in place or removed, without
+# touching the rest: the QGIS layer id, the fields, the GeoPackage
+# serving the layer ('' for a memory layer), and for each source
+# (.3d file) the Digest of its features and their feature ids in
+# the same order
+
+Imported = namedtuple('Imported', 'layer_id fields path digests fids')
+
+class ImportSession:
+    """The decoded .3d files behind a set of imported layers
+
+    surveys are the decoded files (Survex3D objects), sources the .3d
+    file each came from (each only once), and names the name of each
+    for the SOURCE field, which stays the same while it is in the
+    session.  title and epsg are as given to the layers, and imported
+    maps the layer names (legs, stations, etc) to Imported.  An import either starts a new session, or
+    builds on an existing one (keeping or updating its features) to
+    make another, so nothing is shared with a running import except
+    the decoded files, which are never changed.  A source can be
+    removed from a session, but only while no import is running.
+    """
+
+    def __init__(self, surveys=(), sources=(), title='', epsg=None, imported=None, names=None):
+        self.surveys = list(surveys)
+        self.sources = list(sources)
+        self.names = list(names) if names is not None else [os.path.basename(s) for s in sources]
+        self.title = title
+        self.epsg = epsg
+        self.imported = {} if imported is None else imported
+
+    @property
+    def nbytes(self):
+        """Memory held by the decoded files"""
+        return sum(survey.nbytes for survey in self.surveys)
+
+    def layer_ids(self):
+        """Return the ids of the QGIS layers from this session, as a set"""
+        return set(entry.layer_id for entry in self.imported.values())
+
+    def source_nbytes(self, source):
+        """Memory held by the decoded file from one source"""
+        return self.surveys[self.sources.index(source)].nbytes
+
+    def remove_source(self, source):
+        """Drop a source, returning the feature ids of its features in each layer, by layer id"""
+        k = self.sources.index(source)
+        del self.surveys[k], self.sources[k], self.names[k]
+        result = {}
+        for entry in self.imported.values():
+            entry.digests.pop(source, None)
+            result[entry.layer_id] = entry.fids.pop(source, [])
+        return result
+
+    def release(self):
+        """Let go of the decoded files and layers, so the memory can be reclaimed"""
+        self.surveys, self.sources, self.names, self.imported = [], [], [], {}
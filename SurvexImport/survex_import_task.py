@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ SurvexImport
+                                 A QGIS plugin
+ Import features from survex .3d files
+                              -------------------
+        begin                : 2018-01-03
+        git sha              : $Format:%H$
+        copyright            : (C) 2018 by Patrick B Warren
+        email                : patrickbwarren@gmail.com
+ ***************************************************************************/
+
+Worker for running an import in a background thread, so that QGIS
+stays responsive, with progress reports and cancellation.
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from PyQt4.QtCore import QObject, pyqtSignal
+
+import traceback
+
+class Cancelled(Exception):
+    """Raised in the worker thread when the task has been cancelled"""
+
+class ImportWorker(QObject):
+    """Run a function in a background thread, reporting back by signals
+
+    The function is called with a report(message, value, maximum)
+    callback, which forwards progress to the progress signal at most
+    once per percent, and raises Cancelled once kill() has been
+    called.  The function should therefore not change any shared
+    state until it is done; what it returns is passed on by the
+    finished signal.  Everything else is done in the main thread by
+    the slots connected to the signals.
+    """
+
+    progress = pyqtSignal(str, int, int)
+    finished = pyqtSignal(object)
+    cancelled = pyqtSignal()
+    error = pyqtSignal(str)
+
+    def __init__(self, work):
+        QObject.__init__(self)
+        self.work = work
+        self.killed = False
+        self.last = None # last progress report forwarded
+
+    def kill(self):
+        """Ask the worker to stop, at the next progress report"""
+        self.killed = True
+
+    def report(self, message, value, maximum):
+        """Forward progress to the main thread, or abandon the work if killed"""
+        if self.killed:
+            raise Cancelled()
+        percent = 100 * value // maximum if maximum > 0 else 0
+        if (message, percent) != self.last:
+            self.last = message, percent
+            self.progress.emit(message, value, maximum)
+
+    def run(self):
+        """Do the work, then emit one of finished, cancelled, or error"""
+        try:
+            result = self.work(self.report)
+        except Cancelled:
+            self.cancelled.emit()
+        except Exception:
+            self.error.emit(traceback.format_exc())
+        else:
+            self.finished.emit(result)
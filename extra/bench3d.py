@@ -0,0 +1,206 @@
+#!/usr/bin/env python2.7
+
+# Benchmark importing survex .3d files from end to end, on synthetic
+# surveys of increasing size (see synth3d.py): the decode, feature
+# build, wall geometry and GeoPackage export are each timed and
+# memory profiled, and the results written as JSON, so that runs
+# from different commits can be compared for regressions
+
+# Copyright (c) 2018 Patrick B Warren
+
+# Distributed under the terms of the GNU General Public License v2
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# The decoder and layers are shared with the plugin
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'SurvexImport'))
+
+import survex3d
+import survex3d_layers
+import survex3d_timing
+import synth3d
+
+try: # the export needs OGR, which may not be installed outside QGIS
+    import survex3d_gpkg
+    from osgeo import gdal
+except ImportError:
+    survex3d_gpkg = gdal = None
+
+try: # memory profiling needs Python 3
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+stages = ['decode', 'build', 'walls', 'export']
+
+def stage_functions(path, gpkg):
+    """Return the stages as functions which add to a shared state, each returning the number of features"""
+
+    def decode(state):
+        state['survey'] = survex3d.decode_3d(path)
+        return len(state['survey'].legs) + len(state['survey'].stations)
+
+    def build(state):
+        state['layers'] = survex3d_layers.build_layers([state['survey']])
+        return sum(len(layer.rows) for layer in state['layers'])
+
+    def walls(state):
+        state['walls'] = survex3d_layers.wall_layers([state['survey']])
+        return sum(len(layer.rows) for layer in state['walls'])
+
+    def export(state): # with the inserts, spatial index and flush as phases
+        cs = state['survey'].header.cs
+        epsg = survex3d_gpkg.epsg_from_cs(cs) if cs else None
+        timer = survex3d_timing.PhaseTimer()
+        nfeatures = survex3d_gpkg.write_layers(gpkg, state['layers'] + state['walls'], epsg, timer=timer)
+        state['phases'] = timer.as_dict()['phases']
+        return nfeatures
+
+    return [decode, build, walls, export]
+
+def run_stage(function, state, repeat, memory):
+    """Time a stage, best of repeat, then profile its memory, returning a dict"""
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        features = function(state)
+        times.append(time.time() - t0)
+    result = {'seconds': min(times), 'features': features}
+    if 'phases' in state: # from the last run
+        result['phases'] = state.pop('phases')
+    if memory and tracemalloc: # a separate run, as tracing slows everything down
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        function(state)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        state.pop('phases', None)
+        result.update(peak_bytes=peak - base, retained_bytes=current - base)
+    return result
+
+def benchmark(path, gpkg, repeat=1, memory=True, report=None):
+    """Run all the stages on a .3d file, returning {stage: dict} in order"""
+    state, results = {}, {}
+    for name, function in zip(stages, stage_functions(path, gpkg)):
+        if name == 'export' and survex3d_gpkg is None:
+            results[name] = None
+            continue
+        results[name] = run_stage(function, state, repeat, memory)
+        if report:
+            report(name, results[name])
+    return results
+
+def git_commit():
+    """Return the commit checked out, if this is a git working copy"""
+    try:
+        with open(os.devnull, 'w') as null:
+            out = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here, stderr=null)
+        return out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def environment():
+    """Return a description of what the benchmark was run on"""
+    return {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'gdal': gdal.__version__ if gdal else '',
+            'platform': platform.platform(), 'processor': platform.processor()}
+
+def compare(old, new, tolerance):
+    """Print the ratios of times new/old for matching runs, returning the number of regressions"""
+    old_runs = dict((run['legs'], run) for run in old['runs'])
+    nregressions = 0
+    print('comparing %s (%s) with %s (%s)' % (new['environment']['commit'], new['environment']['time'],
+                                              old['environment']['commit'], old['environment']['time']))
+    for run in new['runs']:
+        previous = old_runs.get(run['legs'])
+        if previous is None:
+            continue
+        for name in stages:
+            a, b = previous['stages'].get(name), run['stages'].get(name)
+            if not a or not b:
+                continue
+            ratio = b['seconds'] / a['seconds'] if a['seconds'] else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  <-- slower'
+                nregressions += 1
+            print('%9i legs %-7s %8.3fs -> %8.3fs  x%.2f%s' % (run['legs'], name, a['seconds'],
+                                                             b['seconds'], ratio, flag))
+    return nregressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='benchmark importing synthetic survex .3d files')
+    parser.add_argument('-n', '--sizes', nargs='+', type=synth3d.parse_size,
+                        default=[synth3d.parse_size(s) for s in ['10k', '100k', '1M']],
+                        help='numbers of legs, as 10k 100k 1M 10M (default 10k 100k 1M)')
+    parser.add_argument('-w', '--workdir', default=os.path.join(tempfile.gettempdir(), 'bench3d'),
+                        help='directory for the synthetic .3d files, kept between runs (default %(default)s)')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-c', '--compare', metavar='JSON', help='compare the times with an earlier results file')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='fractional slow down counted as a regression (default %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='take the best time of this many runs')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed for the synthetic files')
+    parser.add_argument('--no-memory', action='store_true', help="don't profile the memory use")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+
+    results = {'environment': environment(), 'runs': []}
+
+    for nlegs in args.sizes:
+
+        path = os.path.join(args.workdir, 'synth_%i_%i.3d' % (nlegs, args.seed))
+        if not os.path.exists(path): # the same size and seed always give the same file
+            t0 = time.time()
+            synth3d.write_synthetic_3d(path, nlegs, args.seed)
+            print('%s: written in %.2fs' % (path, time.time() - t0))
+
+        summary = survex3d.scan_3d(path)
+        print('%s: %i legs, %i stations, %i xsects, %.1f MB' % (path, summary.legs, summary.stations,
+                                                                summary.xsects, os.path.getsize(path) / 1e6))
+
+        def report(name, result):
+            memory = ''
+            if 'peak_bytes' in result:
+                memory = ', peak %.1f MB, retained %.1f MB' % (result['peak_bytes'] / 1e6,
+                                                               result['retained_bytes'] / 1e6)
+            print('  %-7s %8.3fs  %9i features%s' % (name, result['seconds'], result['features'], memory))
+
+        gpkg = os.path.join(args.workdir, 'synth_%i_%i.gpkg' % (nlegs, args.seed))
+        run = {'legs': nlegs, 'file_bytes': os.path.getsize(path), 'seed': args.seed,
+               'counts': {'legs': summary.legs, 'splay_legs': summary.splay_legs,
+                          'surface_legs': summary.surface_legs, 'duplicate_legs': summary.duplicate_legs,
+                          'stations': summary.stations, 'xsects': summary.xsects},
+               'stages': benchmark(path, gpkg, args.repeat, not args.no_memory, report)}
+        if os.path.exists(gpkg):
+            run['gpkg_bytes'] = os.path.getsize(gpkg)
+        results['runs'].append(run)
+
+    if survex3d_gpkg is None:
+        print('GeoPackage export skipped, as OGR (osgeo) is not available')
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    nregressions = 0
+    if args.compare:
+        with open(args.compare) as fp:
+            nregressions = compare(json.load(fp), results, args.tolerance)
+
+    sys.exit(1 if nregressions else 0)
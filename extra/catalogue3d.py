@@ -0,0 +1,81 @@
+#!/usr/bin/env python2.7
+
+# Catalogue the survex .3d files in one or more directories, writing
+# a CSV summary of each (title, CS, counts, dates and bounding box)
+# using the quick scan from the plugin, with files scanned in parallel
+
+# Copyright (c) 2018 Patrick B Warren
+
+# Distributed under the terms of the GNU General Public License v2
+
+import argparse
+import csv
+import os
+import sys
+from datetime import date
+from multiprocessing import Pool
+
+# The decoder is shared with the plugin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SurvexImport'))
+
+import survex3d
+
+day_zero = date(1900, 1, 1).toordinal()
+
+fields = ['path', 'title', 'cs', 'timestamp', 'version', 'extended',
+          'legs', 'splay_legs', 'surface_legs', 'duplicate_legs',
+          'stations', 'entrances', 'xsects', 'date1', 'date2',
+          'xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax', 'error']
+
+def to_date(days):
+    """Convert from integer days since 1900.01.01 to a string YYYY.mm.dd"""
+    return '' if days is None else date.fromordinal(day_zero + days).strftime('%Y.%m.%d')
+
+def catalogue(path):
+    """Return a row for the catalogue, for a single file"""
+    row = dict.fromkeys(fields, '')
+    row['path'] = path
+    try:
+        summary = survex3d.scan_3d(path)
+    except (IOError, OSError, ValueError) as e:
+        row['error'] = str(e)
+        return row
+    row.update(summary._asdict())
+    row['extended'] = int(summary.extended)
+    row['date1'], row['date2'] = to_date(summary.date1), to_date(summary.date2)
+    row.pop('bbox')
+    if summary.bbox:
+        for name, v in zip(['xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax'],
+                           summary.bbox[0] + summary.bbox[1]):
+            row[name] = '%.2f' % v
+    return row
+
+if __name__ == '__main__': # guarded, as worker processes may import this script
+
+    parser = argparse.ArgumentParser(description='catalogue survex .3d files as CSV')
+    parser.add_argument('PATH', nargs='+', help='.3d files, or directories to search for them')
+    parser.add_argument('-o', '--output', help='output CSV file (default stdout)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes (default one per cpu)')
+    args = parser.parse_args()
+
+    files = list(survex3d.find_3d_files(args.PATH))
+
+    pool = Pool(args.processes)
+    try:
+        rows = pool.map(catalogue, files, chunksize=8)
+    finally:
+        pool.close()
+        pool.join()
+
+    fp = open(args.output, 'w') if args.output else sys.stdout
+    writer = csv.DictWriter(fp, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    if args.output:
+        fp.close()
+
+    nerrors = sum(1 for row in rows if row['error'])
+    sys.stderr.write('%i .3d files catalogued, %i with errors\n' % (len(rows), nerrors))
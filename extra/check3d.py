@@ -0,0 +1,79 @@
+#!/usr/bin/env python2.7
+
+# Check that decoding a .3d file in parallel chunks, from a checkpoint
+# index, gives exactly the same result as decoding it sequentially.
+# The index is built in memory, and never written.
+
+# Copyright (c) 2018 Patrick B Warren
+
+# Distributed under the terms of the GNU General Public License v2
+
+import argparse
+import os
+import sys
+import time
+
+# The decoders are shared with the plugin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SurvexImport'))
+
+import survex3d
+import survex3d_parallel
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description='check parallel decoding of a survex .3d file')
+parser.add_argument('FILE', nargs='+', help='.3d files to check')
+parser.add_argument('-s', '--spacing', type=int, default=survex3d_parallel.DEFAULT_SPACING,
+                    help='bytes between checkpoints (default %(default)s)')
+parser.add_argument('-p', '--processes', type=int, default=None,
+                    help='number of worker processes (default one per cpu)')
+args = parser.parse_args()
+
+names = ['legs', 'stations', 'xsects', 'traverses', 'xsect_runs', 'label_xyz']
+
+options = ['exclude_surface_legs', 'exclude_duplicate_legs',
+           'exclude_splay_legs', 'exclude_surface_stations']
+
+def differences(a, b):
+    """Return the names of the parts which differ between two Survex3D objects"""
+    result = [name for name in names if not np.array_equal(getattr(a, name), getattr(b, name))]
+    if a.header != b.header:
+        result.append('header')
+    if a.labels.names(np.arange(len(a.labels))) != b.labels.names(np.arange(len(b.labels))):
+        result.append('labels')
+    return result
+
+failed = False
+
+for path in args.FILE:
+
+    t0 = time.time()
+    sequential = survex3d.decode_3d(path)
+    t1 = time.time()
+    decoded, checkpoints = survex3d_parallel.index_3d(path, args.spacing)
+    t2 = time.time()
+    chunks = [survex3d_parallel.decode_chunk((path, start, stop))
+              for start, stop in zip([None] + checkpoints, [cp.pos for cp in checkpoints] + [None])]
+    t3 = time.time()
+    parallel = survex3d.assemble(decoded.header, survex3d_parallel.merge_chunks(chunks))
+
+    print('%s: %i chunks, sequential %.3fs, with checkpoints %.3fs, chunk by chunk %.3fs'
+          % (path, len(chunks), t1 - t0, t2 - t1, t3 - t2))
+
+    for i in range(1 << len(options)): # every combination of exclusions
+        kwargs = dict((option, bool(i >> j & 1)) for j, option in enumerate(options))
+        diffs = differences(survex3d.decode_3d(path, **kwargs), parallel.select(**kwargs))
+        if diffs:
+            print('  mismatch in %s with %s' % (', '.join(diffs), kwargs))
+            failed = True
+
+    t0 = time.time()
+    pooled = survex3d_parallel.decode_chunks(path, checkpoints, processes=args.processes)
+    print('  pool of processes %.3fs' % (time.time() - t0))
+    diffs = differences(sequential, pooled)
+    if diffs:
+        print('  mismatch in %s using a pool of processes' % ', '.join(diffs))
+        failed = True
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python2.7
+
+# Convert survex .3d files to GeoPackages without QGIS, writing the
+# same layers (stations, legs, traverses, xsections, walls, polygons)
+# with the same schemas as the plugin, with files converted in parallel,
+# either one GeoPackage for each or all combined into one.  A single
+# large file is instead decoded in parallel chunks, from a checkpoint
+# index kept next to it, if asked to write one (see
+# SurvexImport/survex3d_parallel.py)
+
+# Copyright (c) 2018 Patrick B Warren
+
+# Distributed under the terms of the GNU General Public License v2
+
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+
+# The decoder, layers and GeoPackage writer are shared with the plugin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SurvexImport'))
+
+import survex3d
+import survex3d_layers
+import survex3d_gpkg
+import survex3d_parallel
+
+def output_path(path, directory=None):
+    """Return the GeoPackage for a .3d file, next to it or in a directory"""
+    name = os.path.splitext(os.path.basename(path))[0] + '.gpkg'
+    return os.path.join(directory or os.path.dirname(path), name)
+
+def decode(path, options):
+    """Decode one .3d file, in parallel chunks if set in the options"""
+    if options['parallel']:
+        return survex3d_parallel.decode_3d(path, processes=options['processes'],
+                                           update_index=options['write_index'], **options['exclusions'])
+    return survex3d.decode_3d(path, **options['exclusions'])
+
+def build(path, options):
+    """Decode one .3d file and build its layers, returning (layers, CS)
+
+    If there is a target EPSG code, the coordinates are transformed
+    to it from the CS in the file.
+    """
+    decoded = decode(path, options)
+    sources = [options['names'][path]] if options['source'] else None
+    transform = None
+    if options['target_epsg']:
+        if not decoded.header.cs:
+            raise ValueError('No CS to transform from in ' + path)
+        source_epsg = survex3d_gpkg.epsg_from_cs(decoded.header.cs)
+        if source_epsg != options['target_epsg']:
+            transform = survex3d_gpkg.coordinate_transform(source_epsg, options['target_epsg'])
+    return (survex3d_layers.build_layers([decoded], sources=sources, transform=transform, **options['layers']),
+            decoded.header.cs)
+
+def convert(task):
+    """Convert one .3d file to a GeoPackage, returning (path, output, features, seconds, error)"""
+    path, output, options = task
+    t0 = time.time()
+    try:
+        layers, cs = build(path, options)
+        epsg = options['epsg']
+        if epsg is None and cs:
+            epsg = survex3d_gpkg.epsg_from_cs(cs)
+        nfeatures = survex3d_gpkg.write_layers(output, layers, epsg)
+    except (IOError, OSError, ValueError) as e:
+        return path, output, 0, time.time() - t0, str(e)
+    return path, output, nfeatures, time.time() - t0, ''
+
+def build_task(task):
+    """Build the layers for one .3d file to be combined, returning (path, layers, CS, seconds, error)"""
+    path, options = task
+    t0 = time.time()
+    try:
+        layers, cs = build(path, options)
+    except (IOError, OSError, ValueError) as e:
+        return path, [], '', time.time() - t0, str(e)
+    return path, layers, cs, time.time() - t0, ''
+
+def run_tasks(function, tasks, processes):
+    """Return [function(task) for task in tasks], in a process pool if worth it"""
+    if len(tasks) == 1 or processes == 1:
+        return [function(task) for task in tasks]
+    pool = Pool(processes)
+    try:
+        return pool.map(function, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__': # guarded, as worker processes may import this script
+
+    parser = argparse.ArgumentParser(description='convert survex .3d files to GeoPackages')
+    parser.add_argument('FILE', nargs='+', help='.3d files to convert, or directories to search for them')
+    parser.add_argument('-d', '--directory', help='directory for the GeoPackages (default next to the .3d files)')
+    parser.add_argument('-c', '--combine', metavar='GPKG',
+                        help='write the features from all the files to this one GeoPackage, with a SOURCE field')
+    parser.add_argument('--source', action='store_true',
+                        help='add a SOURCE field with the .3d file name (implied by --combine)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes (default one per cpu)')
+    parser.add_argument('--write-index', action='store_true',
+                        help='write an index next to a single file, as FILE.idx, to decode it in parallel next time')
+    parser.add_argument('--no-legs', action='store_true', help='omit the legs layer')
+    parser.add_argument('--no-stations', action='store_true', help='omit the stations layer')
+    parser.add_argument('--traverses', action='store_true', help='include the traverses layer')
+    parser.add_argument('--xsections', action='store_true', help='include the xsections layer')
+    parser.add_argument('--walls', action='store_true', help='include the walls layer')
+    parser.add_argument('--polygons', action='store_true', help='include the polygons layer')
+    parser.add_argument('--merge-legs', action='store_true', help='merge consecutive legs into polylines')
+    parser.add_argument('--no-surface-legs', action='store_true', help='exclude surface legs')
+    parser.add_argument('--no-splay-legs', action='store_true', help='exclude splay legs')
+    parser.add_argument('--no-duplicate-legs', action='store_true', help='exclude duplicate legs')
+    parser.add_argument('--no-surface-stations', action='store_true', help='exclude surface stations')
+    parser.add_argument('--no-clino-weights', action='store_true',
+                        help="don't weight passage directions by cos(inclination)")
+    parser.add_argument('--no-up-down', action='store_true', help='omit MEAN_UP, MEAN_DOWN for polygons')
+    parser.add_argument('--derived', action='store_true',
+                        help='add leg lengths, bearings and inclinations, and station depths')
+    parser.add_argument('--surveys', default='',
+                        help='surveys to include, or with a leading - to exclude (space separated)')
+    parser.add_argument('--dates', type=survex3d.parse_dates, default=None, metavar="'FIRST LAST'",
+                        help='legs surveyed in a window of dates, as yyyy.mm.dd, yyyy.mm or yyyy')
+    parser.add_argument('--styles', type=survex3d.parse_styles, default=None,
+                        help='leg styles to include (normal diving cartesian cylpolar nosurvey), '
+                        'or with a leading - to exclude (space separated)')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                        help='restrict to a bounding box')
+    parser.add_argument('--epsg', type=int, default=None, help='EPSG code (default from the CS in the file)')
+    parser.add_argument('--target-epsg', type=int, default=None,
+                        help='transform the coordinates to this EPSG code, from the CS in each file')
+    args = parser.parse_args()
+
+    surveys = args.surveys.split()
+
+    epsg = args.target_epsg or args.epsg
+
+    options = {'epsg': epsg, 'target_epsg': args.target_epsg, 'source': args.source or bool(args.combine),
+               'exclusions': {'exclude_surface_legs': args.no_surface_legs,
+                              'exclude_splay_legs': args.no_splay_legs,
+                              'exclude_duplicate_legs': args.no_duplicate_legs,
+                              'exclude_surface_stations': args.no_surface_stations,
+                              'include_surveys': [s for s in surveys if not s.startswith('-')],
+                              'exclude_surveys': [s[1:] for s in surveys if s.startswith('-')],
+                              'dates': args.dates, 'styles': args.styles,
+                              'bbox': args.bbox},
+               'layers': {'include_legs': not args.no_legs,
+                          'include_stations': not args.no_stations,
+                          'include_traverses': args.traverses,
+                          'include_xsections': args.xsections,
+                          'include_walls': args.walls,
+                          'include_polygons': args.polygons,
+                          'merge_legs': args.merge_legs,
+                          'use_clino_wgt': not args.no_clino_weights,
+                          'include_up_down': not args.no_up_down,
+                          'include_derived': args.derived}}
+
+    paths = list(survex3d.find_3d_files(args.FILE))
+
+    # The SOURCE field has the path relative to the directory all the
+    # files are in, as files in different directories may share a name
+
+    options['names'] = dict(zip(paths, survex3d.source_names(paths)))
+
+    # With only one file there is nothing to convert in parallel, so
+    # the decode is split up instead (if a run with --write-index has
+    # indexed it), unless there is only one cpu, when the chunks only
+    # add overhead
+
+    options['parallel'] = len(paths) == 1 and (args.processes or cpu_count()) > 1
+    options['write_index'] = args.write_index
+    options['processes'] = args.processes
+
+    nerrors = 0
+
+    if args.combine: # build the layers in parallel, then write them together
+
+        t0 = time.time()
+        results = run_tasks(build_task, [(path, options) for path in paths], args.processes)
+
+        layer_lists, cs_list = [], []
+        for path, layers, cs, seconds, error in results:
+            if error:
+                sys.stderr.write('%s: %s\n' % (path, error))
+                nerrors += 1
+            else:
+                print('%s: %i features in %.2fs' % (path, sum(len(layer.rows) for layer in layers), seconds))
+                layer_lists.append(layers)
+                if cs:
+                    cs_list.append(cs)
+
+        if epsg is None and cs_list:
+            if len(set(cs_list)) > 1:
+                sys.stderr.write('The .3d files have different CS, using %s\n' % cs_list[0])
+            epsg = survex3d_gpkg.epsg_from_cs(cs_list[0])
+
+        nfeatures = survex3d_gpkg.write_layers(args.combine, survex3d_layers.concat_layers(layer_lists), epsg)
+        print('%i files -> %s: %i features in %.2fs' % (len(layer_lists), args.combine, nfeatures,
+                                                        time.time() - t0))
+
+    else: # convert each file in parallel
+
+        tasks = [(path, output_path(path, args.directory), options) for path in paths]
+
+        for path, output, nfeatures, seconds, error in run_tasks(convert, tasks, args.processes):
+            if error:
+                sys.stderr.write('%s: %s\n' % (path, error))
+                nerrors += 1
+            else:
+                print('%s -> %s: %i features in %.2fs' % (path, output, nfeatures, seconds))
+
+    sys.exit(1 if nerrors else 0)
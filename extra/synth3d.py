@@ -0,0 +1,237 @@
+#!/usr/bin/env python2.7
+
+# Write synthetic survex .3d files (v8) of any size, for benchmarking
+# and testing the decoder and plugin on data much larger than the
+# sample in DowProv/.  The surveys are random walks branching off one
+# another, with splays, surface and duplicate legs, dates, error info
+# and passage cross-sections (XSECT runs), in the same record order as
+# cavern writes: legs first, then the stations, then the XSECTs.
+
+# Copyright (c) 2018 Patrick B Warren
+
+# Distributed under the terms of the GNU General Public License v2
+
+import argparse
+import os
+from array import array
+from collections import namedtuple
+from struct import Struct
+
+import numpy as np
+
+xyz_struct = Struct('<iii')
+date_struct = Struct('<H')
+date_range_struct = Struct('<HB')
+error_struct = Struct('<iiiii')
+lrud_short_struct = Struct('<hhhh')
+
+LEGS_PER_SURVEY = 30 # centre line legs, each with a splay from its end station
+SURVEYS_PER_AREA = 100 # surveys in each sub-survey, as 'synth.a3.s312'
+ORIGIN = (38000000, 46000000, 30000) # in cm, somewhere in the OSGB grid
+
+Counts = namedtuple('Counts', 'legs splay_legs surface_legs duplicate_legs stations xsects surveys')
+
+class RecordWriter:
+    """Buffered writer for .3d records, keeping track of the current label"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buf = bytearray()
+        self.label = ''
+        self.style = 0xff
+
+    def write_label(self, label):
+        """Write a label as the change from the current one, in the short format if possible"""
+        prev = self.label
+        common = len(os.path.commonprefix([prev, label]))
+        ndel, add = len(prev) - common, label[common:].encode('ascii')
+        if ndel < 16 and len(add) < 16 and (ndel or add):
+            self.buf.append(ndel << 4 | len(add))
+        else:
+            self.buf.append(0x00)
+            for n in ndel, len(add):
+                if n < 0xff:
+                    self.buf.append(n)
+                else:
+                    self.buf.append(0xff)
+                    self.buf += Struct('<I').pack(n)
+        self.buf += add
+        self.label = label
+
+    def write_style(self, style):
+        """Write a STYLE record, only if the style changes, as a repeated 0x00 ends the data"""
+        if style != self.style:
+            self.buf.append(style)
+            self.style = style
+
+    def write_end(self):
+        """Write the end of the data, and flush"""
+        self.write_style(0x00)
+        self.buf.append(0x00)
+        self.flush(force=True)
+
+    def flush(self, force=False):
+        """Write out the buffer once it is large enough"""
+        if force or len(self.buf) > 1 << 20:
+            self.fp.write(self.buf)
+            del self.buf[:]
+
+def random_walk(rng, start, nlegs, surface):
+    """Return the nlegs+1 station positions (cm) of a random walk from start"""
+    length = rng.uniform(200, 1000, nlegs)
+    bearing = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.35, nlegs))
+    inclination = np.clip(rng.normal(0, 0.05 if surface else 0.3, nlegs), -1.2, 1.2)
+    step = np.column_stack([length * np.cos(inclination) * np.sin(bearing),
+                            length * np.cos(inclination) * np.cos(bearing),
+                            length * np.sin(inclination)])
+    return np.vstack([start, start + np.cumsum(step, axis=0)]).round().astype(np.int32)
+
+def write_synthetic_3d(path, nlegs, seed=0, title='synth', cs='+init=epsg:27700 +no_defs',
+                       timestamp=1514764800):
+    """Write a synthetic .3d file with (at least) nlegs legs, returning the Counts
+
+    Half the legs are centre line and half are splays.  Every 20th
+    survey is on the surface, every 25th is duplicated, and every 40th
+    is a dive, with the rest underground with error info and a run of
+    XSECTs along the centre line.  The same seed gives the same file.
+    """
+
+    rng = np.random.RandomState(seed)
+    nsurveys = max(1, -(-nlegs // (2 * LEGS_PER_SURVEY)))
+
+    xyz = array('i') # all the station positions, in order, for the branching
+    splay_xyz = array('i')
+    surveys = [] # (label, flags, surface) for each survey
+
+    legs = splay_legs = surface_legs = duplicate_legs = 0
+
+    with open(path, 'wb') as fp:
+
+        fp.write(b'Survex 3D Image File\nv8\n')
+        fp.write(title.encode('utf-8') + b'\x00' + cs.encode('utf-8') + b'\n')
+        fp.write(b'@' + str(timestamp).encode('ascii') + b'\n')
+        fp.write(b'\x00') # file-wide flag
+
+        out = RecordWriter(fp)
+
+        for i in range(nsurveys):
+
+            label = 'synth.a%i.s%i' % (i // SURVEYS_PER_AREA, i)
+            surface = i % 20 == 19
+            flags = (0x01 if surface else 0) | (0x02 if i % 25 == 24 else 0)
+
+            # Branch off one of the more recent stations
+
+            if i:
+                k = rng.randint(max(0, len(xyz) // 3 - 2000), len(xyz) // 3)
+                start = xyz[3 * k:3 * k + 3]
+            else:
+                start = ORIGIN
+
+            pos = random_walk(rng, np.array(start), LEGS_PER_SURVEY, surface)
+            splay = pos[1:] + (rng.normal(0, 150, (LEGS_PER_SURVEY, 3))).round().astype(np.int32)
+            xyz.extend(pos.ravel().tolist())
+            splay_xyz.extend(splay.ravel().tolist())
+            surveys.append((label, flags, surface))
+
+            out.write_style(0x01 if i % 40 == 39 else 0x00) # diving, or normal
+
+            days = int(rng.randint(29000, 43000)) # 1979 to 2017
+            if i % 7 == 6: # a date range
+                out.buf.append(0x12)
+                out.buf += date_range_struct.pack(days, int(rng.randint(0, 30)))
+            else:
+                out.buf.append(0x11)
+                out.buf += date_struct.pack(days)
+
+            positions = pos.tolist()
+            out.buf.append(0x0f) # MOVE
+            out.buf += xyz_struct.pack(*positions[0])
+            out.buf.append(0x40 | flags) # LINE, with the survey label
+            out.write_label(label)
+            out.buf += xyz_struct.pack(*positions[1])
+            for p in positions[2:]:
+                out.buf.append(0x60 | flags) # LINE, same label
+                out.buf += xyz_struct.pack(*p)
+
+            if not surface:
+                length = int(np.abs(np.diff(pos, axis=0)).sum())
+                out.buf.append(0x1f) # error info
+                out.buf += error_struct.pack(LEGS_PER_SURVEY, length, *rng.randint(0, 500, 3).tolist())
+
+            for p, q in zip(positions[1:], splay.tolist()): # one splay from each station
+                out.buf.append(0x0f)
+                out.buf += xyz_struct.pack(*p)
+                out.buf.append(0x64 | flags)
+                out.buf += xyz_struct.pack(*q)
+
+            legs += 2 * LEGS_PER_SURVEY
+            splay_legs += LEGS_PER_SURVEY
+            if flags & 0x01:
+                surface_legs += 2 * LEGS_PER_SURVEY
+            if flags & 0x02:
+                duplicate_legs += 2 * LEGS_PER_SURVEY
+
+            out.flush()
+
+        # Now the stations, with the splay ends as anonymous stations
+
+        nstations = 0
+
+        for i, (label, flags, surface) in enumerate(surveys):
+            kind = 0x01 if surface else 0x02
+            pos = xyz[3 * (LEGS_PER_SURVEY + 1) * i:3 * (LEGS_PER_SURVEY + 1) * (i + 1)]
+            for j in range(LEGS_PER_SURVEY + 1):
+                flag = kind
+                if j == 0:
+                    flag |= 0x08 # exported, to join the survey it branches from
+                if surface and j == LEGS_PER_SURVEY or i == 0 and j == 0:
+                    flag |= 0x04 | 0x02 # entrance
+                out.buf.append(0x80 | flag)
+                out.write_label('%s.%i' % (label, j))
+                out.buf += xyz_struct.pack(*pos[3 * j:3 * j + 3])
+            splay = splay_xyz[3 * LEGS_PER_SURVEY * i:3 * LEGS_PER_SURVEY * (i + 1)]
+            for j in range(LEGS_PER_SURVEY):
+                out.buf.append(0x80 | 0x20 | kind)
+                out.write_label(label + '.')
+                out.buf += xyz_struct.pack(*splay[3 * j:3 * j + 3])
+            nstations += 2 * LEGS_PER_SURVEY + 1
+            out.flush()
+
+        # Finally the XSECTs along the centre line of the surveys underground
+
+        nxsects = 0
+
+        for i, (label, flags, surface) in enumerate(surveys):
+            if surface:
+                continue
+            lrud = rng.randint(50, 500, (LEGS_PER_SURVEY + 1, 4))
+            lrud[rng.uniform(size=lrud.shape) < 0.02] = -1 # missing
+            for j, values in enumerate(lrud.tolist()):
+                out.buf.append(0x31 if j == LEGS_PER_SURVEY else 0x30)
+                out.write_label('%s.%i' % (label, j))
+                out.buf += lrud_short_struct.pack(*values)
+            nxsects += LEGS_PER_SURVEY + 1
+            out.flush()
+
+        out.write_end()
+
+    return Counts(legs, splay_legs, surface_legs, duplicate_legs, nstations, nxsects, nsurveys)
+
+def parse_size(s):
+    """Parse a number of legs such as 10000, 10k or 1M"""
+    scale = {'k': 1000, 'M': 1000000}.get(s[-1:], 1)
+    return int(float(s[:-1] if scale > 1 else s) * scale)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='write a synthetic survex .3d file')
+    parser.add_argument('FILE', help='output .3d file')
+    parser.add_argument('-n', '--legs', type=parse_size, default=parse_size('10k'),
+                        help='number of legs, as 10000, 10k or 1M (default 10k)')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed (default 0)')
+    args = parser.parse_args()
+
+    counts = write_synthetic_3d(args.FILE, args.legs, args.seed)
+    print('%s: %s' % (args.FILE, ', '.join('%i %s' % (n, name.replace('_', ' '))
+                                           for name, n in zip(counts._fields, counts))))
@@ -10,10 +10,17 @@
 # Distributed under the terms of the GNU General Public License v2
 
 import argparse
-from struct import unpack
+import os
+import sys
 from datetime import date
 import math as m
 
+# The decoder is shared with the plugin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SurvexImport'))
+
+import survex3d
+
 styles = {0x00 : 'NORMAL',
           0x01 : 'DIVING',
           0x02 : 'CARTESIAN',
@@ -41,6 +48,14 @@ def to_date_range(days1, days2):
     """Convert from integer days range to a string YYYY.mm.dd-YYYY.mm.dd"""
     return to_date(days1) + '-' + to_date(days2)
 
+def to_date_string(days1, days2):
+    """Convert a date, or range of dates, to a string (or None if no date)"""
+    if days1 is None:
+        return None
+    if days1 == days2:
+        return to_date(days1)
+    return to_date_range(days1, days2)
+
 def to_string(ijk):
     """Convert xyz, lrud, nlehv (error info) tuples to strings"""
     if len(ijk) == 3:
@@ -60,30 +75,6 @@ def to_lrud_string(lrud, label, date_string):
         s = s + ' ' + date_string
     return s
 
-def read_xyz(fp):
-    """Read xyz as signed integers according to .3d spec and return as tuple""" 
-    return unpack('<iii', fp.read(12))
-        
-def read_len(fp):
-    """Read a number as a length according to .3d spec"""
-    byte = ord(fp.read(1))
-    if byte != 0xff:
-        return byte
-    else:
-        return unpack('<I', fp.read(4))[0]
-
-def read_label(fp, current_label):
-    """Read a string as a label, or part thereof, according to .3d spec"""
-    byte = ord(fp.read(1))
-    if byte != 0x00:
-        ndel = byte >> 4
-        nadd = byte & 0x0f
-    else:
-        ndel = read_len(fp)
-        nadd = read_len(fp)
-    oldlen = len(current_label)
-    return current_label[:oldlen - ndel] + fp.read(nadd).decode('ascii')
-
 # Command line arguments
 
 parser = argparse.ArgumentParser(description='Dump contents of .3d file to stdout')
@@ -93,158 +84,87 @@ args = parser.parse_args()
     
 # Start reading file
 
-with open(args.FILE, 'rb') as fp:
-    
-    line = fp.readline().rstrip() # File ID
-    if not line.startswith(b'Survex 3D Image File'):
-        raise IOError('Not a Survex 3D File: ' + args.FILE)
-
-    line = fp.readline().rstrip() # File format version
-    if not line.startswith(b'v'):
-        raise IOError('Unrecognised .3d version: ' + args.FILE)
-    version = int(line[1:])
-    if version < 8:
-        raise IOError('Version >= 8 required: ' + args.FILE)
-
-    line = fp.readline().rstrip() # Metadata (title and coordinate system)
-    title, cs = [s.decode('utf-8') for s in line.split(b'\x00')]
-
-    line = fp.readline().rstrip() # Timestamp
-    if not line.startswith(b'@'):
-        raise IOError('Unrecognised timestamp: ' + args.FILE)
-    timestamp = int(line[1:])
-
-    # Write file header to match output of dump3d
-    
-    print('TITLE "%s"' % title)
-    print('DATE "@%i"' % timestamp)
-    print('DATE_NUMERIC %i' % timestamp)
-    print('CS %s' % cs)
-    print('VERSION 8')
-    print("SEPARATOR '.'")
-    print('--')
-
-    # System-wide flags
+records = survex3d.iter_3d_records(args.FILE)
 
-    flag = ord(fp.read(1))
+header = next(records)
 
-    if flag & 0x80:
-        raise IOError('Flagged as extended elevation: ' + args.FILE)
-
-    # All front-end data read in, now read byte-wise according to .3d spec, and process
+# Write file header to match output of dump3d
     
-    current_label = ''
-    current_date = None
-    current_style = 0xff
-
-    traverse_list = []
-    traverse_label = []
-    current_traverse = []
+print('TITLE "%s"' % header.title)
+print('DATE "@%i"' % header.timestamp)
+print('DATE_NUMERIC %i' % header.timestamp)
+print('CS %s' % header.cs)
+print('VERSION 8')
+print("SEPARATOR '.'")
+print('--')
 
-    xsect_list = []
-    current_xsect = []
+# System-wide flags
 
-    station_xyz = {}
+if header.flag & 0x80:
+    raise IOError('Flagged as extended elevation: ' + args.FILE)
 
-    while True:
+# All front-end data read in, now walk through the records and process
 
-        char = fp.read(1)
+traverse_list = []
+traverse_label = []
+current_traverse = []
+current_label = ''
 
-        if not char: # End of file reached (prematurely?)
-            raise IOError('Premature end of file: ' + args.FILE)
+xsect_list = []
+current_xsect = []
 
-        byte = ord(char)
+station_xyz = {}
 
-        if byte <= 0x05: # STYLE
-            if byte == 0x00 and current_style == 0x00: # this signals end of data
-                print('STOP')
-                if current_traverse:
-                    traverse_list.append(current_traverse)
-                    traverse_label.append(current_label)
-                break # escape from byte-gobbling while loop
-            else:
-                current_style = byte
-                
-        elif byte <= 0x0e: # Reserved
-            continue
-        
-        elif byte == 0x0f: # MOVE
-            xyz = read_xyz(fp)
-            print('MOVE ' + to_string(xyz))
-            if current_traverse:
-                traverse_list.append(current_traverse)
-                traverse_label.append(current_label)
-                current_traverse = []
-            current_traverse.append(xyz)
-
-        elif byte == 0x10: # DATE (none)
-            current_date = None
-            
-        elif byte == 0x11: # DATE (single date)
-            days = unpack('<H', fp.read(2))[0]
-            current_date = to_date(days)
-            
-        elif byte == 0x12:  # DATE (date range, short format)
-            days, extra = unpack('<HB', fp.read(3))
-            current_date = to_date_range(days, days + extra + 1)
+for record in records:
 
-        elif byte == 0x13: # DATE (date range, long format)
-            days1, days2 = unpack('<HH', fp.read(4))
-            current_date = to_date_range(days1, days2)
+    if isinstance(record, survex3d.Move):
+        print('MOVE ' + to_string(record.xyz))
+        if current_traverse:
+            traverse_list.append(current_traverse)
+            traverse_label.append(current_label)
+            current_traverse = []
+        current_traverse.append(record.xyz)
 
-        elif byte <= 0x1e: # Reserved
-            continue
-        
-        elif byte == 0x1f:  # Error info
-            nlehv = unpack('<iiiii', fp.read(20))
-            print('ERROR_INFO ' + to_string(nlehv))
-            
-        elif byte <= 0x2f: # Reserved
-            continue
-        
-        elif byte <= 0x33: # XSECT
-            current_label = read_label(fp, current_label)
-            if byte & 0x02: # short or long format
-                lrud = unpack('<iiii', fp.read(16))
-            else:
-                lrud = unpack('<hhhh', fp.read(8))
-            print('XSECT ' + to_lrud_string(lrud, current_label, current_date))
-            current_xsect.append((current_label, lrud))
-            if byte & 0x01:
-                print('XSECT_END')
-                xsect_list.append(current_xsect)
-                current_xsect = []
+    elif isinstance(record, survex3d.ErrorInfo):
+        print('ERROR_INFO ' + to_string(record.nlehv))
             
-        elif byte <= 0x3f: # Reserved
-            continue
-        
-        elif byte <= 0x7f: # LINE
-            flag = byte & 0x3f
-            if not (flag & 0x20):
-                current_label = read_label(fp, current_label)
-            xyz = read_xyz(fp)
-            flags = [v for k, v in sorted(line_flags.iteritems()) if flag & k]
-            tag = styles[current_style]
-            if flags:
-                tag = tag + ' ' + ' '.join(flags)
-            if args.show_dates and current_date:
-                tag = tag + ' ' + current_date
-            print('LINE %s [%s] STYLE=%s' % (to_string(xyz), current_label, tag))
-            current_traverse.append(xyz)
-
-        elif byte <= 0xff: # LABEL (or NODE)
-            flag = byte & 0x7f
-            current_label = read_label(fp, current_label)
-            xyz = read_xyz(fp)
-            flags = [v for k, v in sorted(node_flags.iteritems()) if flag & k]
-            if flags:
-                tag = ' '.join(flags)
-                print('NODE %s [%s] %s' % (to_string(xyz), current_label, tag))
-            else:
-                print('NODE %s [%s]' % (to_string(xyz), current_label))
-            station_xyz[current_label] = xyz
-
-# file closes automatically, with open(args.FILE, 'rb') as fp:
+    elif isinstance(record, survex3d.Xsect):
+        current_date = to_date_string(record.date1, record.date2)
+        print('XSECT ' + to_lrud_string(record.lrud, record.label, current_date))
+        current_xsect.append((record.label, record.lrud))
+        if record.end:
+            print('XSECT_END')
+            xsect_list.append(current_xsect)
+            current_xsect = []
+
+    elif isinstance(record, survex3d.Line):
+        flags = [v for k, v in sorted(line_flags.items()) if record.flag & k]
+        tag = styles[record.style]
+        if flags:
+            tag = tag + ' ' + ' '.join(flags)
+        current_date = to_date_string(record.date1, record.date2)
+        if args.show_dates and current_date:
+            tag = tag + ' ' + current_date
+        print('LINE %s [%s] STYLE=%s' % (to_string(record.xyz), record.label, tag))
+        current_traverse.append(record.xyz)
+
+    elif isinstance(record, survex3d.Node):
+        flags = [v for k, v in sorted(node_flags.items()) if record.flag & k]
+        if flags:
+            tag = ' '.join(flags)
+            print('NODE %s [%s] %s' % (to_string(record.xyz), record.label, tag))
+        else:
+            print('NODE %s [%s]' % (to_string(record.xyz), record.label))
+        station_xyz[record.label] = record.xyz
+
+    if hasattr(record, 'label'):
+        current_label = record.label
+
+print('STOP')
+
+if current_traverse:
+    traverse_list.append(current_traverse)
+    traverse_label.append(current_label)
 
 #with open('traverses.dat', 'w') as fp:
 #    for i, traverse in enumerate(traverse_list):